@@ -4,6 +4,8 @@ import pandas as pd
 import numpy as np
 import logging
 
+from collections import OrderedDict
+
 from activitysim.core import inject
 
 
@@ -62,7 +64,16 @@ beam_skims_types = {'timePeriod': str,
                     }
 
 
-def _load_raw_beam_skims(settings):
+# default number of beam skims rows to read at a time
+DEFAULT_BEAM_SKIMS_CHUNK_SIZE = 1000000
+
+# (all transit paths currently get walk access values)
+walk_access_paths = ['WLK_COM_WLK', 'WLK_HVY_WLK', 'WLK_LOC_WLK', 'WLK_LRF_WLK', 'WLK_EXP_WLK', 'WLK_TRN_WLK']
+
+METERS_TO_MILES = 0.621371 / 1000
+
+
+def _beam_skims_url(settings):
 
     if settings.get('beam_skims_url', False):
         beam_skims_url = settings.get('beam_skims_url')
@@ -78,10 +89,33 @@ def _load_raw_beam_skims(settings):
                 "simulation.py --help or configs/settings.yaml "
                 "for more ideas.")
 
-    # load skims from url
-    skims = pd.read_csv(beam_skims_url, dtype=beam_skims_types)
+    return beam_skims_url
+
+
+def _read_beam_skims_chunks(beam_skims_url, columns, chunk_size):
+    """
+    generator yielding dataframes of (at most chunk_size) rows of the beam skims csv or parquet file
+
+    Parameters
+    ----------
+    beam_skims_url : str
+        path or url of csv (optionally compressed) or parquet file
+    columns : list of str
+        beam skims columns to read
+    chunk_size : int
+        max rows per chunk
+    """
 
-    return skims
+    if beam_skims_url.endswith('.parquet'):
+        # pyarrow is only needed for parquet beam skims
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(beam_skims_url)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        dtype = {c: beam_skims_types[c] for c in columns if c in beam_skims_types}
+        for chunk in pd.read_csv(beam_skims_url, usecols=columns, dtype=dtype, chunksize=chunk_size):
+            yield chunk
 
 
 def create_skim_object(data_dir):
@@ -99,158 +133,218 @@ def create_skim_object(data_dir):
         return True
 
 
-def create_skims_by_mode(settings):
+def beam_skims_zone_ids(beam_skims_url, chunk_size):
     """
-    Returns 2 OD pandas dataframe for auto and transit
+    sorted unique origin zone ids in beam skims (reading only the origin column)
     """
-    logger.info("Splitting BEAM skims by mode.")
-    skims_df = _load_raw_beam_skims(settings)
 
-    num_hours = skims_df['timePeriod'].nunique()
-    num_modes = skims_df['pathType'].nunique()
-    num_od_pairs = len(skims_df) / num_hours / num_modes
+    zone_ids = np.zeros(0, dtype=int)
+    for chunk in _read_beam_skims_chunks(beam_skims_url, ['origin'], chunk_size):
+        zone_ids = np.union1d(zone_ids, chunk['origin'].unique())
+
+    return zone_ids
+
 
-    # make sure the matrix is square
-    num_taz = np.sqrt(num_od_pairs)
-    assert num_taz.is_integer()
-    num_taz = int(num_taz)
+def _scatter_max_time(od, time, values, max_time, matrices):
+    """
+    scatter row values into flattened od matrices, keeping the values of the row with the
+    largest time for each od pair (of all rows scattered so far)
+
+    Parameters
+    ----------
+    od : numpy array of int
+        flattened od index of each row
+    time : numpy array of float
+        time of each row
+    values : list of numpy arrays
+        row values for each matrix
+    max_time : numpy array of float
+        (num_taz * num_taz) largest time scattered so far for each od pair (updated in place)
+    matrices : list of numpy arrays
+        (num_taz * num_taz) flattened matrices (updated in place)
+    """
 
-    # convert beam skims to activitysim units (miles and minutes)
-    skims_df['DIST_miles'] = skims_df['DIST_meters'] * (0.621371 / 1000)
-    skims_df['DDIST_miles'] = skims_df['DDIST_meters'] * (0.621371 / 1000)
+    if len(od) == 0:
+        return
 
-    skims_df = skims_df.sort_values(['origin', 'destination', 'TIME_minutes'])
-    logger.info('Splitting out auto skims.')
-    auto_df = skims_df.loc[skims_df['pathType'] == 'SOV']
-    logger.info('Splitting out transit skims.')
-    transit_df = skims_df[(skims_df['pathType'].isin(transit_paths))]
-    return auto_df, transit_df, num_taz
+    # order rows by od and time, so the last row for each od has the largest time
+    order = np.lexsort((time, od))
+    od = od[order]
+    last = np.ones(len(od), dtype=bool)
+    last[:-1] = od[1:] != od[:-1]
 
+    od = od[last]
+    rows = order[last]
+    time = time[rows]
 
-def distance_skims(auto_df, data_dir, num_taz):
+    update = time >= max_time[od]
+    od = od[update]
+    rows = rows[update]
 
-    # Open skims object
-    skims_path = os.path.join(data_dir, 'skims.omx')
-    skims = omx.open_file(skims_path, 'a')
+    max_time[od] = time[update]
+    for matrix, row_values in zip(matrices, values):
+        matrix[od] = row_values[rows]
+
+
+def read_beam_skims(beam_skims_url, zone_ids, chunk_size):
+    """
+    stream beam skims and scatter rows directly into flattened skim matrices
+
+    Rows are mapped to integer od, period and path codes so each chunk is scattered with a few
+    vectorized assignments, and memory use is bounded by the size of the matrices (not the input).
+
+    Parameters
+    ----------
+    beam_skims_url : str
+    zone_ids : numpy array of int
+        sorted zone ids (skim matrix order)
+    chunk_size : int
+
+    Returns
+    -------
+    auto_matrices : dict {(<period>, <beam column>): flattened matrix}
+        SOV skims by period
+    dist_matrix : flattened matrix
+        SOV distance (miles) of the slowest (all period) SOV row for each od pair
+    transit_matrices : dict {<beam column>: flattened matrix}
+        walk access transit skims of the slowest (all period) walk access transit row for each od pair
+    """
+
+    num_taz = len(zone_ids)
+    num_od_pairs = num_taz * num_taz
+
+    auto_columns = [c for c in beam_asim_hwy_measure_map.values() if c]
+    transit_columns = list(OrderedDict.fromkeys(c for c in beam_asim_transit_measure_map.values() if c))
+
+    auto_matrices = {(period, c): np.zeros(num_od_pairs) for period in periods for c in auto_columns}
+    auto_rows = np.zeros(len(periods), dtype=np.int64)
+
+    dist_matrix = np.zeros(num_od_pairs)
+    dist_max_time = np.full(num_od_pairs, -np.inf)
+
+    transit_matrices = OrderedDict((c, np.zeros(num_od_pairs)) for c in transit_columns)
+    transit_max_time = np.full(num_od_pairs, -np.inf)
+
+    path_codes = OrderedDict((path, code) for code, path in enumerate(['SOV'] + walk_access_paths))
+    sov_code = path_codes['SOV']
+
+    # beam columns (meters converted to miles after reading)
+    read_columns = ['timePeriod', 'pathType', 'origin', 'destination'] + \
+        [c.replace('_miles', '_meters') for c in OrderedDict.fromkeys(auto_columns + transit_columns)]
+
+    for chunk in _read_beam_skims_chunks(beam_skims_url, read_columns, chunk_size):
+
+        # convert beam skims to activitysim units (miles and minutes)
+        chunk['DIST_miles'] = chunk['DIST_meters'] * METERS_TO_MILES
+        chunk['DDIST_miles'] = chunk['DDIST_meters'] * METERS_TO_MILES
+
+        # path code (-1 for paths we don't use)
+        path = pd.Categorical(chunk['pathType'], categories=list(path_codes.keys())).codes
+        keep = path >= 0
+        if not keep.any():
+            continue
+        chunk = chunk[keep]
+        path = path[keep]
+
+        orig = np.searchsorted(zone_ids, chunk['origin'].values)
+        dest = np.searchsorted(zone_ids, chunk['destination'].values)
+        assert (orig < num_taz).all() and (zone_ids[orig] == chunk['origin'].values).all()
+        assert (dest < num_taz).all() and (zone_ids[dest] == chunk['destination'].values).all()
+        od = orig * num_taz + dest
+
+        time = chunk['TIME_minutes'].values
+        period = pd.Categorical(chunk['timePeriod'], categories=periods).codes
+
+        # - auto skims by period
+        sov = path == sov_code
+        for period_code, period_name in enumerate(periods):
+            rows = sov & (period == period_code)
+            auto_rows[period_code] += rows.sum()
+            for c in auto_columns:
+                auto_matrices[(period_name, c)][od[rows]] = chunk[c].values[rows]
+
+        # - distance from slowest SOV row
+        _scatter_max_time(od[sov], time[sov],
+                          [chunk['DIST_miles'].values[sov]],
+                          dist_max_time, [dist_matrix])
+
+        # - walk access transit skims from slowest walk access row
+        walk = ~sov
+        _scatter_max_time(od[walk], time[walk],
+                          [chunk[c].values[walk] for c in transit_columns],
+                          transit_max_time, list(transit_matrices.values()))
+
+    # same checks as reshaping complete od dataframes
+    for period_code, period_name in enumerate(periods):
+        assert auto_rows[period_code] == num_od_pairs, \
+            "beam skims have %s SOV rows for period %s, expected %s" % \
+            (auto_rows[period_code], period_name, num_od_pairs)
+    assert np.isfinite(dist_max_time).all(), "beam skims missing SOV od pairs"
+    assert np.isfinite(transit_max_time).all(), "beam skims missing walk access transit od pairs"
+
+    return auto_matrices, dist_matrix, transit_matrices
+
+
+def distance_skims(skims, dist_matrix, num_taz):
 
     # TO DO: Include walk and bike distances,
     # for now walk and bike are the same as drive.
-    distances_auto = auto_df.drop_duplicates(
-        ['origin', 'destination'],
-        keep='last')[beam_asim_hwy_measure_map['DIST']]
 
     # TO DO: Do something better.
-    distances_auto = distances_auto.replace(
-        0, np.random.normal(39, 20))
-
-    # distances_walk = walk_df.drop_duplicates(
-    #     ['origin', 'destination'])[beam_asim_hwy_measure_map['DIST']]
-
-    mx_auto = distances_auto.values.reshape((num_taz, num_taz))
-    # mx_walk = distances_walk.values.reshape((num_taz, num_taz))
+    mx_auto = np.where(dist_matrix == 0, np.random.normal(39, 20), dist_matrix).reshape((num_taz, num_taz))
 
     # Distance matrices
     skims['DIST'] = mx_auto
     skims['DISTBIKE'] = mx_auto
     skims['DISTWALK'] = mx_auto
-    skims.close()
 
 
-def transit_access(transit_df, access_paths, num_taz):
-    ''' OD pair value for drive access '''
-    df = transit_df[transit_df.pathType.isin(access_paths)]
-    df.drop_duplicates(['origin', 'destination'], keep='last', inplace=True)
-    assert df.shape[0] == num_taz * num_taz
-    return df
-
-
-def transit_skims(transit_df, data_dir, num_taz):
+def transit_skims(skims, transit_matrices, num_taz):
     """ Generate transit OMX skims"""
     logger.info("Creating transit skims.")
-    # Open skims object
-    skims_path = os.path.join(data_dir, 'skims.omx')
-    skims = omx.open_file(skims_path, 'a')
-
-    drive_access = ['DRV_COM_WLK', 'DRV_HVY_WLK',
-                    'DRV_LOC_WLK', 'DRV_LRF_WLK', 'DRV_EXP_WLK']
-    walk_acces = ['WLK_COM_WLK', 'WLK_HVY_WLK', 'WLK_LOC_WLK',
-                  'WLK_LRF_WLK', 'WLK_EXP_WLK', 'WLK_TRN_WLK']
 
-    drive_access_values = transit_access(transit_df, drive_access, num_taz)
-    walk_access_values = transit_access(transit_df, walk_acces, num_taz)
+    zeros = np.zeros((num_taz, num_taz))
+
+    # each measure matrix is computed once and written for all paths and periods
+    measure_matrices = OrderedDict()
+    for measure, column in beam_asim_transit_measure_map.items():
+        if (measure == 'FAR') or (measure == 'BOARDS'):
+            mx = transit_matrices[column].reshape((num_taz, num_taz))
+        elif column:
+            # activitysim estimated its models using transit skims from Cube
+            # which store time values as scaled integers (e.g. x100), so their
+            # models also divide transit skim values by 100. Since our skims
+            # aren't coming out of Cube, we multiply by 100 to negate the division.
+            # This only applies for travel times. Fare is not multiplied by 100.
+            mx = transit_matrices[column].reshape((num_taz, num_taz)) * 100
+        else:
+            mx = zeros
+        measure_matrices[measure] = mx
 
+    # TO DO: Drive access needs to be different for each transit mode
+    # TO DO: Walk access needs to be different for each transit mode
+    # (for now all paths, including drive access paths, get walk access values)
     for path in transit_paths:
-
-        path_ = path.replace('EXP', "LOC")  # Get the values of LOC for EXP.
-        path_ = path_.replace('TRN', "LOC")  # Get the values of LOC for TRN.
-
-        # # When BEAM skims generates all skims
-        # mask1 = transit_df['pathType'] == path_
-        # df = transit_df[mask1]
-
-        # TO DO: Drive access needs to be different for each transit mode
-        # TO DO: Walk access needs to be different for each transit mode
-        if path[:4] == 'DRIVE':
-            df = drive_access_values
-        else:
-            df = walk_access_values
         for period in periods:
-            # # When BEAM skims generates all skims
-            # mask2 = df_['timePeriod'] == period
-            # df_ = df[mask2]
-            df_ = df
-            for measure in beam_asim_transit_measure_map.keys():
-                name = '{0}_{1}__{2}'.format(path, measure, period)
-                if (measure == 'FAR') or (measure == 'BOARDS'):
-                    vals = df_[beam_asim_transit_measure_map[measure]]
-                    mx = vals.values.reshape((num_taz, num_taz), order='C')
-                elif beam_asim_transit_measure_map[measure]:
-                   # activitysim estimated its models using transit skims from Cube
-                    # which store time values as scaled integers (e.g. x100), so their
-                    # models also divide transit skim values by 100. Since our skims
-                    # aren't coming out of Cube, we multiply by 100 to negate the division. 
-                    # This only applies for travel times. Fare is not multiplied by 100. 
-                    vals = df_[beam_asim_transit_measure_map[measure]]
-                    mx = vals.values.reshape((num_taz, num_taz), order='C')*100
-                else:
-                    mx = np.zeros((num_taz, num_taz))
-                skims[name] = mx
-    skims.close()
+            for measure, mx in measure_matrices.items():
+                skims['{0}_{1}__{2}'.format(path, measure, period)] = mx
 
 
-def auto_skims(auto_df, data_dir, num_taz):
+def auto_skims(skims, auto_matrices, num_taz):
     logger.info("Creating drive skims.")
-    # Open skims object
-    skims_path = os.path.join(data_dir, 'skims.omx')
-    skims = omx.open_file(skims_path, 'a')
+
+    zeros = np.zeros((num_taz, num_taz))
 
     # Create skims
     for period in periods:
-        mask1 = auto_df['timePeriod'] == period
-        df = auto_df[mask1]
         for path in hwy_paths:
-            for measure in beam_asim_hwy_measure_map.keys():
+            for measure, column in beam_asim_hwy_measure_map.items():
                 name = '{0}_{1}__{2}'.format(path, measure, period)
-                if beam_asim_hwy_measure_map[measure]:
-                    vals = df[beam_asim_hwy_measure_map[measure]]
-                    mx = vals.values.reshape((num_taz, num_taz), order='C')
+                if column:
+                    mx = auto_matrices[(period, column)].reshape((num_taz, num_taz))
                 else:
-                    mx = np.zeros((num_taz, num_taz))
+                    mx = zeros
                 skims[name] = mx
-    skims.close()
-
-
-def create_offset(auto_df, data_dir):
-    logger.info("Creating skims offset keys")
-
-    # Open skims object
-    skims_path = os.path.join(data_dir, 'skims.omx')
-    skims = omx.open_file(skims_path, 'a')
-
-    # Generint offset
-    taz_equivs = auto_df.origin.sort_values().unique()
-    skims.create_mapping('taz', taz_equivs)
-    skims.close()
 
 
 @inject.step()
@@ -258,12 +352,24 @@ def create_skims_from_beam(data_dir, settings):
 
     new = create_skim_object(data_dir)
     if new:
-        auto_df, transit_df, num_taz = create_skims_by_mode(settings)
+        beam_skims_url = _beam_skims_url(settings)
+        chunk_size = int(settings.get('beam_skims_chunk_size', DEFAULT_BEAM_SKIMS_CHUNK_SIZE))
+
+        logger.info("Reading zone ids from BEAM skims.")
+        zone_ids = beam_skims_zone_ids(beam_skims_url, chunk_size)
+        num_taz = len(zone_ids)
+
+        logger.info("Reading BEAM skims for %s zones." % num_taz)
+        auto_matrices, dist_matrix, transit_matrices = read_beam_skims(beam_skims_url, zone_ids, chunk_size)
+
+        skims = omx.open_file(os.path.join(data_dir, 'skims.omx'), 'a')
 
         # Create skims
-        distance_skims(auto_df, data_dir, num_taz)
-        auto_skims(auto_df, data_dir, num_taz)
-        transit_skims(transit_df, data_dir, num_taz)
+        distance_skims(skims, dist_matrix, num_taz)
+        auto_skims(skims, auto_matrices, num_taz)
+        transit_skims(skims, transit_matrices, num_taz)
 
         # Create offset
-        create_offset(auto_df, data_dir)
+        logger.info("Creating skims offset keys")
+        skims.create_mapping('taz', zone_ids)
+        skims.close()
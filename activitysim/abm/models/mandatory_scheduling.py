@@ -5,6 +5,7 @@ import logging
 import pandas as pd
 
 from activitysim.core import simulate
+from activitysim.core import compact
 from activitysim.core import tracing
 from activitysim.core import config
 from activitysim.core import inject
@@ -70,7 +71,7 @@ def mandatory_tour_scheduling(tours,
         (mandatory_tours.tour_type == 'school') & \
         reindex(persons_merged.is_university, mandatory_tours.person_id)
     mandatory_tours[tour_segment_col] = \
-        mandatory_tours.tour_type.where(~is_university_tour, 'univ')
+        compact.add_categories(mandatory_tours.tour_type, ['univ']).where(~is_university_tour, 'univ')
 
     # load specs
     spec_segment_settings = model_settings.get('SPEC_SEGMENTS', {})
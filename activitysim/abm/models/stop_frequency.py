@@ -186,7 +186,7 @@ def stop_frequency(
                           tours_merged.primary_purpose, value_counts=True)
 
     choices_list = []
-    for segment_type, choosers in tours_merged.groupby('primary_purpose'):
+    for segment_type, choosers in tours_merged.groupby('primary_purpose', observed=True):
 
         logging.info("%s running segment %s with %s chooser rows" %
                      (trace_label, segment_type, choosers.shape[0]))
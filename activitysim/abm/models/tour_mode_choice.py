@@ -10,6 +10,7 @@ from activitysim.core import config
 from activitysim.core import inject
 from activitysim.core import pipeline
 from activitysim.core import simulate
+from activitysim.core import compact
 from activitysim.core.mem import force_garbage_collect
 from activitysim.core.util import assign_in_place
 
@@ -132,11 +133,12 @@ def tour_mode_choice_simulate(tours, persons_merged,
         # FIXME run_tour_mode_choice_simulate writes choosers post-annotation
 
     choices_list = []
+    # (tour_type may be categorical if compact_tables)
+    tour_type = compact.add_categories(primary_tours_merged.tour_type, ['univ'])
     primary_tours_merged['primary_purpose'] = \
-        primary_tours_merged.tour_type.where((primary_tours_merged.tour_type != 'school') |
-                                             ~primary_tours_merged.is_university, 'univ')
+        tour_type.where((tour_type != 'school') | ~primary_tours_merged.is_university, 'univ')
 
-    for primary_purpose, tours_segment in primary_tours_merged.groupby('primary_purpose'):
+    for primary_purpose, tours_segment in primary_tours_merged.groupby('primary_purpose', observed=True):
 
         logger.info("tour_mode_choice_simulate primary_purpose '%s' (%s tours)" %
                     (primary_purpose, len(tours_segment.index), ))
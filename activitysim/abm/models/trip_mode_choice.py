@@ -98,7 +98,7 @@ def trip_mode_choice(
     })
 
     choices_list = []
-    for primary_purpose, trips_segment in trips_merged.groupby('primary_purpose'):
+    for primary_purpose, trips_segment in trips_merged.groupby('primary_purpose', observed=True):
 #         print(primary_purpose, trips_segment)
 
         segment_trace_label = tracing.extend_trace_label(trace_label, primary_purpose)
@@ -169,7 +169,7 @@ def run_trip_purpose(
     rows_per_chunk, effective_chunk_size = \
         trip_purpose_rpc(chunk_size, trips_df, probs_spec, trace_label=trace_label)
 
-    for i, num_chunks, trips_chunk in chunk.chunked_choosers(trips_df, rows_per_chunk):
+    for i, num_chunks, trips_chunk in chunk.chunked_choosers(trips_df, rows_per_chunk, trace_label=trace_label):
 
         logger.info("Running chunk %s of %s size %d", i, num_chunks, len(trips_chunk))
 
@@ -463,7 +463,8 @@ def run_trip_scheduling(
         trip_scheduling_rpc(chunk_size, trips, probs_spec, trace_label)
 
     result_list = []
-    for i, num_chunks, trips_chunk in chunk.chunked_choosers_by_chunk_id(trips, rows_per_chunk):
+    for i, num_chunks, trips_chunk in chunk.chunked_choosers_by_chunk_id(trips, rows_per_chunk,
+                                                                         trace_label=trace_label):
 
         if num_chunks > 1:
             chunk_trace_label = tracing.extend_trace_label(trace_label, 'chunk_%s' % i)
@@ -169,7 +169,7 @@ def individual_utilities(
         persons,
         cdap_indiv_spec,
         locals_d,
-        trace_hh_id=None, trace_label=None):
+        trace_hh_id=None, trace_label=None, deduplicate=True):
     """
     Calculate CDAP utilities for all individuals.
 
@@ -179,6 +179,8 @@ def individual_utilities(
         DataFrame of individual persons data.
     cdap_indiv_spec : pandas.DataFrame
         CDAP spec applied to individuals.
+    deduplicate : bool
+        compute utilities once per distinct profile of persons (see simulate.chooser_profiles)
 
     Returns
     -------
@@ -188,8 +190,14 @@ def individual_utilities(
 
     """
 
-    # calculate single person utilities
-    indiv_utils = simulate.eval_utilities(cdap_indiv_spec, persons, locals_d, trace_label=trace_label)
+    # calculate single person utilities (once per distinct profile of persons)
+    profiles, profile_of_person = simulate.chooser_profiles(cdap_indiv_spec, persons, locals_d, trace_label,
+                                                            deduplicate=deduplicate)
+    if profiles is None:
+        indiv_utils = simulate.eval_utilities(cdap_indiv_spec, persons, locals_d, trace_label=trace_label)
+    else:
+        indiv_utils = simulate.eval_utilities(cdap_indiv_spec, profiles, locals_d, trace_label=trace_label)
+        indiv_utils = simulate.expand_profiles(indiv_utils, profile_of_person, persons.index)
 
     # add columns from persons to facilitate building household interactions
     useful_columns = [_hh_id_, _ptype_, 'cdap_rank', _hh_size_]
@@ -822,7 +830,8 @@ def _run_cdap(
     # i.e. three columns 'M' (Mandatory), 'N' (NonMandatory), 'H' (Home)
     indiv_utils = individual_utilities(persons[persons.cdap_rank <= MAX_HHSIZE],
                                        cdap_indiv_spec, locals_d,
-                                       trace_hh_id, trace_label)
+                                       trace_hh_id, trace_label,
+                                       deduplicate=config.setting('deduplicate_choosers', True))
 
     # compute interaction utilities, probabilities, and hh activity pattern choices
     # for each size household separately in turn up to MAX_HHSIZE
@@ -940,7 +949,8 @@ def run_cdap(
 
     result_list = []
     # segment by person type and pick the right spec for each person type
-    for i, num_chunks, persons_chunk in chunk.chunked_choosers_by_chunk_id(persons, rows_per_chunk):
+    for i, num_chunks, persons_chunk in chunk.chunked_choosers_by_chunk_id(persons, rows_per_chunk,
+                                                                           trace_label=trace_label):
 
         logger.info("Running chunk %s of %s with %d persons" % (i, num_chunks, len(persons_chunk)))
 
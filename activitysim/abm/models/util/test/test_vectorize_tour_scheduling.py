@@ -8,6 +8,7 @@ import numpy as np
 
 import pandas.testing as pdt
 
+from activitysim.core import compact
 from activitysim.core import inject
 
 from ..vectorize_tour_scheduling import get_previous_tour_by_tourid, \
@@ -77,3 +78,55 @@ def test_vts():
     # by the trip index.  shrug?
     expected = [2, 2, 2, 0, 0]
     assert (tdd_choices.values == expected).all()
+
+
+def test_vts_compact_tables():
+
+    inject.add_injectable("settings", {
+        'compact_tables': True,
+        'compact_categories': {'tours': {'tour_type': ['work', 'school']}},
+    })
+
+    alts = pd.DataFrame({
+        "start": [1, 1, 2, 3],
+        "end": [1, 4, 5, 6]
+    })
+    alts['duration'] = alts.end - alts.start
+    inject.add_injectable("tdd_alts", alts)
+
+    persons = pd.DataFrame({
+        "income": [20, 30, 25],
+        "is_university": [False, True, False]
+    }, index=[1, 2, 3])
+    inject.add_table('persons', persons, replace=True)
+
+    spec = pd.DataFrame({"Coefficient": [1.2]}, index=["income"])
+    spec.index.name = "Expression"
+
+    def schedule(tours):
+        # segment like mandatory_scheduling (adding a value that may not be among tour_type categories)
+        is_university_tour = (tours.tour_type == 'school') & persons.is_university.reindex(tours.person_id).values
+        tours['tour_segment'] = compact.add_categories(tours.tour_type, ['univ']).where(~is_university_tour, 'univ')
+        timetable = inject.get_injectable("timetable")
+        return vectorize_tour_scheduling(
+            tours, persons, alts, timetable,
+            tour_segments={segment: {'spec': spec} for segment in ['work', 'school', 'univ', 'escort']},
+            tour_segment_col='tour_segment',
+            model_settings={},
+            chunk_size=0, trace_label='test_vts_compact_tables')
+
+    tours = pd.DataFrame({
+        "person_id": [1, 1, 2, 3, 3],
+        "tour_num": [1, 2, 1, 1, 2],
+        "tour_type": ['work', 'school', 'school', 'work', 'work']
+    })
+
+    expected = schedule(tours.copy())
+
+    inject.clear_cache()
+    compacted = compact.compact_df(tours.copy(), 'tours')
+    assert pd.api.types.is_categorical_dtype(compacted.tour_type)
+
+    pdt.assert_series_equal(schedule(compacted), expected)
+
+    inject.reinject_decorated_tables()
@@ -463,7 +463,7 @@ def schedule_tours(
 
     result_list = []
     for i, num_chunks, chooser_chunk \
-            in chunk.chunked_choosers(tours, rows_per_chunk):
+            in chunk.chunked_choosers(tours, rows_per_chunk, trace_label=tour_trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
@@ -5,6 +5,11 @@ from builtins import int
 
 import sys
 import os
+import re
+import glob
+import math
+import time
+import hashlib
 import logging
 import multiprocessing
 
@@ -14,6 +19,7 @@ from operator import mul
 
 import numpy as np
 import openmatrix as omx
+import yaml
 
 from activitysim.core import skim
 from activitysim.core import inject
@@ -27,8 +33,125 @@ logger = logging.getLogger(__name__)
 Read in the omx files and create the skim objects
 """
 
+# low precision dtypes in which skims can optionally be stored (see skim_quantization setting)
+QUANTIZED_SKIM_DTYPES = ['float16', 'int16', 'uint8']
 
-def get_skim_info(omx_file_path, tags_to_load=None):
+
+def get_skim_quantization(quantization_settings):
+    """
+    normalize skim_quantization setting into dict of quantization info keyed by key1
+
+    ::
+
+      skim_quantization:
+        DIST: float16
+        DRV_COM_WLK_BOARDS: uint8
+        SOV_TIME:
+          dtype: int16
+          scale: 0.01
+          offset: 0
+
+    Stored value for skim value x is round((x - offset) / scale) for integer dtypes,
+    and dequantized on lookup as stored * scale + offset.
+
+    Parameters
+    ----------
+    quantization_settings : dict or None
+        {<key1>: <dtype_name> or {'dtype': <dtype_name>, 'scale': <float>, 'offset': <float>}}
+
+    Returns
+    -------
+    quantization : OrderedDict
+        {<key1>: {'dtype': <np.dtype>, 'scale': <float>, 'offset': <float>}}
+    """
+
+    quantization = OrderedDict()
+    for key1, spec in (quantization_settings or {}).items():
+
+        if not isinstance(spec, dict):
+            spec = {'dtype': spec}
+
+        dtype_name = spec.get('dtype')
+        if dtype_name not in QUANTIZED_SKIM_DTYPES:
+            raise RuntimeError("skim_quantization dtype '%s' for skim %s not in %s" %
+                               (dtype_name, key1, QUANTIZED_SKIM_DTYPES))
+
+        scale = float(spec.get('scale', 1))
+        offset = float(spec.get('offset', 0))
+
+        if np.issubdtype(np.dtype(dtype_name), np.floating) and (scale != 1 or offset != 0):
+            raise RuntimeError("skim_quantization scale and offset not supported for %s skim %s" %
+                               (dtype_name, key1))
+
+        if scale <= 0:
+            raise RuntimeError("skim_quantization scale for skim %s must be positive" % (key1, ))
+
+        quantization[key1] = {'dtype': np.dtype(dtype_name), 'scale': scale, 'offset': offset}
+
+    return quantization
+
+
+def block_dtype(skim_info, block_name):
+    """
+    storage dtype of skim block (skim_info dtype unless block holds quantized skims)
+    """
+    return skim_info.get('block_dtypes', {}).get(block_name, skim_info['dtype'])
+
+
+# skim key1 referenced by spec expressions like odt_skims['SOV_TIME'], od_skims.reverse('DIST'),
+# skim_od['DISTWALK'] or skim_dict.get(('SOV_TIME', 'MD'))
+SPEC_SKIM_KEY_PATTERN = re.compile(r"""(?:\w*skims?\w*|skim_\w+)\s*(?:\[|\.\w+\()\s*\(?\s*['"](\w+)['"]""")
+
+
+def spec_skim_key1s(configs_dir=None):
+    """
+    scan all csv spec files in configs dir(s) for skim lookups and return the set of skim key1s they reference
+
+    This is a purely lexical scan, so it errs on the side of including too many keys (e.g. from specs of
+    models that are not in the run list). Skims referenced by keys computed at run time are not detected
+    and must be listed in the keep_skims setting.
+
+    Parameters
+    ----------
+    configs_dir : str or list of str
+        defaults to configs_dir injectable
+
+    Returns
+    -------
+    key1s : set of str
+    """
+
+    if configs_dir is None:
+        configs_dir = inject.get_injectable('configs_dir')
+
+    if isinstance(configs_dir, str):
+        configs_dir = [configs_dir]
+
+    key1s = set()
+    for dir in configs_dir:
+        for spec_file_path in glob.glob(os.path.join(dir, '*.csv')):
+            with open(spec_file_path) as f:
+                key1s.update(SPEC_SKIM_KEY_PATTERN.findall(f.read()))
+
+    return key1s
+
+
+def skim_key1s_to_load():
+    """
+    key1s of skims to load if prune_skims setting is True (or None to load all skims)
+    """
+
+    if not config.setting('prune_skims', False):
+        return None
+
+    key1s = spec_skim_key1s() | set(config.setting('keep_skims', None) or [])
+
+    logger.info("prune_skims loading %s skim key1s referenced by specs or keep_skims" % len(key1s))
+
+    return key1s
+
+
+def get_skim_info(omx_file_path, tags_to_load=None, quantization_settings=None, key1s_to_load=None):
 
     # this is sys.maxint for p2.7 but no limit for p3
     # windows sys.maxint =  2147483647
@@ -73,11 +196,19 @@ def get_skim_info(omx_file_path, tags_to_load=None):
         if tags_to_load and sep and key2 not in tags_to_load:
             continue
 
+        # - ignore skims not referenced by model specs (if pruning)
+        if key1s_to_load is not None and key1 not in key1s_to_load:
+            continue
+
         skim_key = (key1, key2) if sep else key1
         omx_keys[skim_key] = skim_name
 
     num_skims = len(omx_keys)
 
+    if key1s_to_load is not None:
+        logger.info("get_skim_info pruned %s of %s omx skims not referenced by model specs" %
+                    (len(omx_skim_names) - num_skims, len(omx_skim_names)))
+
     # - key1_subkeys dict maps key1 to dict of subkeys with that key1
     # DIST: {'DIST': 0}
     # DRV_COM_WLK_BOARDS: {'MD': 1, 'AM': 0, 'PM': 2}, ...
@@ -90,34 +221,55 @@ def get_skim_info(omx_file_path, tags_to_load=None):
         key2_dict = key1_subkeys.setdefault(key1, {})
         key2_dict[key2] = len(key2_dict)
 
+    # - quantization dict maps key1 to storage dtype, scale and offset for key1 skims stored at low precision
+    # DIST: {'dtype': dtype('float16'), 'scale': 1.0, 'offset': 0.0}, ...
+    quantization = get_skim_quantization(quantization_settings)
+    quantization = OrderedDict([(k, v) for k, v in quantization.items() if k in key1_subkeys])
+
+    def key1_dtype(key1):
+        return quantization[key1]['dtype'] if key1 in quantization else np.dtype(skim_dtype)
+
     # - blocks dict maps block name to blocksize (number of subkey skims in block)
     # skims_0: 198,
     # skims_1: 198, ...
+    # - block_dtypes dict maps block name to storage dtype of skims in block
+    # skims_0: float32,
+    # skims_1: float16, ...
     # - key1_block_offsets dict maps key1 to (block, offset) of first skim with that key1
     # DISTWALK: (0, 2),
     # DRV_COM_WLK_BOARDS: (0, 3), ...
 
-    if MAX_BLOCK_BYTES:
-        max_block_items = MAX_BLOCK_BYTES // np.dtype(skim_dtype).itemsize
-        max_skims_per_block = max_block_items // multiply_large_numbers(omx_shape)
-    else:
-        max_skims_per_block = num_skims
-
     def block_name(block):
         return "skim_%s_%s" % (omx_name, block)
 
+    # all skims in a block share a buffer, so group key1s by storage dtype (full precision skims first)
+    dtypes = [np.dtype(skim_dtype)] + [np.dtype(d) for d in QUANTIZED_SKIM_DTYPES]
+    key1s = sorted(key1_subkeys.keys(), key=lambda k: dtypes.index(key1_dtype(k)))
+
     key1_block_offsets = OrderedDict()
     blocks = OrderedDict()
+    block_dtypes = OrderedDict()
     block = offset = 0
-    for key1, v in key1_subkeys.items():
-        num_subkeys = len(v)
-        if offset + num_subkeys > max_skims_per_block:  # next block
+    dtype = key1_dtype(key1s[0]) if key1s else np.dtype(skim_dtype)
+    for key1 in key1s:
+        num_subkeys = len(key1_subkeys[key1])
+
+        if MAX_BLOCK_BYTES:
+            max_block_items = MAX_BLOCK_BYTES // key1_dtype(key1).itemsize
+            max_skims_per_block = max_block_items // multiply_large_numbers(omx_shape)
+        else:
+            max_skims_per_block = num_skims
+
+        if offset + num_subkeys > max_skims_per_block or key1_dtype(key1) != dtype:  # next block
             blocks[block_name(block)] = offset
+            block_dtypes[block_name(block)] = dtype
             block += 1
             offset = 0
+            dtype = key1_dtype(key1)
         key1_block_offsets[key1] = (block, offset)
         offset += num_subkeys
     blocks[block_name(block)] = offset  # last block
+    block_dtypes[block_name(block)] = dtype
 
     # - block_offsets dict maps skim_key to (block, offset) of omx matrix
     # DIST: (0, 0),
@@ -152,6 +304,8 @@ def get_skim_info(omx_file_path, tags_to_load=None):
         'key1_block_offsets': key1_block_offsets,
         'block_offsets': block_offsets,
         'blocks': blocks,
+        'block_dtypes': block_dtypes,
+        'quantization': quantization,
     }
 
     return skim_info
@@ -159,13 +313,14 @@ def get_skim_info(omx_file_path, tags_to_load=None):
 
 def buffers_for_skims(skim_info, shared=False):
 
-    skim_dtype = skim_info['dtype']
     omx_shape = skim_info['omx_shape']
     blocks = skim_info['blocks']
 
     skim_buffers = {}
     for block_name, block_size in blocks.items():
 
+        skim_dtype = block_dtype(skim_info, block_name)
+
         # buffer_size must be int, not np.int64
         buffer_size = int(multiply_large_numbers(omx_shape) * block_size)
 
@@ -179,6 +334,11 @@ def buffers_for_skims(skim_info, shared=False):
                 typecode = 'd'
             elif np.issubdtype(skim_dtype, np.float32):
                 typecode = 'f'
+            elif np.issubdtype(skim_dtype, np.float16) or np.issubdtype(skim_dtype, np.int16):
+                # no float16 typecode, but frombuffer only cares about itemsize
+                typecode = 'h'
+            elif np.issubdtype(skim_dtype, np.uint8):
+                typecode = 'B'
             else:
                 raise RuntimeError("buffers_for_skims unrecognized dtype %s" % skim_dtype)
 
@@ -196,7 +356,6 @@ def skim_data_from_buffers(skim_buffers, skim_info):
     assert type(skim_buffers) == dict
 
     omx_shape = skim_info['omx_shape']
-    skim_dtype = skim_info['dtype']
     blocks = skim_info['blocks']
 
     skim_data = []
@@ -204,7 +363,7 @@ def skim_data_from_buffers(skim_buffers, skim_info):
         skims_shape = omx_shape + (block_size,)
         block_buffer = skim_buffers[block_name]
         assert len(block_buffer) == int(multiply_large_numbers(skims_shape))
-        block_data = np.frombuffer(block_buffer, dtype=skim_dtype).reshape(skims_shape)
+        block_data = np.frombuffer(block_buffer, dtype=block_dtype(skim_info, block_name)).reshape(skims_shape)
         skim_data.append(block_data)
 
     return skim_data
@@ -218,36 +377,183 @@ def build_skim_cache_file_name(omx_name, block):
     return f"cached_{omx_name}_{block}.mmap"
 
 
-def read_skim_cache(skim_info, skim_data):
+def skim_cache_dir_setting():
+    return config.setting('skim_cache_dir') or default_skim_cache_dir()
+
+
+def open_skim_cache(skim_info, mode='r', skim_cache_dir=None):
     """
-        read cached memmapped skim data from canonically named cache file(s) in output directory into skim_data
+        open canonically named cache file(s) in skim cache directory as numpy memmaps
+
+    Parameters
+    ----------
+    skim_info : dict
+    mode : str
+        np.memmap mode ('r' to read existing cache files, 'r+' to update them, 'w+' to create or overwrite them)
+    skim_cache_dir : str
+        defaults to skim_cache_dir setting (explicit dir allows use from skim loader processes)
+
+    Returns
+    -------
+    skim_data : list of np.memmap
+        one memmap per skim block, with same shape and dtype as skim_data_from_buffers
     """
 
-    skim_cache_dir = config.setting('skim_cache_dir', default_skim_cache_dir())
-    logger.info(f"load_skims reading skims data from cache directory {skim_cache_dir}")
+    skim_cache_dir = skim_cache_dir or skim_cache_dir_setting()
 
     omx_name = skim_info['omx_name']
-    dtype = np.dtype(skim_info['dtype'])
+    omx_shape = skim_info['omx_shape']
 
-    blocks = skim_info['blocks']
-    block = 0
-    for block_name, block_size in blocks.items():
+    skim_data = []
+    for block, (block_name, block_size) in enumerate(skim_info['blocks'].items()):
+        dtype = np.dtype(block_dtype(skim_info, block_name))
         skim_cache_file_name = build_skim_cache_file_name(omx_name, block)
         skim_cache_path = os.path.join(skim_cache_dir, skim_cache_file_name)
 
-        assert os.path.isfile(skim_cache_path), \
-            "read_skim_cache could not find skim_cache_path: %s" % (skim_cache_path, )
+        if mode != 'w+':
+            assert os.path.isfile(skim_cache_path), \
+                "open_skim_cache could not find skim_cache_path: %s" % (skim_cache_path, )
 
-        block_data = skim_data[block]
+        skims_shape = omx_shape + (block_size,)
 
-        logger.info(f"load_skims reading block_name {block_name} {block_data.shape} from {skim_cache_file_name}")
+        logger.info(f"open_skim_cache block_name {block_name} {skims_shape} mode '{mode}' {skim_cache_file_name}")
 
-        data = np.memmap(skim_cache_path, shape=block_data.shape, dtype=dtype, mode='r')
-        assert data.shape == block_data.shape
+        skim_data.append(np.memmap(skim_cache_path, shape=skims_shape, dtype=dtype, mode=mode))
 
-        block_data[::] = data[::]
+    return skim_data
+
+
+def skim_cache_exists(skim_info):
+    """
+        check whether all the canonically named cache file(s) for skim_info exist in skim cache directory
+    """
+
+    skim_cache_dir = skim_cache_dir_setting()
+    omx_name = skim_info['omx_name']
+
+    return all(os.path.isfile(os.path.join(skim_cache_dir, build_skim_cache_file_name(omx_name, block)))
+               for block in range(len(skim_info['blocks'])))
+
+
+def build_skim_cache_manifest_file_name(omx_name):
+    return f"cached_{omx_name}.manifest.yaml"
 
-        block += 1
+
+def skim_cache_manifest_path(skim_info):
+    return os.path.join(skim_cache_dir_setting(), build_skim_cache_manifest_file_name(skim_info['omx_name']))
+
+
+def omx_fingerprint(omx_file_path, content_hash=False):
+    """
+    fingerprint of omx file from file size, mtime and the name, shape and dtype of its matrices
+    (and optionally a hash of the file contents)
+
+    Parameters
+    ----------
+    omx_file_path : str
+    content_hash : bool
+        include sha256 of file contents (slow for large files, but robust to copied files and mtime changes)
+
+    Returns
+    -------
+    fingerprint : str
+    """
+
+    stat = os.stat(omx_file_path)
+
+    h = hashlib.sha256()
+    h.update(repr((stat.st_size, stat.st_mtime_ns)).encode())
+
+    with omx.open_file(omx_file_path) as omx_file:
+        for m in omx_file.listMatrices():
+            h.update(repr((m, tuple(omx_file[m].shape), str(omx_file[m].dtype))).encode())
+
+    if content_hash:
+        with open(omx_file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+
+    return h.hexdigest()
+
+
+def skim_info_fingerprint(skim_info):
+    """
+    fingerprint of the skim_info elements that determine the layout and contents of the skim cache
+    """
+
+    h = hashlib.sha256()
+    for k in ['omx_shape', 'dtype', 'omx_keys', 'block_offsets', 'blocks', 'block_dtypes', 'quantization']:
+        v = skim_info.get(k)
+        h.update(repr((k, list(v.items()) if isinstance(v, dict) else v)).encode())
+
+    return h.hexdigest()
+
+
+def skim_cache_manifest(skim_info, omx_file_path):
+
+    return {
+        'omx_file_path': os.path.abspath(omx_file_path),
+        'omx_fingerprint': omx_fingerprint(omx_file_path, config.setting('skim_cache_content_hash', False)),
+        'skim_info_fingerprint': skim_info_fingerprint(skim_info),
+    }
+
+
+def write_skim_cache_manifest(skim_info, omx_file_path):
+    """
+    write manifest with fingerprints of source omx file and skim_info (after cache files are written)
+    """
+
+    with open(skim_cache_manifest_path(skim_info), 'w') as f:
+        yaml.dump(skim_cache_manifest(skim_info, omx_file_path), f)
+
+
+def remove_skim_cache_manifest(skim_info):
+    """
+    invalidate skim cache (before cache files are (re)written, so partially written caches are never valid)
+    """
+
+    manifest_path = skim_cache_manifest_path(skim_info)
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+
+
+def skim_cache_is_valid(skim_info, omx_file_path):
+    """
+    check whether skim cache exists and its manifest matches the current omx file and skim_info
+    """
+
+    manifest_path = skim_cache_manifest_path(skim_info)
+
+    if not (skim_cache_exists(skim_info) and os.path.isfile(manifest_path)):
+        logger.info("skim cache for %s not found" % (skim_info['omx_name'], ))
+        return False
+
+    with open(manifest_path) as f:
+        manifest = yaml.load(f, Loader=yaml.SafeLoader) or {}
+
+    current = skim_cache_manifest(skim_info, omx_file_path)
+    stale = [k for k in current if k != 'omx_file_path' and manifest.get(k) != current[k]]
+
+    if stale:
+        logger.warning("skim cache for %s is stale (%s changed)" % (skim_info['omx_name'], ', '.join(stale)))
+        return False
+
+    return True
+
+
+def read_skim_cache(skim_info, skim_data):
+    """
+        read cached memmapped skim data from canonically named cache file(s) in output directory into skim_data
+    """
+
+    skim_cache_dir = skim_cache_dir_setting()
+    logger.info(f"load_skims reading skims data from cache directory {skim_cache_dir}")
+
+    cache_data = open_skim_cache(skim_info, mode='r')
+
+    for block_data, data in zip(skim_data, cache_data):
+        assert data.shape == block_data.shape
+        block_data[::] = data[::]
 
 
 def write_skim_cache(skim_info, skim_data):
@@ -255,40 +561,174 @@ def write_skim_cache(skim_info, skim_data):
         write skim data from skim_data to canonically named cache file(s) in output directory
     """
 
-    skim_cache_dir = config.setting('skim_cache_dir', default_skim_cache_dir())
+    skim_cache_dir = skim_cache_dir_setting()
     logger.info(f"load_skims writing skims data to cache directory {skim_cache_dir}")
 
-    omx_name = skim_info['omx_name']
-    dtype = np.dtype(skim_info['dtype'])
+    cache_data = open_skim_cache(skim_info, mode='w+')
 
-    blocks = skim_info['blocks']
-    block = 0
-    for block_name, block_size in blocks.items():
-        skim_cache_file_name = build_skim_cache_file_name(omx_name, block)
-        skim_cache_path = os.path.join(skim_cache_dir, skim_cache_file_name)
+    for block_data, data in zip(skim_data, cache_data):
+        data[::] = block_data
+        data.flush()
 
-        block_data = skim_data[block]
 
-        logger.info(f"load_skims writing block_name {block_name} {block_data.shape} to {skim_cache_file_name}")
+def memmap_skims(omx_file_path, skim_info, build_cache=True):
+    """
+    return skim_data as read-only memmaps of the skim cache file(s), building the cache first if necessary
+
+    Unlike read_skim_cache, the cached data is not copied into skim buffers, so the blocks in skim_data
+    are backed by the OS page cache (shared by all processes that map the same files) and only the pages
+    holding the OD cells actually looked up are read from disk.
+
+    The cache is (re)built from the omx file if it is missing or stale (see skim_cache_is_valid)
+    or if write_skim_cache is set.
+    Data is read from omx directly into the writeable memmaps, without intermediate skim buffers.
+
+    Only the single process (or the multiprocess mp_setup_skims step) should build the cache.
+    Multiprocess sub-processes map the cache built by mp_setup_skims with build_cache False,
+    since rebuilding it would overwrite the files other sub-processes have mapped. They do not
+    check the cache against the omx file again (mp_setup_skims already did, and only writes the
+    manifest once the cache is valid), so they just require the manifest to exist.
+
+    Parameters
+    ----------
+    omx_file_path : str
+    skim_info : dict
+    build_cache : bool
+        build the cache if necessary (otherwise raise RuntimeError if it or its manifest does not exist)
+
+    Returns
+    -------
+    skim_data : list of read-only np.memmap
+    """
+
+    if not build_cache:
+        if not (skim_cache_exists(skim_info) and os.path.isfile(skim_cache_manifest_path(skim_info))):
+            raise RuntimeError("memmap_skims skim cache (or manifest) for %s not found in %s" %
+                               (skim_info['omx_name'], skim_cache_dir_setting()))
+        return open_skim_cache(skim_info, mode='r')
+
+    if config.setting('write_skim_cache') or not skim_cache_is_valid(skim_info, omx_file_path):
+
+        t0 = tracing.print_elapsed_time()
+
+        remove_skim_cache_manifest(skim_info)
+        cache_data = open_skim_cache(skim_info, mode='w+')
+
+        num_processes = num_skim_load_processes()
+        if num_processes > 1:
+            # skim loader processes read omx directly into (r+ memmaps of) the cache files we just created
+            del cache_data
+            read_skims_from_omx_parallel(skim_info, None, omx_file_path, num_processes)
+        else:
+            read_skims_from_omx(skim_info, cache_data, omx_file_path)
+            for data in cache_data:
+                data.flush()
+            del cache_data
+
+        write_skim_cache_manifest(skim_info, omx_file_path)
+
+        tracing.print_elapsed_time("memmap_skims build skim cache", t0)
+
+    return open_skim_cache(skim_info, mode='r')
 
-        data = np.memmap(skim_cache_path, shape=block_data.shape, dtype=dtype, mode='w+')
-        data[::] = block_data
 
-        block += 1
+def quantize_skim(data, quantization):
+    """
+    convert full precision skim data to the low precision storage dtype specified by quantization
+
+    Parameters
+    ----------
+    data : 2D numpy array
+    quantization : dict
+        {'dtype': <np.dtype>, 'scale': <float>, 'offset': <float>} (see get_skim_quantization)
+
+    Returns
+    -------
+    quantized : 2D numpy array of quantization dtype
+    max_error : float
+        maximum absolute difference between data and dequantized values (ignoring nans)
+    """
+
+    dtype = quantization['dtype']
+
+    if np.issubdtype(dtype, np.floating):
+        quantized = data.astype(dtype)
+    else:
+        iinfo = np.iinfo(dtype)
+        quantized = np.rint((data - quantization['offset']) / quantization['scale'])
+
+        num_nans = np.isnan(quantized).sum()
+        if num_nans:
+            logger.warning("quantize_skim %s nan values cannot be stored as %s, storing as 0" % (num_nans, dtype))
+            quantized = np.nan_to_num(quantized, nan=0)
+
+        num_clipped = ((quantized < iinfo.min) | (quantized > iinfo.max)).sum()
+        if num_clipped:
+            logger.warning("quantize_skim %s values out of %s range after scale and offset will be clipped" %
+                           (num_clipped, dtype))
+
+        quantized = np.clip(quantized, iinfo.min, iinfo.max).astype(dtype)
+
+    error = np.abs(skim.dequantize(quantized, quantization, dtype=data.dtype) - data)
+    max_error = float(np.nanmax(error)) if not np.isnan(error).all() else 0.0
 
+    return quantized, max_error
 
-def read_skims_from_omx(skim_info, skim_data, omx_file_path):
+
+def log_quantization_errors(skim_info, quantization_errors):
+
+    quantization = skim_info.get('quantization', {})
+
+    for skim_key, max_error in quantization_errors.items():
+        q = quantization[skim_key[0] if isinstance(skim_key, tuple) else skim_key]
+        logger.info("load_skims quantized skim %s as %s (scale %s offset %s) max error %s" %
+                    (skim_key, q['dtype'], q['scale'], q['offset'], max_error))
+
+
+def log_skim_load_throughput(label, num_bytes, t0):
+
+    seconds = max(time.time() - t0, 1e-6)
+    logger.info("%s loaded %s in %.1f seconds (%s/sec)" %
+                (label, util.GB(num_bytes), seconds, util.GB(num_bytes / seconds)))
+
+
+def read_skims_from_omx(skim_info, skim_data, omx_file_path, skim_keys=None, log_errors=True):
     """
     read skims from omx file into skim_data
+
+    skims with quantization info in skim_info are converted to their low precision storage dtype,
+    and the maximum quantization error for each such skim is logged (and returned)
+
+    Parameters
+    ----------
+    skim_info : dict
+    skim_data : list of numpy arrays (one per block)
+    omx_file_path : str
+    skim_keys : list of skim keys
+        skim_keys to read (defaults to all omx_keys in skim_info)
+    log_errors : bool
+        log quantization errors
+
+    Returns
+    -------
+    quantization_errors : dict
+        {<skim_key>: <max absolute quantization error>} for quantized skims
     """
 
     block_offsets = skim_info['block_offsets']
     omx_keys = skim_info['omx_keys']
+    quantization = skim_info.get('quantization', {})
+
+    if skim_keys is None:
+        skim_keys = list(omx_keys.keys())
+
+    quantization_errors = OrderedDict()
 
     # read skims into skim_data
     with omx.open_file(omx_file_path) as omx_file:
-        for skim_key, omx_key in omx_keys.items():
+        for skim_key in skim_keys:
 
+            omx_key = omx_keys[skim_key]
             omx_data = omx_file[omx_key]
             assert np.issubdtype(omx_data.dtype, np.floating)
 
@@ -298,33 +738,349 @@ def read_skims_from_omx(skim_info, skim_data, omx_file_path):
             logger.debug("load_skims load omx_key %s skim_key %s to block %s offset %s" %
                          (omx_key, skim_key, block, offset))
 
+            key1 = skim_key[0] if isinstance(skim_key, tuple) else skim_key
+
             # this will trigger omx readslice to read and copy data to skim_data's buffer
             a = block_data[:, :, offset]
-            a[:] = omx_data[:]
+            if key1 in quantization:
+                a[:], quantization_errors[skim_key] = quantize_skim(omx_data[:], quantization[key1])
+            else:
+                a[:] = omx_data[:]
+
+    logger.debug("load_skims loaded %s skims from %s" % (len(skim_keys), omx_file_path, ))
+
+    if log_errors:
+        log_quantization_errors(skim_info, quantization_errors)
+
+    return quantization_errors
+
+
+def load_sparse_skims(omx_file_path, skim_info, sparse_skim_settings):
+    """
+    read skims from omx file into a SparseSkimDict, keeping only od pairs within a cutoff
+
+    omx matrices are read in chunks of rows, so the dense zones x zones skims are never all in memory.
+    All skims share the sparsity pattern of the od pairs whose cutoff_skim value is at most cutoff.
+
+    Parameters
+    ----------
+    omx_file_path : str
+    skim_info : dict
+        as returned by get_skim_info (quantized skims are not supported)
+    sparse_skim_settings : dict
+        cutoff_skim: name of omx matrix (e.g. DIST) used to select the od pairs to store
+        cutoff: max cutoff_skim value of stored od pairs
+        default: value of skims for od pairs not stored (e.g. a large value that makes alternatives unattractive)
+        defaults: optional dict of default values for specific skim key1s
+        rows_per_chunk: optional number of omx rows to read at a time
+
+    Returns
+    -------
+    skim_dict : skim.SparseSkimDict
+    """
+
+    cutoff_skim = sparse_skim_settings.get('cutoff_skim')
+    cutoff = sparse_skim_settings.get('cutoff')
+    rows_per_chunk = int(sparse_skim_settings.get('rows_per_chunk', 1000))
+
+    if cutoff_skim is None or cutoff is None:
+        raise RuntimeError("sparse_skims settings must specify cutoff_skim and cutoff")
+    if 'default' not in sparse_skim_settings:
+        raise RuntimeError("sparse_skims settings must specify default value for od pairs beyond cutoff")
+    if skim_info.get('quantization'):
+        raise RuntimeError("sparse_skims not supported with skim_quantization")
+
+    num_rows = skim_info['omx_shape'][0]
+    omx_keys = skim_info['omx_keys']
+    block_offsets = skim_info['block_offsets']
+
+    t0 = time.time()
+
+    with omx.open_file(omx_file_path) as omx_file:
+
+        # - sparsity pattern from cutoff_skim
+        cutoff_data = omx_file[cutoff_skim]
+        row_counts = np.zeros(num_rows, dtype=np.int64)
+        indices = []
+        for r0 in range(0, num_rows, rows_per_chunk):
+            r1 = min(r0 + rows_per_chunk, num_rows)
+            rows, cols = np.nonzero(cutoff_data[r0:r1] <= cutoff)
+            row_counts[r0:r1] = np.bincount(rows, minlength=r1 - r0)
+            indices.append(cols)
+
+        indptr = np.concatenate(([0], np.cumsum(row_counts)))
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        nnz = len(indices)
+
+        skim_data = [np.zeros((nnz, block_size), dtype=block_dtype(skim_info, block_name))
+                     for block_name, block_size in skim_info['blocks'].items()]
+
+        # - read stored od pairs of each skim, a chunk of rows at a time
+        for skim_key, omx_key in omx_keys.items():
+            omx_data = omx_file[omx_key]
+            block, offset = block_offsets[skim_key]
+            for r0 in range(0, num_rows, rows_per_chunk):
+                r1 = min(r0 + rows_per_chunk, num_rows)
+                i0, i1 = indptr[r0], indptr[r1]
+                rows = np.repeat(np.arange(r1 - r0), row_counts[r0:r1])
+                skim_data[block][i0:i1, offset] = omx_data[r0:r1][rows, indices[i0:i1]]
+
+    num_bytes = sum(block_data.nbytes for block_data in skim_data) + indptr.nbytes + indices.nbytes
+    logger.info("load_sparse_skims stored %s of %s od pairs (%.1f%%) with %s <= %s in %s" %
+                (nnz, multiply_large_numbers(skim_info['omx_shape']),
+                 100.0 * nnz / max(multiply_large_numbers(skim_info['omx_shape']), 1),
+                 cutoff_skim, cutoff, util.GB(num_bytes)))
+    log_skim_load_throughput('load_sparse_skims', num_bytes, t0)
+
+    return skim.SparseSkimDict(skim_data, skim_info, indptr, indices,
+                               default_value=sparse_skim_settings['default'],
+                               default_values=sparse_skim_settings.get('defaults'))
+
+
+"""
+Parallel skim loading
+
+Skims are read (from omx or skim cache) by a bounded pool of skim loader processes that write
+directly into the (shared) skim buffers or skim cache memmaps. Worker processes get the skim buffers
+through the pool initializer (shared multiprocessing.RawArrays can only be passed by inheritance).
+"""
+
+# skim data for current skim loader process (set by _init_skim_loader_process)
+_SKIM_LOADER = {}
+
+
+def num_skim_load_processes():
+    """
+    number of skim loader processes from num_skim_load_processes setting (1 to load serially)
+    """
+    return max(int(config.setting('num_skim_load_processes', 1) or 1), 1)
+
+
+def _init_skim_loader_process(skim_info, skim_buffers, skim_cache_dir, cache_mode):
+
+    _SKIM_LOADER['skim_info'] = skim_info
+    _SKIM_LOADER['skim_data'] = \
+        skim_data_from_buffers(skim_buffers, skim_info) if skim_buffers is not None else None
+    _SKIM_LOADER['cache_data'] = \
+        open_skim_cache(skim_info, mode=cache_mode, skim_cache_dir=skim_cache_dir) if cache_mode else None
+
+
+def _read_omx_task(args):
+
+    omx_file_path, skim_keys = args
+
+    skim_info = _SKIM_LOADER['skim_info']
+    skim_data = _SKIM_LOADER['skim_data']
+    if skim_data is None:
+        skim_data = _SKIM_LOADER['cache_data']
+
+    quantization_errors = read_skims_from_omx(skim_info, skim_data, omx_file_path, skim_keys, log_errors=False)
+
+    if skim_data is _SKIM_LOADER['cache_data']:
+        for data in skim_data:
+            data.flush()
+
+    return quantization_errors
+
+
+def _read_cache_task(args):
+
+    block, start, stop = args
+    _SKIM_LOADER['skim_data'][block][start:stop] = _SKIM_LOADER['cache_data'][block][start:stop]
+
+
+def _write_cache_task(args):
 
-    logger.info("load_skims loaded skims from %s" % (omx_file_path, ))
+    block, start, stop = args
+    data = _SKIM_LOADER['cache_data'][block]
+    data[start:stop] = _SKIM_LOADER['skim_data'][block][start:stop]
+    data.flush()
+
+
+def run_skim_loader_pool(task, task_args, skim_info, skim_buffers, cache_mode, num_processes):
+    """
+    run task for each of task_args in a pool of num_processes skim loader processes
+
+    Parameters
+    ----------
+    task : function
+        one of the skim loader task functions (e.g. _read_omx_task)
+    task_args : list
+        task argument for each task
+    skim_info : dict
+    skim_buffers : dict of shared buffers (multiprocessing.RawArray) or None
+        if not None, skim_data in the skim loader processes is built from these buffers
+    cache_mode : str or None
+        np.memmap mode to open skim cache files in the skim loader processes (or None to not open them)
+    num_processes : int
+
+    Returns
+    -------
+    results : list of task results (in no particular order)
+    """
+
+    skim_cache_dir = skim_cache_dir_setting() if cache_mode else None
+
+    num_processes = min(num_processes, len(task_args))
+
+    logger.info("run_skim_loader_pool %s tasks with %s processes" % (len(task_args), num_processes))
+
+    with multiprocessing.Pool(processes=num_processes,
+                              initializer=_init_skim_loader_process,
+                              initargs=(skim_info, skim_buffers, skim_cache_dir, cache_mode)) as pool:
+        results = list(pool.imap_unordered(task, task_args))
+
+    return results
+
+
+def skim_block_row_slices(skim_info, num_processes):
+    """
+    split each skim block into row slices for parallel copying (a few slices per process for load balancing)
+    """
+
+    num_rows = skim_info['omx_shape'][0]
+    rows_per_slice = max(int(math.ceil(num_rows / (num_processes * 4))), 1)
+
+    slices = []
+    for block in range(len(skim_info['blocks'])):
+        for start in range(0, num_rows, rows_per_slice):
+            slices.append((block, start, min(start + rows_per_slice, num_rows)))
+
+    return slices
+
+
+def skim_data_bytes(skim_info):
+
+    omx_shape = skim_info['omx_shape']
+    return sum(int(multiply_large_numbers(omx_shape) * block_size) *
+               np.dtype(block_dtype(skim_info, block_name)).itemsize
+               for block_name, block_size in skim_info['blocks'].items())
+
+
+def read_skims_from_omx_parallel(skim_info, skim_buffers, omx_file_path, num_processes):
+    """
+    read skims from omx file with a pool of skim loader processes
+
+    Parameters
+    ----------
+    skim_info : dict
+    skim_buffers : dict of shared buffers (multiprocessing.RawArray) or None
+        if None, skims are read into the (existing) skim cache files
+    omx_file_path : str
+    num_processes : int
+    """
+
+    t0 = tracing.print_elapsed_time()
+
+    # - several tasks per process for load balancing, each reading a batch of skims from its own omx file handle
+    skim_keys = list(skim_info['omx_keys'].keys())
+    num_tasks = min(num_processes * 4, len(skim_keys))
+    task_args = [(omx_file_path, skim_keys[i::num_tasks]) for i in range(num_tasks)]
+
+    cache_mode = 'r+' if skim_buffers is None else None
+    results = run_skim_loader_pool(_read_omx_task, task_args, skim_info, skim_buffers, cache_mode, num_processes)
+
+    # tasks read interleaved skim keys, so put errors back in skim key order
+    errors = {}
+    for task_errors in results:
+        errors.update(task_errors)
+    quantization_errors = OrderedDict([(k, errors[k]) for k in skim_keys if k in errors])
+    log_quantization_errors(skim_info, quantization_errors)
+
+    log_skim_load_throughput("read_skims_from_omx_parallel", skim_data_bytes(skim_info), t0)
+
+    return quantization_errors
+
+
+def read_skim_cache_parallel(skim_info, skim_buffers, num_processes):
+    """
+    read skim cache files into shared skim_buffers with a pool of skim loader processes
+    """
+
+    t0 = tracing.print_elapsed_time()
+
+    logger.info(f"load_skims reading skims data from cache directory {skim_cache_dir_setting()}")
+
+    task_args = skim_block_row_slices(skim_info, num_processes)
+    run_skim_loader_pool(_read_cache_task, task_args, skim_info, skim_buffers, 'r', num_processes)
+
+    log_skim_load_throughput("read_skim_cache_parallel", skim_data_bytes(skim_info), t0)
+
+
+def write_skim_cache_parallel(skim_info, skim_buffers, num_processes):
+    """
+    write shared skim_buffers to skim cache files with a pool of skim loader processes
+    """
+
+    t0 = tracing.print_elapsed_time()
+
+    logger.info(f"load_skims writing skims data to cache directory {skim_cache_dir_setting()}")
+
+    # create (or truncate) cache files so they can be opened 'r+' by skim loader processes
+    cache_data = open_skim_cache(skim_info, mode='w+')
+    del cache_data
+
+    task_args = skim_block_row_slices(skim_info, num_processes)
+    run_skim_loader_pool(_write_cache_task, task_args, skim_info, skim_buffers, 'r+', num_processes)
+
+    log_skim_load_throughput("write_skim_cache_parallel", skim_data_bytes(skim_info), t0)
+
+
+def shared_skim_buffers(skim_buffers):
+    """
+    True if skim_buffers can be shared with skim loader processes (i.e. are not process-local numpy arrays)
+    """
+    return not any(isinstance(buffer, np.ndarray) for buffer in skim_buffers.values())
 
 
 def load_skims(omx_file_path, skim_info, skim_buffers):
+    """
+    load skims into skim_buffers from skim cache (if read_skim_cache and the cache is valid) or omx file
+
+    If read_skim_cache is set but the cache is missing or stale (its manifest fingerprints do not match the
+    current omx file and skim_info), skims are read from omx and the cache is rebuilt.
+    If write_skim_cache is set, skims are always read from omx and the cache rebuilt.
+    """
 
     read_cache = config.setting('read_skim_cache')
     write_cache = config.setting('write_skim_cache')
-    assert not (read_cache and write_cache), \
-        "read_skim_cache and write_skim_cache are both True in settings file. I am assuming this is a mistake"
+
+    if write_cache:
+        read_cache = False
+    elif read_cache and not skim_cache_is_valid(skim_info, omx_file_path):
+        logger.info("load_skims rebuilding skim cache from %s" % (omx_file_path, ))
+        read_cache = False
+        write_cache = True
 
     skim_data = skim_data_from_buffers(skim_buffers, skim_info)
 
+    num_processes = num_skim_load_processes()
+    if num_processes > 1 and not shared_skim_buffers(skim_buffers):
+        logger.warning("load_skims loading skims serially since skim_buffers are not shared")
+        num_processes = 1
+
     t0 = tracing.print_elapsed_time()
 
     if read_cache:
-        read_skim_cache(skim_info, skim_data)
+        if num_processes > 1:
+            read_skim_cache_parallel(skim_info, skim_buffers, num_processes)
+        else:
+            read_skim_cache(skim_info, skim_data)
         t0 = tracing.print_elapsed_time("read_skim_cache", t0)
     else:
-        read_skims_from_omx(skim_info, skim_data, omx_file_path)
+        if num_processes > 1:
+            read_skims_from_omx_parallel(skim_info, skim_buffers, omx_file_path, num_processes)
+        else:
+            read_skims_from_omx(skim_info, skim_data, omx_file_path)
         t0 = tracing.print_elapsed_time("read_skims_from_omx", t0)
 
     if write_cache:
-        write_skim_cache(skim_info, skim_data)
+        remove_skim_cache_manifest(skim_info)
+        if num_processes > 1:
+            write_skim_cache_parallel(skim_info, skim_buffers, num_processes)
+        else:
+            write_skim_cache(skim_info, skim_data)
+        write_skim_cache_manifest(skim_info, omx_file_path)
         t0 = tracing.print_elapsed_time("write_skim_cache", t0)
 
 
@@ -337,18 +1093,35 @@ def skim_dict(settings):
     logger.info("loading skim_dict from %s" % (omx_file_path, ))
 
     # select the skims to load
-    skim_info = get_skim_info(omx_file_path, tags_to_load)
+    skim_info = get_skim_info(omx_file_path, tags_to_load, settings.get('skim_quantization'),
+                              skim_key1s_to_load())
 
     logger.debug("omx_shape %s skim_dtype %s" % (skim_info['omx_shape'], skim_info['dtype']))
 
-    skim_buffers = inject.get_injectable('data_buffers', None)
-    if skim_buffers:
-        logger.info('Using existing skim_buffers for skims')
+    sparse_skim_settings = config.setting('sparse_skims')
+    if sparse_skim_settings:
+        # only store od pairs within cutoff (e.g. for fine grained zone systems)
+        logger.info('Using sparse skims')
+        skim_dict = load_sparse_skims(omx_file_path, skim_info, sparse_skim_settings)
+        set_skim_dict_offsets(skim_dict, skim_info)
+        return skim_dict
+
+    if config.setting('memmap_skim_cache'):
+        # serve skims straight from (read-only, os page-cached) skim cache files
+        logger.info('Using memmapped skim cache for skims')
+        # in multiprocess runs, the cache is built by mp_setup_skims before sub-processes map it
+        skim_data = memmap_skims(omx_file_path, skim_info,
+                                 build_cache=not inject.get_injectable('is_sub_task', False))
     else:
-        skim_buffers = buffers_for_skims(skim_info, shared=False)
-        load_skims(omx_file_path, skim_info, skim_buffers)
+        skim_buffers = inject.get_injectable('data_buffers', None)
+        if skim_buffers:
+            logger.info('Using existing skim_buffers for skims')
+        else:
+            # skim loader processes can only write to shared buffers
+            skim_buffers = buffers_for_skims(skim_info, shared=num_skim_load_processes() > 1)
+            load_skims(omx_file_path, skim_info, skim_buffers)
 
-    skim_data = skim_data_from_buffers(skim_buffers, skim_info)
+        skim_data = skim_data_from_buffers(skim_buffers, skim_info)
 
     block_names = list(skim_info['blocks'].keys())
     for i in range(len(skim_data)):
@@ -359,6 +1132,12 @@ def skim_dict(settings):
 
     # create skim dict
     skim_dict = skim.SkimDict(skim_data, skim_info)
+    set_skim_dict_offsets(skim_dict, skim_info)
+
+    return skim_dict
+
+
+def set_skim_dict_offsets(skim_dict, skim_info):
 
     offset_map = skim_info['offset_map']
     if offset_map is not None:
@@ -368,8 +1147,6 @@ def skim_dict(settings):
         # assume this is a one-based skim map
         skim_dict.offset_mapper.set_offset_int(-1)
 
-    return skim_dict
-
 
 def multiply_large_numbers(list_of_numbers):
     return reduce(mul, list_of_numbers)
@@ -1,9 +1,14 @@
+import os
+
 from collections import OrderedDict
 
 
 import numpy as np
+import pandas as pd
+import openmatrix as omx
 import pytest
 
+from activitysim.core import inject
 from activitysim.abm.tables import skims
 
 
@@ -65,3 +70,252 @@ def test_multiple_large_floats():
     calculated_value = skims.multiply_large_numbers([6205.1, 5423.2, 932.4, 15.4])
     actual_value = 483200518316.9472
     assert abs(calculated_value - actual_value) < 0.0001
+
+
+@pytest.fixture
+def omx_file_path(tmpdir):
+
+    omx_file_path = str(tmpdir.join('small_skims.omx'))
+    with omx.open_file(omx_file_path, 'w') as omx_file:
+        omx_file['DIST'] = np.arange(16, dtype=np.float32).reshape((4, 4))
+        omx_file['SOV_TIME__AM'] = np.arange(16, dtype=np.float32).reshape((4, 4)) * 10
+        omx_file['SOV_TIME__PM'] = np.arange(16, dtype=np.float32).reshape((4, 4)) * 100
+
+    return omx_file_path
+
+
+def test_memmap_skims(tmpdir, omx_file_path):
+
+    inject.add_injectable('settings', {})
+    inject.add_injectable('output_dir', str(tmpdir))
+
+    skim_info = skims.get_skim_info(omx_file_path, tags_to_load=['AM', 'PM'])
+
+    assert not skims.skim_cache_exists(skim_info)
+
+    skim_data = skims.memmap_skims(omx_file_path, skim_info)
+
+    assert skims.skim_cache_exists(skim_info)
+    assert isinstance(skim_data[0], np.memmap)
+    assert not skim_data[0].flags.writeable
+
+    skim_dict = skims.skim.SkimDict(skim_data, skim_info)
+    skim_dict.offset_mapper.set_offset_int(-1)
+
+    np.testing.assert_array_equal(skim_dict.get('DIST').get([1, 4], [2, 3]), [1, 14])
+    np.testing.assert_array_equal(skim_dict.get(('SOV_TIME', 'PM')).get([1, 4], [2, 3]), [100, 1400])
+
+    # read_skim_cache should copy the same data into skim buffers
+    skim_buffers = skims.buffers_for_skims(skim_info, shared=False)
+    buffer_data = skims.skim_data_from_buffers(skim_buffers, skim_info)
+    skims.read_skim_cache(skim_info, buffer_data)
+    np.testing.assert_array_equal(buffer_data[0], skim_data[0])
+
+    inject.reinject_decorated_tables()
+
+
+def test_memmap_skims_sub_task(tmpdir, omx_file_path):
+
+    inject.add_injectable('settings', {'write_skim_cache': True})
+    inject.add_injectable('output_dir', str(tmpdir))
+
+    skim_info = skims.get_skim_info(omx_file_path, tags_to_load=['AM', 'PM'])
+
+    # sub-processes never build the cache
+    with pytest.raises(RuntimeError):
+        skims.memmap_skims(omx_file_path, skim_info, build_cache=False)
+    assert not skims.skim_cache_exists(skim_info)
+
+    skims.memmap_skims(omx_file_path, skim_info)
+    cache_file_path = os.path.join(str(tmpdir), skims.build_skim_cache_file_name(skim_info['omx_name'], 0))
+    mtime = os.stat(cache_file_path).st_mtime_ns
+
+    # or rewrite it (even if write_skim_cache is set)
+    skim_data = skims.memmap_skims(omx_file_path, skim_info, build_cache=False)
+    assert not skim_data[0].flags.writeable
+    assert os.stat(cache_file_path).st_mtime_ns == mtime
+
+    # or check it against the omx file (the parent already did)
+    os.utime(omx_file_path, ns=(0, 0))
+    skims.memmap_skims(omx_file_path, skim_info, build_cache=False)
+    assert os.stat(cache_file_path).st_mtime_ns == mtime
+
+    # but require the manifest the parent writes once the cache is built and valid
+    skims.remove_skim_cache_manifest(skim_info)
+    with pytest.raises(RuntimeError):
+        skims.memmap_skims(omx_file_path, skim_info, build_cache=False)
+
+    inject.reinject_decorated_tables()
+
+
+def test_quantized_skim_info(tmpdir, omx_file_path):
+
+    inject.add_injectable('settings', {})
+    inject.add_injectable('output_dir', str(tmpdir))
+
+    quantization_settings = {
+        'DIST': 'float16',
+        'SOV_TIME': {'dtype': 'int16', 'scale': 0.5},
+    }
+
+    skim_info = skims.get_skim_info(omx_file_path, ['AM', 'PM'], quantization_settings)
+
+    # full precision and each quantized dtype in separate blocks
+    assert list(skim_info['block_dtypes'].values()) == [np.float16, np.int16]
+    assert skim_info['block_offsets'] == {'DIST': (0, 0), ('SOV_TIME', 'AM'): (1, 0), ('SOV_TIME', 'PM'): (1, 1)}
+
+    skim_buffers = skims.buffers_for_skims(skim_info, shared=True)
+    skim_data = skims.skim_data_from_buffers(skim_buffers, skim_info)
+    assert skim_data[1].dtype == np.int16
+
+    quantization_errors = skims.read_skims_from_omx(skim_info, skim_data, omx_file_path)
+    assert quantization_errors == {'DIST': 0.0, ('SOV_TIME', 'AM'): 0.0, ('SOV_TIME', 'PM'): 0.0}
+
+    skim_dict = skims.skim.SkimDict(skim_data, skim_info)
+    skim_dict.offset_mapper.set_offset_int(-1)
+
+    np.testing.assert_array_equal(skim_dict.get(('SOV_TIME', 'PM')).get([1, 4], [2, 3]), [100, 1400])
+
+    with pytest.raises(RuntimeError) as excinfo:
+        skims.get_skim_info(omx_file_path, ['AM', 'PM'], {'DIST': 'int8'})
+    assert "skim_quantization dtype" in str(excinfo.value)
+
+    inject.reinject_decorated_tables()
+
+
+def test_prune_skims(tmpdir, omx_file_path):
+
+    configs_dir = tmpdir.mkdir('configs')
+    configs_dir.join('spec.csv').write(
+        "Label,Description,Expression,coefficient\n"
+        "util_time,time,@odt_skims['SOV_TIME'],-0.1\n"
+        "util_dist,dist,@od_skims.reverse('DISTWALK'),-0.2\n"
+        "util_ivt,ivt,\"@skim_dict.get(('WLK_TRN_WLK_IVT', 'MD'))\",-0.3\n")
+
+    assert skims.spec_skim_key1s(str(configs_dir)) == {'SOV_TIME', 'DISTWALK', 'WLK_TRN_WLK_IVT'}
+
+    skim_info = skims.get_skim_info(omx_file_path, ['AM', 'PM'], key1s_to_load={'SOV_TIME', 'DISTWALK'})
+
+    assert list(skim_info['omx_keys'].keys()) == [('SOV_TIME', 'AM'), ('SOV_TIME', 'PM')]
+    assert skim_info['blocks'] == {'skim_small_skims_0': 2}
+
+
+def test_parallel_skim_loading(tmpdir, omx_file_path):
+
+    inject.add_injectable('settings', {'num_skim_load_processes': 2, 'skim_cache_dir': str(tmpdir)})
+
+    skim_info = skims.get_skim_info(omx_file_path, ['AM', 'PM'], {'SOV_TIME': {'dtype': 'int16', 'scale': 0.5}})
+
+    serial_buffers = skims.buffers_for_skims(skim_info, shared=False)
+    serial_data = skims.skim_data_from_buffers(serial_buffers, skim_info)
+    serial_errors = skims.read_skims_from_omx(skim_info, serial_data, omx_file_path)
+
+    skim_buffers = skims.buffers_for_skims(skim_info, shared=True)
+    assert skims.shared_skim_buffers(skim_buffers)
+    skim_data = skims.skim_data_from_buffers(skim_buffers, skim_info)
+
+    quantization_errors = skims.read_skims_from_omx_parallel(skim_info, skim_buffers, omx_file_path, 2)
+    assert quantization_errors == serial_errors
+    for block_data, serial_block_data in zip(skim_data, serial_data):
+        np.testing.assert_array_equal(block_data, serial_block_data)
+
+    skims.write_skim_cache_parallel(skim_info, skim_buffers, 2)
+    for block_data, cache_data in zip(skim_data, skims.open_skim_cache(skim_info, mode='r')):
+        np.testing.assert_array_equal(block_data, cache_data)
+
+    cached_buffers = skims.buffers_for_skims(skim_info, shared=True)
+    skims.read_skim_cache_parallel(skim_info, cached_buffers, 2)
+    for block_data, cached_block_data in zip(skim_data, skims.skim_data_from_buffers(cached_buffers, skim_info)):
+        np.testing.assert_array_equal(block_data, cached_block_data)
+
+    inject.reinject_decorated_tables()
+
+
+def test_skim_cache_manifest(tmpdir, omx_file_path):
+
+    inject.add_injectable('settings', {'read_skim_cache': True, 'skim_cache_dir': str(tmpdir)})
+
+    skim_info = skims.get_skim_info(omx_file_path, ['AM', 'PM'])
+    assert not skims.skim_cache_is_valid(skim_info, omx_file_path)
+
+    # missing cache is built from omx
+    skim_buffers = skims.buffers_for_skims(skim_info, shared=False)
+    skims.load_skims(omx_file_path, skim_info, skim_buffers)
+    assert skims.skim_cache_is_valid(skim_info, omx_file_path)
+
+    # cache is stale if skim_info changes (e.g. quantization)
+    quantized_skim_info = skims.get_skim_info(omx_file_path, ['AM', 'PM'], {'DIST': 'float16'})
+    assert not skims.skim_cache_is_valid(quantized_skim_info, omx_file_path)
+
+    # cache is stale if omx file is regenerated
+    with omx.open_file(omx_file_path, 'a') as omx_file:
+        omx_file['DIST'][:] = np.ones((4, 4), dtype=np.float32)
+    os.utime(omx_file_path, ns=(0, 0))
+    assert not skims.skim_cache_is_valid(skim_info, omx_file_path)
+
+    skim_buffers = skims.buffers_for_skims(skim_info, shared=False)
+    skims.load_skims(omx_file_path, skim_info, skim_buffers)
+    assert skims.skim_cache_is_valid(skim_info, omx_file_path)
+
+    skim_data = skims.skim_data_from_buffers(skim_buffers, skim_info)
+    np.testing.assert_array_equal(skim_data[0][:, :, 0], np.ones((4, 4)))
+
+    inject.reinject_decorated_tables()
+
+
+def test_sparse_skims(omx_file_path):
+
+    skim_info = skims.get_skim_info(omx_file_path, ['AM', 'PM'])
+
+    sparse_skim_settings = {'cutoff_skim': 'DIST', 'cutoff': 6, 'default': -1,
+                            'defaults': {'SOV_TIME': 999}, 'rows_per_chunk': 3}
+    skim_dict = skims.load_sparse_skims(omx_file_path, skim_info, sparse_skim_settings)
+    skim_dict.offset_mapper.set_offset_int(-1)
+
+    # DIST values 0..6 are stored (first row and first 3 columns of second row)
+    assert skim_dict.nnz == 7
+    np.testing.assert_array_equal(skim_dict.indptr, [0, 4, 7, 7, 7])
+
+    orig = np.array([1, 2, 2, 4])
+    dest = np.array([4, 3, 4, 3])
+    np.testing.assert_array_equal(skim_dict.get('DIST').get(orig, dest), [3, 6, -1, -1])
+    np.testing.assert_array_equal(skim_dict.get(('SOV_TIME', 'PM')).get(orig, dest), [300, 600, 999, 999])
+
+    # same lookup api as dense SkimDict
+    stack = skims.skim.SkimStack(skim_dict)
+    np.testing.assert_array_equal(stack.lookup(orig, dest, ['AM', 'PM', 'AM', 'PM'], 'SOV_TIME'),
+                                  [30, 600, 999, 999])
+
+
+def test_skims_from_beam(tmpdir):
+
+    from activitysim.abm.models import initialize_skims_from_beam as beam
+
+    # two zones, SOV and walk access transit rows for every period (plus an unused path), in no particular order
+    rows = []
+    for p, period in enumerate(beam.periods):
+        for path in ['SOV', 'WLK_LOC_WLK', 'BIKE']:
+            for o in [10, 20]:
+                for d in [10, 20]:
+                    row = {c: 0.0 for c, t in beam.beam_skims_types.items() if t == float}
+                    row.update(timePeriod=period, pathType=path, origin=o, destination=d, DEBUG_TEXT='')
+                    row['TIME_minutes'] = p + o + d
+                    row['DIST_meters'] = (p + 1) * 1000
+                    row['TOTIVT_IVT_minutes'] = p
+                    row['BOARDS'] = p
+                    rows.append(row)
+    beam_skims_path = str(tmpdir.join('beam_skims.csv'))
+    pd.DataFrame(rows).iloc[::-1].to_csv(beam_skims_path, index=False)
+
+    data_dir = tmpdir.mkdir('data')
+    beam.create_skims_from_beam(str(data_dir), {'beam_skims_url': beam_skims_path, 'beam_skims_chunk_size': 7})
+
+    with omx.open_file(str(data_dir.join('skims.omx'))) as skims_file:
+        np.testing.assert_array_equal(skims_file.mapentries('taz'), [10, 20])
+        np.testing.assert_array_equal(skims_file['SOVTOLL_TIME__MD'], [[22, 32], [32, 42]])
+        np.testing.assert_array_equal(skims_file['SOV_BTOLL__MD'], np.zeros((2, 2)))
+
+        # distance and transit skims from slowest (EV) row
+        np.testing.assert_allclose(skims_file['DIST'], np.full((2, 2), 5 * 0.621371))
+        np.testing.assert_array_equal(skims_file['DRV_HVY_WLK_IVT__AM'], np.full((2, 2), 400))
+        np.testing.assert_array_equal(skims_file['WLK_LOC_WLK_BOARDS__EA'], np.full((2, 2), 4))
@@ -0,0 +1,387 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import os
+import queue
+import shutil
+import logging
+import threading
+
+import pandas as pd
+
+from . import config
+from . import compact
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+"""
+Pipeline checkpoint stores
+
+The pipeline writes a version of every table for every checkpoint in which it changes (and the
+checkpoints table) to a store, by key ('<table_name>/<checkpoint_name>' or 'checkpoints').
+The pipeline_store_type setting selects the store implementation:
+
+    hdf5        (default) one pandas.HDFStore file (pipeline_file_name, e.g. pipeline.h5)
+    parquet     a directory (pipeline_file_name without its extension, e.g. pipeline) with
+                one subdirectory per checkpoint and one compressed parquet file per table
+                (and checkpoints.parquet), so tables can be read column by column and
+                checkpoints can be inspected, copied or removed with the usual file tools
+
+Both have the same interface (read, write, __getitem__, __setitem__, __contains__, flush, close
+and context manager), so the pipeline and the multiprocessing apportion and coalesce steps work
+against either one.
+
+If the background_checkpoint_writer setting is enabled, the pipeline wraps its store in a
+BackgroundWriterStore, which writes tables on a background thread so checkpoint writes overlap
+with the next model step.
+"""
+
+HDF5 = 'hdf5'
+PARQUET = 'parquet'
+
+PARQUET_EXTENSION = '.parquet'
+PARQUET_COMPRESSION = 'snappy'
+
+
+def store_type():
+    """
+    pipeline store type from the pipeline_store_type setting (hdf5 or parquet)
+    """
+
+    type_name = config.setting('pipeline_store_type', HDF5)
+
+    if type_name not in STORE_TYPES:
+        raise RuntimeError("Unknown pipeline_store_type '%s' (expected one of %s)" %
+                           (type_name, list(STORE_TYPES.keys())))
+
+    return type_name
+
+
+def store_path(file_path, type_name=None):
+    """
+    path of the store for pipeline file_path (a directory without the file extension for parquet)
+    """
+
+    if (type_name or store_type()) == PARQUET:
+        return os.path.splitext(file_path)[0]
+
+    return file_path
+
+
+class HdfStore(object):
+    """
+    Pipeline store backed by a pandas.HDFStore file
+
+    Parameters
+    ----------
+    path : str
+        hdf5 file path
+    mode : str
+        'r' to read an existing store or 'a' to read and write (creating the file if necessary)
+    """
+
+    def __init__(self, path, mode='a'):
+
+        self.path = path
+        self.store = pd.HDFStore(path, mode=mode)
+
+    def read(self, key, columns=None):
+        """
+        Read a dataframe from the store (HDFStore raises KeyError if not found)
+
+        Parameters
+        ----------
+        key : str
+        columns : list of str, optional
+            read only these columns (fixed format tables are read whole and then projected,
+            except that only the index is read if columns is empty)
+        """
+
+        if columns is not None and len(columns) == 0:
+            # only read the index of fixed format tables
+            storer = self.store.get_storer(key)
+            if isinstance(storer, pd.io.pytables.FrameFixed):
+                return pd.DataFrame(index=storer.read_index('axis1'))
+
+        df = self.store[key]
+
+        if columns is not None:
+            df = df[columns]
+
+        return df
+
+    def write(self, key, df):
+
+        # fixed format can't store categoricals
+        self.store[key] = compact.decategorize(df)
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def __setitem__(self, key, df):
+        self.write(key, df)
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ParquetStore(object):
+    """
+    Pipeline store backed by a directory of parquet files (requires pyarrow)
+
+    '<table_name>/<checkpoint_name>' tables are written to <path>/<checkpoint_name>/<table_name>.parquet
+    and tables without a checkpoint (e.g. checkpoints) to <path>/<table_name>.parquet
+
+    Parameters
+    ----------
+    path : str
+        store directory path
+    mode : str
+        'r' to read an existing store or 'a' to read and write (creating the directory if necessary)
+    """
+
+    def __init__(self, path, mode='a'):
+
+        if pyarrow is None:
+            raise RuntimeError("parquet pipeline store requires pyarrow")
+
+        assert mode in ['r', 'a']
+
+        if mode == 'r' and not os.path.isdir(path):
+            raise RuntimeError("parquet pipeline store %s not found" % path)
+
+        if mode == 'a':
+            os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.mode = mode
+
+    def file_path(self, key):
+
+        if '/' in key:
+            table_name, checkpoint_name = key.split('/', 1)
+            return os.path.join(self.path, checkpoint_name, table_name + PARQUET_EXTENSION)
+
+        return os.path.join(self.path, key + PARQUET_EXTENSION)
+
+    def read(self, key, columns=None):
+        """
+        Read a dataframe from the store (raises KeyError if not found)
+
+        Parameters
+        ----------
+        key : str
+        columns : list of str, optional
+            only read these columns from the parquet file
+        """
+
+        file_path = self.file_path(key)
+
+        if not os.path.isfile(file_path):
+            raise KeyError("No object named %s in the pipeline store %s" % (key, self.path))
+
+        return pd.read_parquet(file_path, engine='pyarrow', columns=columns)
+
+    def write(self, key, df):
+
+        assert self.mode != 'r'
+
+        file_path = self.file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        # write to temp file and rename, so readers never see a partially written table
+        temp_path = file_path + '.tmp'
+        df.to_parquet(temp_path, engine='pyarrow', compression=PARQUET_COMPRESSION)
+        os.replace(temp_path, file_path)
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def __setitem__(self, key, df):
+        self.write(key, df)
+
+    def __contains__(self, key):
+        return os.path.isfile(self.file_path(key))
+
+    def flush(self):
+        # (every table is written to its own file)
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BackgroundWriterStore(object):
+    """
+    Wraps a pipeline store to write tables on a background writer thread
+
+    write and flush queue a snapshot (deep copy) of the table and return immediately, so the
+    store writes (mostly serialization, compression and disk io) overlap with the next model step.
+    The queue is bounded by queue_size tables, so write blocks if the writer falls that far behind.
+
+    read, __contains__ (for keys not written through this store) and close wait for all queued
+    writes to complete, and any error raised by a background write is raised by the next call.
+
+    Parameters
+    ----------
+    store : HdfStore or ParquetStore
+        open store (only accessed by the writer thread while there are queued writes)
+    queue_size : int
+        maximum number of queued table writes
+    """
+
+    def __init__(self, store, queue_size=4):
+
+        assert queue_size > 0
+
+        self.store = store
+        self.path = store.path
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written_keys = set()
+        self.error = None
+
+        self.thread = threading.Thread(target=self.write_queued, name='checkpoint_writer', daemon=True)
+        self.thread.start()
+
+    def write_queued(self):
+
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                key, df = item
+                if self.error is None:
+                    if key is None:
+                        self.store.flush()
+                    else:
+                        self.store.write(key, df)
+            except Exception as e:
+                logger.exception("background checkpoint writer error writing %s" % (key,))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+
+        if self.error is not None:
+            raise RuntimeError("background checkpoint write to %s failed: %s" % (self.path, self.error))
+
+    def wait(self):
+        """
+        Wait for all queued writes to complete
+        """
+
+        self.queue.join()
+        self.check_error()
+
+    def read(self, key, columns=None):
+
+        self.wait()
+        return self.store.read(key, columns=columns)
+
+    def write(self, key, df):
+
+        self.check_error()
+        self.written_keys.add(key)
+        self.queue.put((key, df.copy()))
+
+    def __getitem__(self, key):
+        return self.read(key)
+
+    def __setitem__(self, key, df):
+        self.write(key, df)
+
+    def __contains__(self, key):
+
+        if key in self.written_keys:
+            return True
+
+        self.wait()
+        return key in self.store
+
+    def flush(self):
+
+        self.check_error()
+        self.queue.put((None, None))
+
+    def close(self):
+
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        self.store.close()
+        self.check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+STORE_TYPES = {
+    HDF5: HdfStore,
+    PARQUET: ParquetStore,
+}
+
+
+def open_store(file_path, mode='a', type_name=None):
+    """
+    Open the pipeline store for pipeline file_path
+
+    Parameters
+    ----------
+    file_path : str
+        pipeline file path (see store_path)
+    mode : str
+        'r' or 'a'
+    type_name : str, optional
+        hdf5 or parquet (default from the pipeline_store_type setting)
+
+    Returns
+    -------
+    store : HdfStore or ParquetStore
+    """
+
+    type_name = type_name or store_type()
+
+    return STORE_TYPES[type_name](store_path(file_path, type_name), mode=mode)
+
+
+def remove_store(file_path, type_name=None):
+    """
+    Remove the pipeline store for pipeline file_path (if it exists)
+    """
+
+    path = store_path(file_path, type_name)
+
+    if os.path.isdir(path):
+        logger.debug("removing pipeline store: %s" % path)
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        logger.debug("removing pipeline store: %s" % path)
+        os.unlink(path)
@@ -2,6 +2,7 @@
 # See full license in LICENSE.txt.
 from builtins import input
 
+import os
 import logging
 from collections import OrderedDict
 
@@ -10,6 +11,8 @@ import pandas as pd
 
 from . import util
 from . import mem
+from . import config
+from . import inject
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +26,21 @@ EFFECTIVE_CHUNK_SIZE = []
 
 HWM = [{}]
 
+# rss when each active CHUNK_LOG was opened
+OPEN_MEM = []
+
+# high water marks of the most recently closed base chunker (for adaptive chunking)
+LAST_CHUNK = {}
+
+# adaptive chunking row_size (chunk_size elements per chooser row) measured by trace_label
+ROW_SIZES = {}
+CALIBRATION = {}
+
+# bytes per chunk_size element (to convert measured bytes and rss growth to elements)
+BYTES_PER_ELEMENT = 8
+
+CALIBRATION_FILE_NAME = 'chunk_calibration.csv'
+
 
 def GB(bytes):
     # symbols = ('', 'K', 'M', 'G', 'T')
@@ -58,6 +76,7 @@ def log_open(trace_label, chunk_size, effective_chunk_size):
     CHUNK_LOG[trace_label] = OrderedDict()
     CHUNK_SIZE.append(chunk_size)
     EFFECTIVE_CHUNK_SIZE.append(effective_chunk_size)
+    OPEN_MEM.append(mem.get_memory_info())
 
     HWM.append({})
 
@@ -72,10 +91,22 @@ def log_close(trace_label):
     if len(CHUNK_LOG) == 1:
         log_write_hwm()
 
+        # (for adaptive chunking)
+        hwm = HWM[-1]
+        LAST_CHUNK.clear()
+        LAST_CHUNK.update({
+            'trace_label': trace_label,
+            'chunk_size': CHUNK_SIZE[-1],
+            'elements': hwm.get('elements', {}).get('mark', 0),
+            'bytes': hwm.get('bytes', {}).get('mark', 0),
+            'rss_growth': max(hwm.get('mem', {}).get('mark', 0) - OPEN_MEM[-1], 0),
+        })
+
     label, _ = CHUNK_LOG.popitem(last=True)
     assert label == trace_label
     CHUNK_SIZE.pop()
     EFFECTIVE_CHUNK_SIZE.pop()
+    OPEN_MEM.pop()
 
     HWM.pop()
 
@@ -106,6 +137,9 @@ def log_df(trace_label, table_name, df):
             bytes = df.memory_usage(index=True).sum()
         elif isinstance(df, np.ndarray):
             bytes = df.nbytes
+        elif hasattr(df, 'memory_usage'):
+            # e.g. logit.InteractionDataset (only its materialized columns)
+            bytes = df.memory_usage(index=True).sum()
         else:
             logger.error("log_df %s unknown type: %s" % (table_name, type(df)))
             assert False
@@ -187,8 +221,122 @@ def log_write_hwm():
         check_chunk_size(hwm, CHUNK_SIZE[0], 'chunk_size', max_leeway=1)
 
 
+def adaptive_chunking():
+    """
+    True if the adaptive_chunking setting is True
+
+    Adaptive chunking measures the high water marks of each chunk (of the log_df elements and
+    bytes, and of the rss growth after the first chunk, converted to elements) and sizes the next
+    chunks so that they would just fit in chunk_size elements. The median measured row_size
+    (elements per chooser row) of the chunks of each trace_label is saved in the chunk calibration
+    file in the output directory, and used instead of the estimated row_size of the caller for the
+    first chunk of later runs (which then replace it with their own measurements).
+    """
+
+    return config.setting('adaptive_chunking', False)
+
+
+def calibration_file_path():
+
+    file_name = config.setting('chunk_calibration_file', CALIBRATION_FILE_NAME)
+    return config.build_output_file_path(file_name, use_prefix=inject.get_injectable('log_file_prefix', None))
+
+
+def read_calibration():
+    """
+    Add the row_sizes of the chunk calibration file (of earlier runs) to ROW_SIZES
+    (unless already measured in this run)
+    """
+
+    file_path = calibration_file_path()
+    if os.path.isfile(file_path):
+        row_sizes = pd.read_csv(file_path, index_col='trace_label')['row_size']
+        for trace_label, row_size in row_sizes.items():
+            ROW_SIZES.setdefault(trace_label, row_size)
+    CALIBRATION['read'] = True
+
+
+def write_calibration():
+
+    row_sizes = pd.Series(ROW_SIZES, name='row_size', dtype=np.float64)
+    row_sizes.index.name = 'trace_label'
+    row_sizes.to_csv(calibration_file_path())
+
+
+def calibrated_row_size(row_size, trace_label):
+    """
+    measured row_size for trace_label (in this or an earlier run) if adaptive chunking
+    otherwise the caller's estimated row_size
+    """
+
+    if not adaptive_chunking():
+        return row_size
+
+    if not CALIBRATION.get('read'):
+        read_calibration()
+
+    calibrated = ROW_SIZES.get(trace_label)
+    if calibrated:
+        logger.debug("#chunk_calc calibrated row_size: %s estimated row_size: %s : %s" %
+                     (calibrated, row_size, trace_label))
+        return calibrated
+
+    return row_size
+
+
+def next_rows_per_chunk(rows_per_chunk, chunk_rows, row_sizes, trace_label):
+    """
+    rows_per_chunk for the next chunk, based on the high water marks of the chunk just processed
+
+    Parameters
+    ----------
+    rows_per_chunk : int
+        rows_per_chunk of the current chunk
+    chunk_rows : int
+        number of chooser rows of the chunk just processed
+    row_sizes : list
+        measured row_sizes of the previous chunks (updated in place)
+    trace_label : str
+        trace_label of the (rows_per_chunk) chunk calculation or None if not adaptive
+
+    Returns
+    -------
+    rows_per_chunk : int
+    """
+
+    if not (trace_label and LAST_CHUNK and LAST_CHUNK['chunk_size'] and adaptive_chunking()):
+        return rows_per_chunk
+
+    elements = max(LAST_CHUNK['elements'], LAST_CHUNK['bytes'] / BYTES_PER_ELEMENT)
+
+    # rss growth of the first chunk includes one-off costs (e.g. loading skims or compiling specs)
+    # that don't scale with the number of chunk rows
+    if row_sizes:
+        elements = max(elements, LAST_CHUNK['rss_growth'] / BYTES_PER_ELEMENT)
+
+    if elements == 0:
+        return rows_per_chunk
+
+    # (median row_size measured so far, so a single outlier chunk doesn't oscillate or blow chunk_size)
+    row_sizes.append(elements / float(chunk_rows))
+    row_size = float(np.median(row_sizes))
+    ROW_SIZES[trace_label] = row_size
+
+    next_rpc = max(int(LAST_CHUNK['chunk_size'] / row_size), 1)
+
+    logger.debug("#chunk_calc adaptive rows_per_chunk: %s (was %s) measured row_size: %s "
+                 "(elements: %s bytes: %s rss_growth: %s rows: %s) : %s" %
+                 (next_rpc, rows_per_chunk, row_size,
+                  commas(LAST_CHUNK['elements']), GB(LAST_CHUNK['bytes']), GB(LAST_CHUNK['rss_growth']),
+                  chunk_rows, trace_label))
+
+    return next_rpc
+
+
 def rows_per_chunk(chunk_size, row_size, num_choosers, trace_label):
 
+    row_size = calibrated_row_size(row_size, trace_label)
+
     if chunk_size > 0:
         # closest number of chooser rows to achieve chunk_size without exceeding
         max_rpc = int(chunk_size / float(row_size))
@@ -208,22 +356,40 @@ def rows_per_chunk(chunk_size, row_size, num_choosers, trace_label):
     return rpc, effective_chunk_size
 
 
-def chunked_choosers(choosers, rows_per_chunk):
+def num_chunks_for(num_choosers, rows_per_chunk):
+
+    return (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
+
+
+def chunked_choosers(choosers, rows_per_chunk, trace_label=None):
+    """
+    generator to iterate over choosers in chunk_size chunks
+
+    If trace_label (of the rows_per_chunk calculation) is specified and adaptive chunking is
+    enabled, rows_per_chunk is adjusted after every chunk (see next_rows_per_chunk), so num_chunks
+    is just the number of chunks expected so far.
+    """
 
     assert choosers.shape[0] > 0
 
-    # generator to iterate over choosers in chunk_size chunks
     num_choosers = len(choosers.index)
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
+    row_sizes = []
 
     i = offset = 0
     while offset < num_choosers:
+        num_chunks = i + num_chunks_for(num_choosers - offset, rows_per_chunk)
+        LAST_CHUNK.clear()
         yield i+1, num_chunks, choosers.iloc[offset: offset+rows_per_chunk]
+        chunk_rows = min(rows_per_chunk, num_choosers - offset)
         offset += rows_per_chunk
         i += 1
+        rows_per_chunk = next_rows_per_chunk(rows_per_chunk, chunk_rows, row_sizes, trace_label)
 
+    if row_sizes:
+        write_calibration()
 
-def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
+
+def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk, trace_label=None):
     """
     generator to iterate over choosers and alternatives in chunk_size chunks
 
@@ -244,6 +410,8 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
     alternatives : pandas DataFrame
         sample alternatives including pick_count column in same order as choosers
     rows_per_chunk : int
+    trace_label : str, optional
+        trace_label of the rows_per_chunk calculation (for adaptive chunking)
 
     Yields
     -------
@@ -271,37 +439,40 @@ def chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
     assert 'pick_count' in alternatives.columns or choosers.index.name == alternatives.index.name
 
     num_choosers = len(choosers.index)
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
 
     assert choosers.index.name == alternatives.index.name
 
     # alt chunks boundaries are where index changes
+    # (offset of the first alternative of each chooser, and of the end of alternatives)
     alt_ids = alternatives.index.values
-    alt_chunk_end = np.where(alt_ids[:-1] != alt_ids[1:])[0] + 1
-    alt_chunk_end = np.append([0], alt_chunk_end)  # including the first...
-    alt_chunk_end = alt_chunk_end[rows_per_chunk::rows_per_chunk]
+    alt_chunk_start = np.where(alt_ids[:-1] != alt_ids[1:])[0] + 1
+    alt_chunk_start = np.concatenate([[0], alt_chunk_start, [len(alternatives.index)]])
 
-    # add index to end of array to capture any final partial chunk
-    alt_chunk_end = np.append(alt_chunk_end, [len(alternatives.index)])
+    row_sizes = []
 
-    i = offset = alt_offset = 0
+    i = offset = 0
     while offset < num_choosers:
 
-        alt_end = alt_chunk_end[i]
+        num_chunks = i + num_chunks_for(num_choosers - offset, rows_per_chunk)
+        end = min(offset + rows_per_chunk, num_choosers)
 
-        chooser_chunk = choosers[offset: offset + rows_per_chunk]
-        alternative_chunk = alternatives[alt_offset: alt_end]
+        chooser_chunk = choosers[offset: end]
+        alternative_chunk = alternatives[alt_chunk_start[offset]: alt_chunk_start[end]]
 
         assert len(chooser_chunk.index) == len(np.unique(alternative_chunk.index.values))
 
+        LAST_CHUNK.clear()
         yield i+1, num_chunks, chooser_chunk, alternative_chunk
 
         i += 1
-        offset += rows_per_chunk
-        alt_offset = alt_end
+        offset = end
+        rows_per_chunk = next_rows_per_chunk(rows_per_chunk, len(chooser_chunk.index), row_sizes, trace_label)
+
+    if row_sizes:
+        write_calibration()
 
 
-def chunked_choosers_by_chunk_id(choosers, rows_per_chunk):
+def chunked_choosers_by_chunk_id(choosers, rows_per_chunk, trace_label=None):
     # generator to iterate over choosers in chunk_size chunks
     # like chunked_choosers but based on chunk_id field rather than dataframe length
     # (the presumption is that choosers has multiple rows with the same chunk_id that
@@ -311,11 +482,18 @@ def chunked_choosers_by_chunk_id(choosers, rows_per_chunk):
     assert choosers.shape[0] > 0
 
     num_choosers = choosers['chunk_id'].max() + 1
-    num_chunks = (num_choosers // rows_per_chunk) + (num_choosers % rows_per_chunk > 0)
+    row_sizes = []
 
     i = offset = 0
     while offset < num_choosers:
+        num_chunks = i + num_chunks_for(num_choosers - offset, rows_per_chunk)
         chooser_chunk = choosers[choosers['chunk_id'].between(offset, offset + rows_per_chunk - 1)]
+        LAST_CHUNK.clear()
         yield i+1, num_chunks, chooser_chunk
+        chunk_rows = min(rows_per_chunk, num_choosers - offset)
         offset += rows_per_chunk
         i += 1
+        rows_per_chunk = next_rows_per_chunk(rows_per_chunk, chunk_rows, row_sizes, trace_label)
+
+    if row_sizes:
+        write_calibration()
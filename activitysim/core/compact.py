@@ -0,0 +1,238 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from . import config
+from . import util
+
+logger = logging.getLogger(__name__)
+
+"""
+Pipeline table dtype compaction
+
+If the compact_tables setting is enabled, the tables added or replaced in the pipeline (and the
+input tables) are compacted:
+
+    integer columns are downcast to the smallest signed integer dtype that holds their values,
+    but not smaller than compact_min_int_dtype (int32 by default, since spec expressions like
+    products or squares of smaller integer columns might overflow)
+
+    float64 columns are downcast to float32 if compact_floats is enabled and the values of the
+    column are all exactly representable in single precision
+
+    string columns listed (by table) in compact_categories are encoded as pandas categoricals with
+    the listed categories (followed by any unlisted values, sorted), so the category sets are stable
+    across steps, chunks and processes
+
+Only listed string columns are encoded, since model code that assigns new values to a categorical
+column (e.g. with where), or loops over the groups of a groupby of one (which include empty groups
+for unobserved categories, unless observed=True) has to allow for it.
+
+The memory used by each table before and after its last compaction is logged and written to
+compact_memory_report.csv when the pipeline is closed.
+"""
+
+INT_DTYPES = ['int8', 'int16', 'int32', 'int64']
+
+MEMORY_REPORT_FILE_NAME = 'compact_memory_report.csv'
+
+# dict of memory report dicts keyed by table_name
+MEMORY_REPORT = OrderedDict()
+
+
+def compact_tables():
+    """
+    Return True if compact_tables setting enabled
+    """
+
+    return config.setting('compact_tables', False)
+
+
+def compact_int(s, min_dtype='int32'):
+    """
+    Downcast signed integer series s to the smallest integer dtype (at least min_dtype) holding its values
+    """
+
+    if len(s) == 0 or not isinstance(s.dtype, np.dtype) or not pd.api.types.is_signed_integer_dtype(s.dtype):
+        return s
+
+    lo, hi = s.min(), s.max()
+    for dtype in INT_DTYPES[INT_DTYPES.index(min_dtype):]:
+        if np.dtype(dtype).itemsize >= s.dtype.itemsize:
+            break
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return s.astype(dtype)
+
+    return s
+
+
+def compact_float(s):
+    """
+    Downcast float64 series s to float32 if all its values are exactly representable in float32
+    """
+
+    if s.dtype != np.float64:
+        return s
+
+    f = s.astype(np.float32)
+    if np.array_equal(f.values.astype(np.float64), s.values, equal_nan=True):
+        return f
+
+    return s
+
+
+def compact_strings(s, categories=None):
+    """
+    Encode object series s of strings as a categorical
+
+    Parameters
+    ----------
+    s : pandas.Series
+    categories : list of str, optional
+        stable category list (values of s not in the list are added, sorted, after them)
+        s is returned as is if no categories are listed
+
+    Returns
+    -------
+    s : pandas.Series
+        categorical series, or s itself if not encoded
+    """
+
+    if categories is None:
+        return s
+
+    categorical = pd.api.types.is_categorical_dtype(s.dtype)
+
+    if categorical:
+        # concatenated or extended columns may have lost their sorted or listed category order
+        values = s.cat.categories
+    elif s.dtype == object:
+        values = s.dropna().unique()
+    else:
+        return s
+
+    if not all(isinstance(v, str) for v in values):
+        return s
+
+    listed = set(categories)
+    categories = list(categories) + sorted(v for v in values if v not in listed)
+
+    if categorical and list(s.cat.categories) == categories:
+        return s
+
+    return s.astype(pd.CategoricalDtype(categories=categories))
+
+
+def compact_df(df, table_name, trace_label=None):
+    """
+    Compact the column dtypes of df (if compact_tables setting is enabled)
+
+    Columns are replaced in place, so df (and any orca table wrapping it) is compacted,
+    and the memory used by the table before and after compaction is added to the memory report.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    table_name : str
+        name of the table (for compact_categories and the memory report)
+    trace_label : str, optional
+        what the table was compacted for (e.g. replace_table)
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        the compacted df
+    """
+
+    if not compact_tables():
+        return df
+
+    min_int_dtype = config.setting('compact_min_int_dtype', 'int32')
+    assert min_int_dtype in INT_DTYPES, "unknown compact_min_int_dtype %s" % min_int_dtype
+    floats = config.setting('compact_floats', False)
+    table_categories = (config.setting('compact_categories', None) or {}).get(table_name, {})
+
+    bytes_before = df.memory_usage(index=True, deep=True).sum()
+
+    compacted_columns = []
+    for c in df.columns:
+        s = df[c]
+        if pd.api.types.is_integer_dtype(s.dtype):
+            compacted = compact_int(s, min_int_dtype)
+        elif floats and pd.api.types.is_float_dtype(s.dtype):
+            compacted = compact_float(s)
+        else:
+            compacted = compact_strings(s, table_categories.get(c))
+
+        if compacted is not s:
+            with pd.option_context('mode.chained_assignment', None):
+                df[c] = compacted
+            compacted_columns.append(c)
+
+    bytes_after = df.memory_usage(index=True, deep=True).sum() if compacted_columns else bytes_before
+
+    MEMORY_REPORT[table_name] = {
+        'table_name': table_name,
+        'trace_label': trace_label,
+        'rows': len(df),
+        'columns': len(df.columns),
+        'compacted_columns': len(compacted_columns),
+        'bytes_before': bytes_before,
+        'bytes_after': bytes_after,
+    }
+
+    if compacted_columns:
+        logger.info("compact %s table %s %s columns: %s -> %s" %
+                    (trace_label, table_name, len(compacted_columns),
+                     util.GB(bytes_before), util.GB(bytes_after)))
+
+    return df
+
+
+def add_categories(s, values):
+    """
+    Return s with values added to its categories if s is categorical (so they can be assigned to it,
+    e.g. with where), or s itself if s is not categorical or values are all among its categories
+    """
+
+    if not pd.api.types.is_categorical_dtype(s.dtype):
+        return s
+
+    new_categories = [v for v in values if v not in s.cat.categories]
+
+    return s.cat.add_categories(new_categories) if new_categories else s
+
+
+def decategorize(df):
+    """
+    Return df with categorical columns converted back to their values
+    (for stores that can't store categoricals, like fixed format HDF5)
+    """
+
+    categorical_columns = [c for c in df.columns if pd.api.types.is_categorical_dtype(df[c].dtype)]
+
+    if categorical_columns:
+        df = df.astype({c: object for c in categorical_columns})
+
+    return df
+
+
+def write_memory_report():
+    """
+    Write memory report (bytes used by each compacted table before and after its last compaction)
+    """
+
+    if not MEMORY_REPORT:
+        return
+
+    report = pd.DataFrame(list(MEMORY_REPORT.values())).set_index('table_name')
+
+    logger.info("compact memory report\n%s" % report)
+
+    report.to_csv(config.log_file_path(MEMORY_REPORT_FILE_NAME))
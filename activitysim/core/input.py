@@ -10,6 +10,7 @@ import pandas as pd
 from activitysim.core import (
     inject,
     config,
+    compact,
     util
 )
 
@@ -129,6 +130,8 @@ def read_from_table_info(table_info):
         logger.info("keeping columns: %s" % keep_columns)
         df = df[keep_columns]
 
+    df = compact.compact_df(df, tablename, trace_label='read_input_table')
+
     logger.debug('%s table columns: %s' % (tablename, df.columns.values))
     logger.debug('%s table size: %s' % (tablename, util.df_size(df)))
     logger.info('%s index name: %s' % (tablename, df.index.name))
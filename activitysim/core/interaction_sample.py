@@ -13,10 +13,12 @@ from activitysim.core.mem import force_garbage_collect
 from . import logit
 from . import tracing
 from . import chunk
+from . import config
 from .simulate import set_skim_wrapper_targets
 
 
 from .interaction_simulate import eval_interaction_utilities
+from .interaction_simulate import factor_interaction_spec
 from . import pipeline
 
 logger = logging.getLogger(__name__)
@@ -24,6 +26,49 @@ logger = logging.getLogger(__name__)
 DUMP = False
 
 
+def sample_positions(cum_probs_arr, rands):
+    """
+    Position of the first cumulative probability greater than each rand (for every chooser at once)
+
+    This is the same as np.argmax(cum_probs_arr[i] > rands[i, j]) for each chooser i and sample j
+    (including returning zero if the rand is not less than the last cumulative probability),
+    but uses a vectorized binary search over the (nondecreasing) cumulative probabilities of all
+    samples of all choosers, rather than a linear scan over all alternatives for every sample.
+
+    Parameters
+    ----------
+    cum_probs_arr : 2-D numpy.ndarray
+        cumulative probabilities with one row per chooser and one column per alternative
+    rands : 2-D numpy.ndarray
+        random numbers with one row per chooser and one column per sample
+
+    Returns
+    -------
+    positions : 2-D numpy.ndarray of int
+        column indexes in cum_probs_arr, same shape as rands
+    """
+
+    num_choosers, alternative_count = cum_probs_arr.shape
+    assert rands.shape[0] == num_choosers
+
+    rows = np.arange(num_choosers)[:, np.newaxis]
+
+    # binary search for the number of cum_probs not greater than r (comparing exactly like argmax)
+    lo = np.zeros(rands.shape, dtype=np.int64)
+    hi = np.full(rands.shape, alternative_count, dtype=np.int64)
+    for _ in range(int(alternative_count).bit_length()):
+        mid = (lo + hi) // 2
+        greater = cum_probs_arr[rows, np.minimum(mid, alternative_count - 1)] > rands
+        active = lo < hi
+        hi = np.where(active & greater, mid, hi)
+        lo = np.where(active & ~greater, mid + 1, lo)
+
+    # argmax of all False is zero
+    lo[lo == alternative_count] = 0
+
+    return lo
+
+
 def make_sample_choices(
         choosers, probs,
         alternatives,
@@ -67,57 +112,24 @@ def make_sample_choices(
 
     cum_probs_arr = probs.values.cumsum(axis=1)
 
-    # alt probs in convenient layout to return prob of chose alternative
-    # (same layout as cum_probs_arr)
-    alt_probs_array = probs.values.flatten()
-
     # get sample_size rands for each chooser
-    # transform as we iterate over alternatives
-    # reshape so rands[i] is in broadcastable (2-D) shape for cum_probs_arr
-    # i.e rands[i] is a 2-D array of one alt choice rand for each chooser
     rands = pipeline.get_rn_generator().random_for_df(probs, n=sample_size)
-    rands = rands.T.reshape(sample_size, -1, 1)
+
+    # positions has one row per chooser and one column per sample, with the chosen alternatives
+    # represented as column indexes in probs (integers between zero and alternative_count)
+    positions = sample_positions(cum_probs_arr, rands)
 
     # the alternative value chosen
-    choices_array = np.empty([sample_size, len(choosers)]).astype(int)
+    choices_array = alternatives.index.values.take(positions).astype(int)
 
     # the probability of the chosen alternative
-    choice_probs_array = np.empty([sample_size, len(choosers)])
-
-    alts = np.tile(alternatives.index.values, len(choosers))
-
-    # FIXME - do this all at once rather than iterate?
-    for i in range(sample_size):
-
-        # FIXME - do this in numpy, not pandas?
-
-        # rands for this alt in broadcastable shape
-        r = rands[i]
-
-        # position of first occurrence of positive value
-        positions = np.argmax(cum_probs_arr > r, axis=1)
-
-        # FIXME - leave positions as numpy array, not pandas series?
-        # positions is series with the chosen alternative represented as a column index in probs
-        # which is an integer between zero and num alternatives in the alternative sample
-        positions = pd.Series(positions, index=probs.index)
-
-        # need to get from an integer offset into the alternative sample to the alternative index
-        # that is, we want the index value of the row that is offset by <position> rows into the
-        # tranche of this choosers alternatives created by cross join of alternatives and choosers
-
-        # offsets is the offset into model_design df of first row of chooser alternatives
-        offsets = np.arange(len(positions)) * alternative_count
-
-        # choices and choice_probs have one element per chooser and is in same order as choosers
-        choices_array[i] = np.take(alts, positions + offsets)
-        choice_probs_array[i] = np.take(alt_probs_array, positions + offsets)
+    choice_probs_array = np.take_along_axis(probs.values, positions, axis=1)
 
     # explode to one row per chooser.index, alt_TAZ
     choices_df = pd.DataFrame(
-        {alt_col_name: choices_array.flatten(order='F'),
-         'rand': rands.flatten(order='F'),
-         'prob': choice_probs_array.flatten(order='F'),
+        {alt_col_name: choices_array.flatten(),
+         'rand': rands.flatten(),
+         'prob': choice_probs_array.flatten(),
          choosers.index.name: np.repeat(np.asanyarray(choosers.index), sample_size)
          })
 
@@ -205,8 +217,16 @@ def _interaction_sample(
     # for every chooser, there will be a row for each alternative
     # index values (non-unique) are from alternatives df
     alternative_count = alternatives.shape[0]
+    if config.setting('factor_interaction_utilities', True) and not have_trace_targets:
+        separable_terms, interaction_choosers, interaction_alternatives = \
+            factor_interaction_spec(spec, choosers, alternatives, alternative_count, skims, locals_d,
+                                    trace_label)
+    else:
+        separable_terms, interaction_choosers, interaction_alternatives = None, choosers, alternatives
     interaction_df = \
-        logit.interaction_dataset(choosers, alternatives, sample_size=alternative_count)
+        logit.interaction_dataset(interaction_choosers, interaction_alternatives,
+                                  sample_size=alternative_count,
+                                  lazy=config.setting('lazy_interaction_dataset', True))
 
     chunk.log_df(trace_label, 'interaction_df', interaction_df)
 
@@ -232,7 +252,10 @@ def _interaction_sample(
 
     # interaction_utilities is a df with one utility column and one row per interaction_df row
     interaction_utilities, trace_eval_results \
-        = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows)
+        = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows,
+                                     separable_terms=separable_terms)
+    # log again, since lazy interaction_df columns are only materialized when utilities are evaluated
+    chunk.log_df(trace_label, 'interaction_df', interaction_df)
     chunk.log_df(trace_label, 'interaction_utilities', interaction_utilities)
 
     del interaction_df
@@ -453,7 +476,7 @@ def interaction_sample(
         calc_rows_per_chunk(chunk_size, choosers, alternatives, trace_label)
 
     result_list = []
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label=trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
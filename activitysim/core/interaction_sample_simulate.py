@@ -371,7 +371,7 @@ def interaction_sample_simulate(
 
     result_list = []
     for i, num_chunks, chooser_chunk, alternative_chunk \
-            in chunk.chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk):
+            in chunk.chunked_choosers_and_alts(choosers, alternatives, rows_per_chunk, trace_label=trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
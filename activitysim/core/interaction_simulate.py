@@ -2,6 +2,8 @@
 # See full license in LICENSE.txt.
 from builtins import zip
 
+from functools import partial
+
 import logging
 
 import numpy as np
@@ -15,6 +17,8 @@ from .simulate import set_skim_wrapper_targets
 from . import chunk
 
 from . import simulate
+from . import spec_compiler
+from .skim import SkimDictWrapper, SkimStackWrapper
 
 from activitysim.core.mem import force_garbage_collect
 
@@ -24,7 +28,8 @@ logger = logging.getLogger(__name__)
 DUMP = False
 
 
-def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, estimator=None):
+def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, estimator=None,
+                               separable_terms=None):
     """
     Compute the utilities for a single-alternative spec evaluated in the context of df
 
@@ -57,6 +62,10 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
         yielding a dataframe  with len(interaction_df) rows and one utility column
         having the same index as interaction_df (non-unique values from alternatives df)
 
+    separable_terms : dict, optional
+        values of chooser-only and alternative-only expressions (from eval_separable_terms) by
+        spec row position - these are broadcast instead of being evaluated against df
+
     Returns
     -------
     utilities : pandas.DataFrame
@@ -90,7 +99,8 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
     # need to be able to identify which variables causes an error, which keeps
     # this from being expressed more parsimoniously
 
-    utilities = pd.DataFrame({'utility': 0.0}, index=df.index)
+    dtype = simulate.utility_dtype()
+    utilities = pd.DataFrame({'utility': np.zeros(len(df.index), dtype=dtype)}, index=df.index)
     no_variability = has_missing_vals = 0
 
     if estimator:
@@ -118,7 +128,11 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
         exprs = spec.index
         labels = spec.index
 
-    for expr, label, coefficient in zip(exprs, labels, spec.iloc[:, 0]):
+    separable_terms = separable_terms or {}
+    assert not (separable_terms and (estimator or trace_eval_results is not None)), \
+        "separable terms are not broadcast for estimation or tracing"
+
+    for i, (expr, label, coefficient) in enumerate(zip(exprs, labels, spec.iloc[:, 0])):
         try:
 
             # - allow temps of form _od_DIST@od_skim['DIST']
@@ -137,7 +151,10 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
                 # mem.trace_memory_info("eval_interaction_utilities TEMP: %s" % expr)
                 continue
 
-            if expr.startswith('@'):
+            if i in separable_terms:
+                # evaluated once per chooser (or alternative) rather than once per df row
+                v, broadcast = separable_terms[i]
+            elif expr.startswith('@'):
                 v = to_series(eval(expr[1:], globals(), locals_d))
             else:
                 v = df.eval(expr)
@@ -157,7 +174,10 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
                 expression_values_df.insert(loc=len(expression_values_df.columns), column=label,
                                             value=v.values if isinstance(v, pd.Series) else v)
 
-            utilities.utility += (v * coefficient).astype('float')
+            if i in separable_terms:
+                utilities.utility += broadcast(np.asanyarray((v * coefficient).astype(dtype)))
+            else:
+                utilities.utility += (v * coefficient).astype(dtype)
 
             if trace_eval_results is not None:
 
@@ -199,6 +219,178 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
     return utilities, trace_eval_results
 
 
+def interaction_column_names(choosers, alternatives):
+    """
+    map chooser and alternative column names to their names in interaction_dataset(choosers, alternatives)
+
+    Returns
+    -------
+    chooser_columns : dict
+        chooser column name by interaction dataset column name
+    alternative_columns : dict
+        alternative column name by interaction dataset column name
+    """
+
+    alternative_columns = {c: c for c in alternatives.columns}
+    chooser_columns = {((c + '_chooser') if c in alternative_columns else c): c for c in choosers.columns}
+
+    return chooser_columns, alternative_columns
+
+
+def skim_key_columns(skims):
+    """
+    names of the interaction dataset columns the skim wrappers in skims are keyed on
+    """
+
+    if skims is None:
+        return set()
+    if isinstance(skims, dict):
+        skims = list(skims.values())
+    elif not isinstance(skims, list):
+        skims = [skims]
+
+    columns = set()
+    for skim in skims:
+        if isinstance(skim, (SkimDictWrapper, SkimStackWrapper)):
+            columns |= {skim.left_key, skim.right_key}
+        if isinstance(skim, SkimStackWrapper):
+            columns.add(skim.skim_key)
+    return columns
+
+
+def factor_interaction_spec(spec, choosers, alternatives, sample_size, skims, locals_d, trace_label):
+    """
+    Split spec into chooser-only, alternative-only and interaction terms, evaluate the separable
+    (chooser-only and alternative-only) terms once per chooser and once per alternative, and trim
+    choosers and alternatives to the columns the interaction terms need.
+
+    Only the interaction terms (and temps) then need to be evaluated against the interaction
+    dataset, and the (much smaller) interaction dataset only has the columns they reference.
+    Separable partial utilities are broadcast and summed in spec order by eval_interaction_utilities,
+    so the utilities are exactly the same as evaluating every term against the interaction dataset.
+
+    Expressions are only treated as separable if they are simple column expressions or '@' python
+    expressions that combine df columns of the same row with elementwise numpy functions or
+    pandas methods (see spec_compiler.CompiledExpression.column_dependencies)
+
+    Parameters
+    ----------
+    spec : dataframe
+        one row per spec expression and one col with utility coefficient
+    choosers : pandas.DataFrame
+    alternatives : pandas.DataFrame
+    sample_size : int
+        alternative terms are only separable if sample_size == len(alternatives)
+        (i.e. every chooser has a row for every alternative, in alternatives order)
+    skims : SkimDictWrapper or SkimStackWrapper object, or a list or dict of skims
+    locals_d : Dict
+    trace_label : str
+
+    Returns
+    -------
+    separable_terms : dict
+        (values, broadcast) of separable terms by spec row position (for eval_interaction_utilities)
+    choosers : pandas.DataFrame
+        choosers with only the columns needed for the interaction terms
+    alternatives : pandas.DataFrame
+        alternatives with only the columns needed for the interaction terms
+    """
+
+    trace_label = tracing.extend_trace_label(trace_label, 'factor_interaction_spec')
+
+    if isinstance(spec.index, pd.MultiIndex):
+        exprs = spec.index.get_level_values(simulate.SPEC_EXPRESSION_NAME)
+    else:
+        exprs = spec.index
+
+    locals_d = locals_d.copy() if locals_d is not None else {}
+
+    chooser_columns, alternative_columns = interaction_column_names(choosers, alternatives)
+    alternatives_separable = (sample_size == len(alternatives))
+
+    compiled_spec = spec_compiler.compile_spec(exprs)
+
+    # interaction dataset columns referenced by interaction terms (None if we can't tell)
+    interaction_columns = skim_key_columns(skims)
+    temps = {}
+    chooser_terms = OrderedDict()
+    alternative_terms = OrderedDict()
+    for i, expr in enumerate(exprs):
+
+        if expr.startswith('_'):
+            target = expr[:expr.index('@')]
+            columns, _ = spec_compiler.CompiledExpression(expr[expr.index('@'):]).column_dependencies(
+                locals_d, temps)
+            # temps are only assigned when evaluating against the interaction dataset
+            # so terms that reference them are not separable (just like skim lookups)
+            temps[target] = (columns, True)
+        else:
+            columns, uses_skims = compiled_spec.exprs[i].column_dependencies(locals_d, temps)
+
+            if columns is not None and not uses_skims:
+                if columns.issubset(chooser_columns):
+                    chooser_terms[i] = columns
+                    continue
+                if alternatives_separable and columns.issubset(alternative_columns):
+                    alternative_terms[i] = columns
+                    continue
+
+        if columns is None or interaction_columns is None:
+            interaction_columns = None
+        else:
+            interaction_columns |= columns
+
+    logger.debug("%s: %s chooser and %s alternative terms of %s expressions are separable" %
+                 (trace_label, len(chooser_terms), len(alternative_terms), len(exprs)))
+
+    # - evaluate separable terms once per chooser or once per alternative
+    chooser_df = pd.DataFrame(index=choosers.index)
+    for c_chooser in set().union(*chooser_terms.values()):
+        # same dtype as in interaction_dataset (e.g. categoricals)
+        # (no copy needed, since separable terms don't modify chooser_df)
+        chooser_df[c_chooser] = choosers[chooser_columns[c_chooser]].values
+
+    separable_terms = {}
+    for i in sorted(list(chooser_terms) + list(alternative_terms)):
+        expr = exprs[i]
+        if i in chooser_terms:
+            df = chooser_df
+            broadcast = partial(np.repeat, repeats=sample_size)
+        else:
+            df = alternatives
+            broadcast = partial(np.tile, reps=len(choosers))
+
+        locals_d['df'] = df
+        try:
+            if expr.startswith('@'):
+                v = eval(expr[1:], globals(), locals_d)
+                if np.isscalar(v):
+                    v = pd.Series([v] * len(df), index=df.index)
+            else:
+                v = df.eval(expr)
+        except Exception as err:
+            logger.exception("Variable evaluation failed for: %s" % str(expr))
+            raise err
+
+        separable_terms[i] = (v, broadcast)
+
+    # - trim choosers and alternatives to the columns referenced by interaction terms
+    if interaction_columns is not None and \
+            interaction_columns.issubset(set(chooser_columns) | set(alternative_columns)):
+        chooser_keep = [c for c_chooser, c in chooser_columns.items() if c_chooser in interaction_columns]
+        # keep alternative columns with the same name as chooser columns so the chooser columns
+        # are still suffixed with '_chooser' in the interaction dataset
+        alternative_keep = [c for c in alternatives.columns
+                            if c in interaction_columns or c in chooser_keep]
+        logger.debug("%s: interaction dataset has %s of %s chooser and %s of %s alternative columns" %
+                     (trace_label, len(chooser_keep), len(choosers.columns),
+                      len(alternative_keep), len(alternatives.columns)))
+        choosers = choosers[chooser_keep]
+        alternatives = alternatives[alternative_keep]
+
+    return separable_terms, choosers, alternatives
+
+
 def _interaction_simulate(
         choosers, alternatives, spec,
         skims=None, locals_d=None, sample_size=None,
@@ -279,7 +471,14 @@ def _interaction_simulate(
     # for every chooser, there will be a row for each alternative
     # index values (non-unique) are from alternatives df
     alt_index_id = estimator.get_alt_id() if estimator else None
-    interaction_df = logit.interaction_dataset(choosers, alternatives, sample_size, alt_index_id)
+    if config.setting('factor_interaction_utilities', True) and not (have_trace_targets or estimator):
+        separable_terms, interaction_choosers, interaction_alternatives = \
+            factor_interaction_spec(spec, choosers, alternatives, sample_size, skims, locals_d, trace_label)
+    else:
+        separable_terms, interaction_choosers, interaction_alternatives = None, choosers, alternatives
+    interaction_df = logit.interaction_dataset(interaction_choosers, interaction_alternatives,
+                                               sample_size, alt_index_id,
+                                               lazy=config.setting('lazy_interaction_dataset', True))
     chunk.log_df(trace_label, 'interaction_df', interaction_df)
 
     if skims is not None:
@@ -301,7 +500,10 @@ def _interaction_simulate(
         trace_rows = trace_ids = None
 
     interaction_utilities, trace_eval_results \
-        = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows, estimator)
+        = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows, estimator,
+                                     separable_terms=separable_terms)
+    # log again, since lazy interaction_df columns are only materialized when utilities are evaluated
+    chunk.log_df(trace_label, 'interaction_df', interaction_df)
     chunk.log_df(trace_label, 'interaction_utilities', interaction_utilities)
 
     if have_trace_targets:
@@ -456,7 +658,7 @@ def interaction_simulate(
                             trace_label=trace_label)
 
     result_list = []
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label=trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
@@ -2,8 +2,11 @@
 # See full license in LICENSE.txt.
 from builtins import object
 
+import ast
 import logging
 
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
@@ -18,6 +21,11 @@ EXP_UTIL_MAX = np.inf
 PROB_MIN = 0.0
 PROB_MAX = 1.0
 
+# (double precision) exponentiated utilities not greater than UTIL_MIN are EXP_UTIL_MIN (zero probability)
+# and exponentiated utilities greater than UTIL_MAX are infinite
+UTIL_MIN = np.log(EXP_UTIL_MIN)
+UTIL_MAX = np.log(np.finfo(np.float64).max)
+
 
 def report_bad_choices(bad_row_map, df, trace_label, msg, trace_choosers=None, raise_error=True):
     """
@@ -69,6 +77,65 @@ def report_bad_choices(bad_row_map, df, trace_label, msg, trace_choosers=None, r
         raise RuntimeError(msg_with_count)
 
 
+def utility_shift(utils_arr):
+    """
+    per row shift for numerically safe exponentiation of single precision utilities
+
+    float32 exp overflows above 88.7 (and underflows below -103), so single precision utilities are
+    exponentiated relative to the max utility of their row, which leaves probabilities unchanged
+    (and just shifts logsums by the row max)
+
+    Parameters
+    ----------
+    utils_arr : numpy.ndarray
+        utilities with one row per chooser and one column per alternative
+
+    Returns
+    -------
+    shift : numpy.ndarray or None
+        max utility of each row if utils_arr is float32, otherwise None (no shift)
+    """
+
+    if utils_arr.dtype != np.float32 or utils_arr.shape[1] == 0:
+        return None
+
+    return utils_arr.max(axis=1)
+
+
+def exp_utilities(utils_arr, shift=None):
+    """
+    exponentiate utilities, relative to shift (see utility_shift) if specified
+
+    Utilities that would exponentiate to zero probability or to infinity in double precision
+    without the shift (see UTIL_MIN and UTIL_MAX) still do.
+
+    Parameters
+    ----------
+    utils_arr : numpy.ndarray
+        utilities with one row per chooser (and one column per alternative)
+    shift : numpy.ndarray or None
+        per row shift (or an array broadcastable to utils_arr)
+
+    Returns
+    -------
+    exp_utils_arr : numpy.ndarray
+        exp(utils_arr - shift) with the same shape and dtype as utils_arr
+    """
+
+    if shift is None:
+        return np.exp(utils_arr)
+
+    if shift.ndim == 1:
+        shift = shift.reshape(-1, *([1] * (utils_arr.ndim - 1)))
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        exp_utils_arr = np.exp(utils_arr - shift)
+    exp_utils_arr[utils_arr <= UTIL_MIN] = 0
+    exp_utils_arr[utils_arr > UTIL_MAX] = np.inf
+
+    return exp_utils_arr
+
+
 def utils_to_logsums(utils, exponentiated=False):
     """
     Convert a table of utilities to logsum series.
@@ -91,14 +158,18 @@ def utils_to_logsums(utils, exponentiated=False):
     # fixme - conversion to float not needed in either case?
     # utils_arr = utils.values.astype('float')
     utils_arr = utils.values
+    shift = None
     if not exponentiated:
-        utils_arr = np.exp(utils_arr)
+        shift = utility_shift(utils_arr)
+        utils_arr = exp_utilities(utils_arr, shift)
 
     np.clip(utils_arr, EXP_UTIL_MIN, EXP_UTIL_MAX, out=utils_arr)
 
     utils_arr = np.where(utils_arr == EXP_UTIL_MIN, 0.0, utils_arr)
 
     logsums = np.log(utils_arr.sum(axis=1))
+    if shift is not None:
+        logsums += shift
     logsums = pd.Series(logsums, index=utils.index)
 
     return logsums
@@ -142,7 +213,8 @@ def utils_to_probs(utils, trace_label=None, exponentiated=False, allow_zero_prob
     # utils_arr = utils.values.astype('float')
     utils_arr = utils.values
     if not exponentiated:
-        utils_arr = np.exp(utils_arr)
+        # (single precision utilities are exponentiated relative to their row max)
+        utils_arr = exp_utilities(utils_arr, utility_shift(utils_arr))
 
     np.clip(utils_arr, EXP_UTIL_MIN, EXP_UTIL_MAX, out=utils_arr)
 
@@ -238,7 +310,7 @@ def make_choices(probs, trace_label=None, trace_choosers=None):
     return choices, rands
 
 
-def interaction_dataset(choosers, alternatives, sample_size=None, alt_index_id=None):
+def interaction_dataset(choosers, alternatives, sample_size=None, alt_index_id=None, lazy=False):
     """
     Combine choosers and alternatives into one table for the purposes
     of creating interaction variables and/or sampling alternatives.
@@ -253,10 +325,14 @@ def interaction_dataset(choosers, alternatives, sample_size=None, alt_index_id=N
     sample_size : int, optional
         If sampling from alternatives for each chooser, this is
         how many to sample.
+    alt_index_id : str, optional
+        If specified, the alternatives index is added as a column with this name
+    lazy : bool
+        If True, return an InteractionDataset that only materializes columns when they are referenced
 
     Returns
     -------
-    alts_sample : pandas.DataFrame
+    alts_sample : pandas.DataFrame or InteractionDataset
         Merged choosers and alternatives with data repeated either
         len(alternatives) or `sample_size` times.
 
@@ -283,6 +359,9 @@ def interaction_dataset(choosers, alternatives, sample_size=None, alt_index_id=N
     else:
         sample = np.tile(alts_idx, numchoosers)
 
+    if lazy:
+        return InteractionDataset(choosers, alternatives, sample, sample_size, alt_index_id)
+
     alts_sample = alternatives.take(sample).copy()
 
     if alt_index_id:
@@ -304,6 +383,148 @@ def interaction_dataset(choosers, alternatives, sample_size=None, alt_index_id=N
     return alts_sample
 
 
+class InteractionDataset(object):
+    """
+    Lazy equivalent of the interaction_dataset DataFrame (see interaction_dataset)
+
+    Chooser and alternative columns are not repeated (or copied) up front. Instead each column
+    is only materialized (repeated for choosers, taken for alternatives) the first time it is
+    referenced, so columns that no spec expression uses never take up any memory.
+
+    It quacks enough like a DataFrame for spec evaluation (eval, df['col'], df.col, df[['a', 'b']]),
+    skim wrappers, tracing and estimation. Any other DataFrame attribute (e.g. df.loc) is passed on
+    to a fully materialized DataFrame.
+
+    Parameters
+    ----------
+    choosers : pandas.DataFrame
+    alternatives : pandas.DataFrame
+    sample : numpy.ndarray of int
+        positions in alternatives of each interaction dataset row
+    sample_size : int
+        number of (consecutive) interaction dataset rows per chooser
+    alt_index_id : str, optional
+        name of column with alternatives index values
+    """
+
+    def __init__(self, choosers, alternatives, sample, sample_size, alt_index_id=None):
+
+        self.choosers = choosers
+        self.alternatives = alternatives
+        self.sample = sample
+        self.sample_size = sample_size
+        self.index = alternatives.index.take(sample)
+
+        # (table, column) source of each interaction dataset column, in interaction_dataset order
+        self.sources = OrderedDict([(c, ('alternatives', c)) for c in alternatives.columns])
+        if alt_index_id:
+            self.sources[alt_index_id] = ('alternatives', None)
+        for c in choosers.columns:
+            c_chooser = (c + '_chooser') if c in self.sources else c
+            self.sources[c_chooser] = ('choosers', c)
+
+        self.columns = pd.Index(list(self.sources))
+
+        # materialized columns
+        self.series = {}
+        self.frame = None
+
+    @property
+    def shape(self):
+        return len(self.index), len(self.columns)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.sources
+
+    def column_values(self, name, rows=None):
+        """
+        values of column name for all rows (or for the row positions in rows)
+        """
+
+        table, c = self.sources[name]
+        if table == 'choosers':
+            if rows is None:
+                return np.repeat(self.choosers[c].values, self.sample_size)
+            return self.choosers[c].values.take(rows // self.sample_size)
+
+        sample = self.sample if rows is None else self.sample[rows]
+        if c is None:
+            return self.alternatives.index.values.take(sample)
+        return self.alternatives[c].values.take(sample)
+
+    def column(self, name):
+
+        s = self.series.get(name)
+        if s is None:
+            s = self.series[name] = pd.Series(self.column_values(name), index=self.index, name=name)
+        return s
+
+    def to_frame(self, columns=None):
+        """
+        materialize columns (all columns if None) as a DataFrame
+        """
+
+        columns = self.columns if columns is None else columns
+        return pd.DataFrame(OrderedDict([(c, self.column(c).values) for c in columns]), index=self.index)
+
+    def take_rows(self, rows):
+        """
+        DataFrame with all columns of the rows at positions rows (without materializing the columns)
+        """
+
+        return pd.DataFrame(OrderedDict([(c, self.column_values(c, rows)) for c in self.columns]),
+                            index=self.index[rows])
+
+    def __getitem__(self, key):
+
+        if isinstance(key, list):
+            return self.to_frame(key)
+        if isinstance(key, (np.ndarray, pd.Series)) and key.dtype == bool:
+            # e.g. trace rows
+            return self.take_rows(np.flatnonzero(np.asanyarray(key)))
+        return self.column(key)
+
+    def __getattr__(self, name):
+
+        # (only called if name is not an attribute of self)
+        if name.startswith('__') or 'sources' not in self.__dict__:
+            raise AttributeError(name)
+        if name in self.sources:
+            return self.column(name)
+
+        if self.frame is None:
+            logger.debug("InteractionDataset materializing all %s columns for '%s'" % (len(self.columns), name))
+            self.frame = self.to_frame()
+        return getattr(self.frame, name)
+
+    def eval(self, expr):
+        """
+        DataFrame.eval of expr (only materializing the columns it references)
+        """
+
+        try:
+            names = {node.id for node in ast.walk(ast.parse(expr.strip(), mode='eval'))
+                     if isinstance(node, ast.Name)}
+        except SyntaxError:
+            # (e.g. backtick quoted column names)
+            names = set(self.columns)
+
+        return self.to_frame([c for c in self.columns if c in names]).eval(expr)
+
+    def memory_usage(self, index=True):
+        """
+        memory usage of the materialized columns (in the same format as DataFrame.memory_usage)
+        """
+
+        usage = [(c, s.memory_usage(index=False)) for c, s in self.series.items()]
+        if index:
+            usage.insert(0, ('Index', self.index.memory_usage()))
+        return pd.Series(OrderedDict(usage), dtype=np.int64)
+
+
 class Nest(object):
     """
     Data for a nest-logit node or leaf
@@ -462,3 +683,209 @@ def count_nests(nest_spec):
             return 1
 
     return count_each_nest(nest_spec, 0) if nest_spec is not None else 0
+
+
+class NestTree(object):
+    """
+    Nest spec compiled into index arrays for vectorized nested logit
+
+    Nodes (nests and leaves) are numbered in breadth first order, so all the nodes of each level
+    are contiguous, as are the children of each nest. The exponentiated utilities, probabilities
+    and logsums of all nodes can then be computed level by level with a few numpy operations on
+    2-D arrays (with one row per chooser and one column per node).
+
+    Parameters
+    ----------
+    nest_spec : dict
+        Nest tree dict from the model spec yaml file (with coefficient values)
+    alternatives : sequence of str
+        names of the alternatives (leaves) in the order of the utilities columns
+    """
+
+    def __init__(self, nest_spec, alternatives):
+
+        nests = {nest.name: nest for nest in each_nest(nest_spec)}
+        root = next(each_nest(nest_spec))
+
+        # breadth first order
+        order = [root]
+        for nest in order:
+            if not nest.is_leaf:
+                order.extend(nests[a] for a in nest.alternatives)
+
+        self.names = [nest.name for nest in order]
+        self.is_leaf = np.array([nest.is_leaf for nest in order])
+        self.levels = np.array([nest.level for nest in order])
+        self.coefficients = np.array([nest.coefficient for nest in order], dtype=np.float64)
+        self.products = np.array([nest.product_of_coefficients for nest in order], dtype=np.float64)
+
+        offsets = {name: i for i, name in enumerate(self.names)}
+        self.parents = np.array([-1] + [offsets[nest.ancestors[-2]] for nest in order[1:]])
+
+        alternatives = list(alternatives)
+        assert set(alternatives) == {nest.name for nest in order if nest.is_leaf}
+        self.leaves = np.array([offsets[a] for a in alternatives])
+
+        # (start, end) of each level's nodes, for every level (below root) with a parent nest
+        # and, for each nest on the level above, the offset of its first child in the level
+        self.child_levels = []
+        for level in range(self.levels.min() + 1, self.levels.max() + 1):
+            nodes = np.flatnonzero(self.levels == level)
+            start, end = nodes[0], nodes[-1] + 1
+            parents = self.parents[start:end]
+            child_offsets = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+            self.child_levels.append((start, end, parents[child_offsets], child_offsets))
+
+    def exp_utilities(self, raw_utilities, shift=None):
+        """
+        exponentiated utilities of leaves and nests
+
+        leaf <- exp( raw_utility / product_of_coefficients )
+        nest <- exp( ln(sum of exponentiated utilities of its alternatives) * nest_coefficient )
+
+        Parameters
+        ----------
+        raw_utilities : numpy.ndarray
+            utilities of the alternatives (in alternatives order)
+        shift : numpy.ndarray, optional
+            per row shift of raw utilities (see utility_shift) for single precision utilities,
+            which scales the exponentiated utilities of all the siblings of each nest by the same
+            factor (so probabilities are unchanged and the root logsum is shifted by shift)
+
+        Returns
+        -------
+        nested_exp_utilities : numpy.ndarray
+            one row per chooser and one column per node (in node order)
+        """
+
+        dtype = np.float32 if raw_utilities.dtype == np.float32 else np.float64
+
+        nested_exp_utilities = np.empty((raw_utilities.shape[0], len(self.names)), dtype=dtype)
+
+        products = self.products[self.leaves]
+        leaf_utilities = raw_utilities.astype(dtype, copy=False) / products.astype(dtype)
+        if shift is not None:
+            shift = shift[:, np.newaxis] / products[np.newaxis, :].astype(dtype)
+        nested_exp_utilities[:, self.leaves] = exp_utilities(leaf_utilities, shift)
+
+        # nest nodes (after their alternatives, from the deepest level up)
+        # this will RuntimeWarning: divide by zero encountered in log
+        # if all nest alternative utilities are zero
+        # but the resulting inf will become 0 when exp is applied
+        for start, end, parents, child_offsets in reversed(self.child_levels):
+            sums = np.add.reduceat(nested_exp_utilities[:, start:end], child_offsets, axis=1)
+            with np.errstate(divide='ignore'):
+                nested_exp_utilities[:, parents] = \
+                    np.exp(self.coefficients[parents].astype(dtype) * np.log(sums))
+
+        return nested_exp_utilities
+
+    def logsums(self, nested_exp_utilities, shift=None):
+        """
+        logsums of the nest root (undoing the shift of single precision exp utilities)
+        """
+
+        logsums = np.log(nested_exp_utilities[:, 0])
+        if shift is not None:
+            logsums = logsums + shift
+
+        return logsums
+
+    def nested_probabilities(self, nested_exp_utilities, index=None, trace_label=None):
+        """
+        probabilities of each node relative to its siblings in the same nest
+
+        These are computed like utils_to_probs(exponentiated=True, allow_zero_probs=True) computes
+        the probabilities of the alternatives of each nest (in which all probabilities of nests
+        whose alternatives all have zero exponentiated utility are zero)
+
+        Parameters
+        ----------
+        nested_exp_utilities : numpy.ndarray
+            (from exp_utilities)
+        index : pandas.Index, optional
+            chooser index to report infinite exponentiated utilities
+        trace_label : str
+
+        Returns
+        -------
+        nested_probabilities : numpy.ndarray
+            one row per chooser and one column per node (root probability is one)
+        """
+
+        exp_utils = np.clip(nested_exp_utilities, EXP_UTIL_MIN, EXP_UTIL_MAX)
+        exp_utils[exp_utils == EXP_UTIL_MIN] = 0.0
+
+        nested_probabilities = np.empty_like(exp_utils)
+        nested_probabilities[:, 0] = 1.0
+
+        for start, end, parents, child_offsets in self.child_levels:
+
+            sums = np.add.reduceat(exp_utils[:, start:end], child_offsets, axis=1)
+
+            inf_utils = np.isinf(sums).any(axis=1)
+            if inf_utils.any():
+                report_bad_choices(inf_utils,
+                                   pd.DataFrame(nested_exp_utilities, index=index, columns=self.names),
+                                   trace_label=tracing.extend_trace_label(trace_label, 'inf_exp_utils'),
+                                   msg="infinite exponentiated utilities")
+
+            child_counts = np.diff(np.r_[child_offsets, end - start])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                np.divide(exp_utils[:, start:end], np.repeat(sums, child_counts, axis=1),
+                          out=nested_probabilities[:, start:end])
+
+        nested_probabilities[np.isnan(nested_probabilities)] = PROB_MIN
+        np.clip(nested_probabilities, PROB_MIN, PROB_MAX, out=nested_probabilities)
+
+        return nested_probabilities
+
+    def base_probabilities(self, nested_probabilities):
+        """
+        base (global) probabilities of the leaves: the product of the nested probabilities of
+        each leaf and its ancestors (below root)
+
+        Returns
+        -------
+        base_probabilities : numpy.ndarray
+            one row per chooser and one column per alternative (in alternatives order)
+        """
+
+        probabilities = nested_probabilities.copy()
+        for start, end, parents, child_offsets in self.child_levels:
+            probabilities[:, start:end] *= probabilities[:, self.parents[start:end]]
+
+        return probabilities[:, self.leaves]
+
+
+# nest trees memoized by nest spec (and alternatives order)
+_NEST_TREES = {}
+
+
+def nest_tree(nest_spec, alternatives):
+    """
+    NestTree for nest_spec (only compiled once per distinct nest spec and alternatives)
+
+    Parameters
+    ----------
+    nest_spec : dict
+        Nest tree dict from the model spec yaml file (with coefficient values)
+    alternatives : sequence of str
+        names of the alternatives in the order of the utilities columns
+
+    Returns
+    -------
+    nest_tree : NestTree
+    """
+
+    def nest_key(spec):
+        if isinstance(spec, dict):
+            return spec['name'], spec['coefficient'], tuple(nest_key(a) for a in spec['alternatives'])
+        return spec
+
+    key = (nest_key(nest_spec), tuple(alternatives))
+    tree = _NEST_TREES.get(key)
+    if tree is None:
+        tree = _NEST_TREES[key] = NestTree(nest_spec, alternatives)
+
+    return tree
@@ -19,6 +19,7 @@ from activitysim.core import pipeline
 from activitysim.core import config
 
 from activitysim.core import chunk
+from activitysim.core import checkpoint_store
 from activitysim.core import mem
 
 from activitysim.core.config import setting
@@ -271,7 +272,7 @@ def pipeline_table_keys(pipeline_store):
     return dict of current (as of last checkpoint) pipeline tables
     and their checkpoint-specific hdf5_keys
 
-    This facilitates reading pipeline tables directly from a 'raw' open pandas.HDFStore without
+    This facilitates reading pipeline tables directly from a 'raw' open checkpoint store without
     opening it as a pipeline (e.g. when apportioning and coalescing pipelines)
 
     We currently only ever need to do this from the last checkpoint, so the ability to specify
@@ -279,7 +280,7 @@ def pipeline_table_keys(pipeline_store):
 
     Parameters
     ----------
-    pipeline_store : open hdf5 pipeline_store
+    pipeline_store : open checkpoint_store (HdfStore or ParquetStore)
 
     Returns
     -------
@@ -487,9 +488,10 @@ def apportion_pipeline(sub_proc_names, slice_info):
 
     # - load all tables from pipeline
     tables = {}
-    with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
+    with checkpoint_store.open_store(pipeline_path, mode='r') as pipeline_store:
 
         checkpoints_df = pipeline_store[pipeline.CHECKPOINT_TABLE_NAME]
+        checkpoint_deltas = pipeline.read_checkpoint_deltas(pipeline_store)
 
         # hdf5_keys is a dict mapping table_name to pipeline hdf5_key
         checkpoint_name, hdf5_keys = pipeline_table_keys(pipeline_store)
@@ -504,7 +506,7 @@ def apportion_pipeline(sub_proc_names, slice_info):
             # new checkpoint for all tables the same
             checkpoints_df[table_name] = checkpoint_name
             # load the dataframe
-            tables[table_name] = pipeline_store[hdf5_key]
+            tables[table_name] = pipeline.read_store_df(pipeline_store, hdf5_key, checkpoint_deltas)
 
             debug(f"loaded table {table_name} {tables[table_name].shape}")
 
@@ -523,13 +525,13 @@ def apportion_pipeline(sub_proc_names, slice_info):
         process_name = sub_proc_names[i]
         pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
 
-        # remove existing file
+        # remove existing store
         try:
-            os.unlink(pipeline_path)
+            checkpoint_store.remove_store(pipeline_path)
         except OSError:
             pass
 
-        with pd.HDFStore(pipeline_path, mode='a') as pipeline_store:
+        with checkpoint_store.open_store(pipeline_path, mode='a') as pipeline_store:
 
             # remember sliced_tables so we can cascade slicing to other tables
             sliced_tables = {}
@@ -597,14 +599,15 @@ def coalesce_pipelines(sub_proc_names, slice_info):
     tables = {}
     pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=sub_proc_names[0])
 
-    with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
+    with checkpoint_store.open_store(pipeline_path, mode='r') as pipeline_store:
 
         # hdf5_keys is a dict mapping table_name to pipeline hdf5_key
         checkpoint_name, hdf5_keys = pipeline_table_keys(pipeline_store)
+        checkpoint_deltas = pipeline.read_checkpoint_deltas(pipeline_store)
 
         for table_name, hdf5_key in hdf5_keys.items():
             debug(f"loading table {table_name} {hdf5_key}")
-            tables[table_name] = pipeline_store[hdf5_key]
+            tables[table_name] = pipeline.read_store_df(pipeline_store, hdf5_key, checkpoint_deltas)
 
     # - use slice rules followed by apportion_pipeline to identify mirrored tables
     # (tables that are identical in every pipeline and so don't need to be concatenated)
@@ -623,9 +626,11 @@ def coalesce_pipelines(sub_proc_names, slice_info):
         pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
         logger.info(f"coalesce pipeline {pipeline_path}")
 
-        with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
+        with checkpoint_store.open_store(pipeline_path, mode='r') as pipeline_store:
+            checkpoint_deltas = pipeline.read_checkpoint_deltas(pipeline_store)
             for table_name, hdf5_key in omnibus_keys.items():
-                omnibus_tables[table_name].append(pipeline_store[hdf5_key])
+                omnibus_tables[table_name].append(
+                    pipeline.read_store_df(pipeline_store, hdf5_key, checkpoint_deltas))
 
     pipeline.open_pipeline()
 
@@ -848,9 +853,16 @@ def mp_setup_skims(injectables, **kwargs):
         omx_file_path = config.data_file_path(setting('skims_file'))
         tags_to_load = setting('skim_time_periods')['labels']
 
-        skim_info = skims.get_skim_info(omx_file_path, tags_to_load)
+        skim_info = skims.get_skim_info(omx_file_path, tags_to_load, setting('skim_quantization'),
+                                        skims.skim_key1s_to_load())
         if TEST_SPAWN:
             warning("mp_setup_skims TEST_SPAWN {TEST_SPAWN} skipping skims.load_skims")
+        elif setting('memmap_skim_cache'):
+            # no shared skim buffers to load - just make sure skim cache exists before sub-processes map it
+            skims.memmap_skims(omx_file_path, skim_info)
+        elif setting('sparse_skims'):
+            # no shared skim buffers to load - sub-processes each load their own (small) sparse skims
+            pass
         else:
             skims.load_skims(omx_file_path, skim_info, shared_data_buffer)
 
@@ -899,11 +911,21 @@ def allocate_shared_skim_buffers():
 
     info("allocate_shared_skim_buffer")
 
+    if setting('memmap_skim_cache'):
+        # sub-processes memmap the skim cache files directly, sharing the os page cache instead
+        info("allocate_shared_skim_buffer not allocating skim buffers since memmap_skim_cache is True")
+        return {}
+
+    if setting('sparse_skims'):
+        info("allocate_shared_skim_buffer not allocating skim buffers since sparse_skims are loaded per process")
+        return {}
+
     omx_file_path = config.data_file_path(setting('skims_file'))
     tags_to_load = setting('skim_time_periods')['labels']
 
     # select the skims to load
-    skim_info = skims.get_skim_info(omx_file_path, tags_to_load)
+    skim_info = skims.get_skim_info(omx_file_path, tags_to_load, setting('skim_quantization'),
+                                    skims.skim_key1s_to_load())
     skim_buffers = skims.buffers_for_skims(skim_info, shared=True)
 
     return skim_buffers
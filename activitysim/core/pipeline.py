@@ -4,10 +4,12 @@ from builtins import next
 from builtins import map
 from builtins import object
 
-import os
+import json
+import hashlib
 import logging
 import datetime as dt
 
+import numpy as np
 import pandas as pd
 
 from . import orca
@@ -16,6 +18,8 @@ from . import config
 from . import random
 from . import tracing
 from . import mem
+from . import checkpoint_store
+from . import compact
 
 from . import util
 from .tracing import print_elapsed_time
@@ -32,6 +36,22 @@ NON_TABLE_COLUMNS = [CHECKPOINT_NAME, TIMESTAMP]
 # name used for storing the checkpoints dataframe to the pipeline store
 CHECKPOINT_TABLE_NAME = 'checkpoints'
 
+# name used for storing the checkpoint deltas dataframe to the pipeline store
+CHECKPOINT_DELTAS_TABLE_NAME = 'checkpoint_deltas'
+
+# suffix of table name used to store rows appended to unchanged columns of a delta checkpointed table
+ADDED_ROWS_SUFFIX = '_added_rows'
+
+# columns of the checkpoint deltas dataframe (one row per delta checkpointed table version)
+TABLE_NAME = 'table_name'
+BASE_CHECKPOINT_NAME = 'base_checkpoint_name'
+TABLE_COLUMNS = 'columns'
+CHANGED_COLUMNS = 'changed_columns'
+ADDED_ROWS = 'added_rows'
+DELTA_DEPTH = 'depth'
+CHECKPOINT_DELTAS_COLUMNS = \
+    [TABLE_NAME, CHECKPOINT_NAME, BASE_CHECKPOINT_NAME, TABLE_COLUMNS, CHANGED_COLUMNS, ADDED_ROWS, DELTA_DEPTH]
+
 # name of the first step/checkpoint created when teh pipeline is started
 INITIAL_CHECKPOINT_NAME = 'init'
 
@@ -56,6 +76,12 @@ class Pipeline(object):
 
         self.replaced_tables = {}
 
+        # dict of checkpoint delta dicts for delta checkpointed tables keyed by pipeline_table_key
+        self.checkpoint_deltas = {}
+
+        # dict of fingerprints of the last checkpointed version of tables keyed by table_name
+        self.table_fingerprints = {}
+
         self._rng = random.Random()
 
         self.open_files = {}
@@ -115,21 +141,27 @@ def open_pipeline_store(overwrite=False):
 
     if overwrite:
         try:
-            if os.path.isfile(pipeline_file_path):
-                logger.debug("removing pipeline store: %s" % pipeline_file_path)
-                os.unlink(pipeline_file_path)
+            checkpoint_store.remove_store(pipeline_file_path)
         except Exception as e:
             print(e)
             logger.warning("Error removing %s: %s" % (pipeline_file_path, e))
 
-    _PIPELINE.pipeline_store = pd.HDFStore(pipeline_file_path, mode='a')
+    _PIPELINE.pipeline_store = checkpoint_store.open_store(pipeline_file_path, mode='a')
+
+    if config.setting('background_checkpoint_writer', False):
+        # write checkpointed tables on a background thread
+        _PIPELINE.pipeline_store = \
+            checkpoint_store.BackgroundWriterStore(_PIPELINE.pipeline_store,
+                                                   queue_size=config.setting('background_writer_queue_size', 4))
 
-    logger.debug("opened pipeline_store")
+    logger.debug("opened %s pipeline_store" % checkpoint_store.store_type())
 
 
 def get_pipeline_store():
     """
-    Return the open pipeline hdf5 checkpoint store or return None if it not been opened
+    Return the open pipeline checkpoint store or return None if it not been opened
+
+    (an HdfStore or ParquetStore depending on the pipeline_store_type setting)
     """
     return _PIPELINE.pipeline_store
 
@@ -145,7 +177,7 @@ def get_rn_generator():
     return _PIPELINE.rng()
 
 
-def read_df(table_name, checkpoint_name=None):
+def read_df(table_name, checkpoint_name=None, columns=None):
     """
     Read a pandas dataframe from the pipeline store.
 
@@ -154,12 +186,14 @@ def read_df(table_name, checkpoint_name=None):
 
     The only exception is the checkpoints dataframe, which just has a table_name
 
-    An error will be raised by HDFStore if the table is not found
+    A KeyError will be raised by the store if the table is not found
 
     Parameters
     ----------
     table_name : str
     checkpoint_name : str
+    columns : list of str, optional
+        only return these columns (the parquet store only reads these columns from disk)
 
     Returns
     -------
@@ -169,7 +203,8 @@ def read_df(table_name, checkpoint_name=None):
     """
 
     store = get_pipeline_store()
-    df = store[pipeline_table_key(table_name, checkpoint_name)]
+    df = read_store_df(store, pipeline_table_key(table_name, checkpoint_name), _PIPELINE.checkpoint_deltas,
+                       columns=columns)
 
     return df
 
@@ -198,11 +233,241 @@ def write_df(df, table_name, checkpoint_name=None):
 
     store = get_pipeline_store()
 
-    store[pipeline_table_key(table_name, checkpoint_name)] = df
+    store.write(pipeline_table_key(table_name, checkpoint_name), df)
 
     store.flush()
 
 
+def checkpoint_deltas():
+    """
+    Return True if checkpoint_deltas setting enabled
+
+    If so, when a checkpointed table has the same rows as (or rows appended to) its previous
+    checkpointed version, only the new or changed columns (and the appended rows of unchanged
+    columns) are written to the pipeline store, up to checkpoint_snapshot_interval delta versions
+    in a row before a full snapshot of the table is written again.
+    """
+
+    return config.setting('checkpoint_deltas', False)
+
+
+def read_checkpoint_deltas(store):
+    """
+    Read checkpoint deltas dict (keyed by pipeline_table_key) from store (empty if there are none)
+
+    Parameters
+    ----------
+    store : open checkpoint_store
+
+    Returns
+    -------
+    deltas : dict {<table_key>: <checkpoint delta dict>}
+    """
+
+    if CHECKPOINT_DELTAS_TABLE_NAME not in store:
+        return {}
+
+    deltas_df = store.read(CHECKPOINT_DELTAS_TABLE_NAME)
+
+    return {pipeline_table_key(delta[TABLE_NAME], delta[CHECKPOINT_NAME]): delta
+            for delta in deltas_df.to_dict(orient='records')}
+
+
+def read_store_df(store, key, deltas, columns=None):
+    """
+    Read table with pipeline_table_key key from store, reconstructing it from its full snapshot
+    and chain of deltas if it was delta checkpointed.
+
+    Parameters
+    ----------
+    store : open checkpoint_store
+    key : str
+        pipeline_table_key
+    deltas : dict
+        checkpoint deltas dict (as returned by read_checkpoint_deltas)
+    columns : list of str, optional
+        only read these columns
+
+    Returns
+    -------
+    df : pandas.DataFrame
+    """
+
+    delta = deltas.get(key)
+
+    if delta is None:
+        return store.read(key, columns=columns)
+
+    table_name = delta[TABLE_NAME]
+    table_columns = json.loads(delta[TABLE_COLUMNS])
+    changed_columns = json.loads(delta[CHANGED_COLUMNS])
+
+    if columns is None:
+        columns = table_columns
+
+    # changed columns (with the full index of this version of the table)
+    df = store.read(key, columns=[c for c in columns if c in changed_columns])
+
+    base_columns = [c for c in columns if c not in changed_columns]
+    if base_columns:
+        base_key = pipeline_table_key(table_name, delta[BASE_CHECKPOINT_NAME])
+        base_df = read_store_df(store, base_key, deltas, columns=base_columns)
+
+        if delta[ADDED_ROWS]:
+            added_rows_key = pipeline_table_key(table_name + ADDED_ROWS_SUFFIX, delta[CHECKPOINT_NAME])
+            base_df = pd.concat([base_df, store.read(added_rows_key, columns=base_columns)])
+
+        assert len(base_df) == len(df)
+        base_df.index = df.index
+
+        df = pd.concat([base_df, df], axis=1)
+
+    return df[columns]
+
+
+def table_fingerprints(df):
+    """
+    Values to fingerprint for the index and each column of df, used to detect which columns changed
+    since the last checkpoint without keeping a copy of the checkpointed table.
+
+    The raw values of numpy dtype columns are fingerprinted directly, object and extension dtype
+    columns (e.g. strings and categoricals) by their pandas hash values. Either way, fingerprinting
+    the first n elements fingerprints the first n rows.
+
+    Returns
+    -------
+    index_values : numpy.ndarray
+    column_values : dict {<column_name>: numpy.ndarray}
+    """
+
+    def hashable(values):
+        if isinstance(values.dtype, np.dtype) and values.dtype != object:
+            return np.ascontiguousarray(values)
+        return pd.util.hash_pandas_object(values, index=False).values
+
+    index_values = hashable(df.index.to_series())
+    column_values = {c: hashable(df[c]) for c in df.columns}
+
+    return index_values, column_values
+
+
+def fingerprint(values, dtype=None):
+    return "%s:%s" % (dtype, hashlib.sha1(memoryview(values)).hexdigest())
+
+
+def write_checkpoint_df(df, table_name, checkpoint_name):
+    """
+    Write version of table as of checkpoint_name to the pipeline store, either as a full snapshot,
+    or (if checkpoint_deltas is enabled) as a delta to its last checkpointed version.
+
+    Delta checkpointed versions are listed in the checkpoint deltas table, and only contain the
+    new or changed columns (and, if rows were appended, the appended rows of the unchanged columns
+    in the <table_name>_added_rows table).
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    table_name : str
+    checkpoint_name : str
+    """
+
+    key = pipeline_table_key(table_name, checkpoint_name)
+
+    if not checkpoint_deltas():
+        _PIPELINE.checkpoint_deltas.pop(key, None)
+        write_df(df, table_name, checkpoint_name)
+        return
+
+    # coerce column names to str (as write_df does) without renaming the columns of the live table
+    if not all(isinstance(c, str) for c in df.columns):
+        df = df.copy(deep=False)
+        df.columns = df.columns.astype(str)
+
+    index_values, column_values = table_fingerprints(df)
+    column_fingerprints = {c: fingerprint(v, df[c].dtype) for c, v in column_values.items()}
+
+    previous = _PIPELINE.table_fingerprints.get(table_name)
+
+    # rows of base version are either the same or the first rows of this version
+    num_base_rows = None
+    if previous and \
+            previous[DELTA_DEPTH] < config.setting('checkpoint_snapshot_interval', 10) and \
+            len(df) >= previous['num_rows'] and df.index.is_unique:
+        if fingerprint(index_values[:previous['num_rows']]) == previous['index']:
+            num_base_rows = previous['num_rows']
+
+    changed_columns = []
+    if num_base_rows is not None:
+        for c in df.columns:
+            base_fingerprint = previous['columns'].get(c)
+            if num_base_rows == len(df):
+                unchanged = (column_fingerprints[c] == base_fingerprint)
+            else:
+                # categoricals with appended rows might not concat to the same dtype
+                unchanged = not pd.api.types.is_categorical_dtype(df[c]) and \
+                    fingerprint(column_values[c][:num_base_rows], df[c].dtype) == base_fingerprint
+            if not unchanged:
+                changed_columns.append(c)
+
+    if num_base_rows is not None and len(changed_columns) < len(df.columns):
+
+        unchanged_columns = [c for c in df.columns if c not in changed_columns]
+        added_rows = (num_base_rows < len(df))
+
+        logger.debug("add_checkpoint '%s' table '%s' delta %s changed columns %s added rows" %
+                     (checkpoint_name, table_name, len(changed_columns), len(df) - num_base_rows))
+
+        write_df(df[changed_columns], table_name, checkpoint_name)
+        if added_rows:
+            write_df(df.iloc[num_base_rows:][unchanged_columns], table_name + ADDED_ROWS_SUFFIX, checkpoint_name)
+
+        depth = previous[DELTA_DEPTH] + 1
+        _PIPELINE.checkpoint_deltas[key] = {
+            TABLE_NAME: table_name,
+            CHECKPOINT_NAME: checkpoint_name,
+            BASE_CHECKPOINT_NAME: previous[CHECKPOINT_NAME],
+            TABLE_COLUMNS: json.dumps(list(df.columns)),
+            CHANGED_COLUMNS: json.dumps(changed_columns),
+            ADDED_ROWS: added_rows,
+            DELTA_DEPTH: depth,
+        }
+    else:
+        _PIPELINE.checkpoint_deltas.pop(key, None)
+        write_df(df, table_name, checkpoint_name)
+        depth = 0
+
+    remember_table_fingerprints(df, table_name, checkpoint_name, depth, index_values, column_fingerprints)
+
+
+def remember_table_fingerprints(df, table_name, checkpoint_name, depth,
+                                index_values=None, column_fingerprints=None):
+    """
+    Remember fingerprints of checkpointed version of table, for comparison at its next checkpoint
+    """
+
+    if index_values is None:
+        index_values, column_values = table_fingerprints(df)
+        column_fingerprints = {c: fingerprint(v, df[c].dtype) for c, v in column_values.items()}
+
+    _PIPELINE.table_fingerprints[table_name] = {
+        CHECKPOINT_NAME: checkpoint_name,
+        DELTA_DEPTH: depth,
+        'num_rows': len(df),
+        'index': fingerprint(index_values),
+        'columns': column_fingerprints,
+    }
+
+
+def write_checkpoint_deltas():
+    """
+    Write the checkpoint deltas table to the pipeline store (if checkpoint_deltas or there are any)
+    """
+
+    if _PIPELINE.checkpoint_deltas or checkpoint_deltas():
+        deltas_df = pd.DataFrame(list(_PIPELINE.checkpoint_deltas.values()), columns=CHECKPOINT_DELTAS_COLUMNS)
+        write_df(deltas_df, CHECKPOINT_DELTAS_TABLE_NAME)
+
+
 def rewrap(table_name, df=None):
     """
     Add or replace an orca registered table as a unitary DataFrame-backed DataFrameWrapper table
@@ -286,13 +551,15 @@ def add_checkpoint(checkpoint_name):
 
         logger.debug("add_checkpoint '%s' table '%s' %s" %
                      (checkpoint_name, table_name, util.df_size(df)))
-        write_df(df, table_name, checkpoint_name)
+        write_checkpoint_df(df, table_name, checkpoint_name)
 
         # remember which checkpoint it was last written
         _PIPELINE.last_checkpoint[table_name] = checkpoint_name
 
     _PIPELINE.replaced_tables.clear()
 
+    write_checkpoint_deltas()
+
     _PIPELINE.last_checkpoint[CHECKPOINT_NAME] = checkpoint_name
     _PIPELINE.last_checkpoint[TIMESTAMP] = timestamp
 
@@ -369,6 +636,14 @@ def load_checkpoint(checkpoint_name):
     # patch _CHECKPOINTS array of dicts
     _PIPELINE.checkpoints = checkpoints
 
+    # deltas of truncated checkpoints will be rewritten (or not) when their models are rerun
+    checkpoint_names = [checkpoint[CHECKPOINT_NAME] for checkpoint in checkpoints]
+    deltas = read_checkpoint_deltas(get_pipeline_store())
+    _PIPELINE.checkpoint_deltas = \
+        {key: delta for key, delta in deltas.items() if delta[CHECKPOINT_NAME] in checkpoint_names}
+    if len(_PIPELINE.checkpoint_deltas) < len(deltas):
+        write_checkpoint_deltas()
+
     # patch _CHECKPOINTS dict with latest checkpoint info
     _PIPELINE.last_checkpoint.clear()
     _PIPELINE.last_checkpoint.update(_PIPELINE.checkpoints[-1])
@@ -378,17 +653,34 @@ def load_checkpoint(checkpoint_name):
 
     tables = checkpointed_tables()
 
+    # register for tracing in order that tracing.register_traceable_table wants us to register them
+    traceable_tables = inject.get_injectable('traceable_tables', [])
+    traced_tables = traceable_tables if inject.get_injectable('trace_hh_id', None) else []
+
+    lazy = config.setting('lazy_checkpoint_tables', False)
+
     loaded_tables = {}
     for table_name in tables:
+
+        table_checkpoint_name = _PIPELINE.last_checkpoint[table_name]
+
+        if lazy and table_name not in traced_tables:
+            # register deferred loader as orca table, to read dataframe from store on first access
+            logger.info("load_checkpoint table %s (lazy)" % (table_name, ))
+            rewrap(table_name, lazy_table_loader(table_name, table_checkpoint_name))
+            continue
+
         # read dataframe from pipeline store
-        df = read_df(table_name, checkpoint_name=_PIPELINE.last_checkpoint[table_name])
+        df = read_df(table_name, checkpoint_name=table_checkpoint_name)
         logger.info("load_checkpoint table %s %s" % (table_name, df.shape))
+        # (hdf5 store doesn't keep categoricals)
+        df = compact.compact_df(df, table_name, trace_label='load_checkpoint')
         # register it as an orca table
         rewrap(table_name, df)
         loaded_tables[table_name] = df
 
-    # register for tracing in order that tracing.register_traceable_table wants us to register them
-    traceable_tables = inject.get_injectable('traceable_tables', [])
+        remember_loaded_table(df, table_name, table_checkpoint_name)
+
     for table_name in traceable_tables:
         if table_name in loaded_tables:
             tracing.register_traceable_table(table_name, loaded_tables[table_name])
@@ -401,6 +693,45 @@ def load_checkpoint(checkpoint_name):
             if table_name in loaded_tables:
                 logger.debug("adding channel %s" % (table_name,))
                 _PIPELINE.rng().add_channel(table_name, loaded_tables[table_name])
+            elif table_name in tables:
+                # channels only need the index of lazy tables
+                logger.debug("adding channel %s (index only)" % (table_name,))
+                index_df = read_df(table_name, checkpoint_name=_PIPELINE.last_checkpoint[table_name], columns=[])
+                _PIPELINE.rng().add_channel(table_name, index_df)
+
+
+def remember_loaded_table(df, table_name, checkpoint_name):
+    """
+    Remember fingerprints of table loaded from checkpoint, so its next checkpoint can be a delta
+    """
+
+    if checkpoint_deltas():
+        delta = _PIPELINE.checkpoint_deltas.get(pipeline_table_key(table_name, checkpoint_name))
+        remember_table_fingerprints(df, table_name, checkpoint_name, delta[DELTA_DEPTH] if delta else 0)
+
+
+def lazy_table_loader(table_name, checkpoint_name):
+    """
+    Return function to register as orca table for lazy_checkpoint_tables
+
+    On first access, it reads the table as of checkpoint_name from the pipeline store and replaces
+    itself with the loaded dataframe, keeping any columns already added to the orca table.
+    (Tables that are never accessed are not changed, so they don't need to be checkpointed again.)
+    """
+
+    def load_table():
+
+        df = read_df(table_name, checkpoint_name=checkpoint_name)
+        logger.info("lazy load table %s %s from checkpoint %s" % (table_name, df.shape, checkpoint_name))
+        df = compact.compact_df(df, table_name, trace_label='load_checkpoint')
+
+        orca.add_table(table_name, df)
+
+        remember_loaded_table(df, table_name, checkpoint_name)
+
+        return df
+
+    return load_table
 
 
 def split_arg(s, sep, default=''):
@@ -497,6 +828,8 @@ def open_pipeline(resume_after=None):
     _PIPELINE.is_open = True
 
     get_rn_generator().set_base_seed(inject.get_injectable('rng_base_seed', 0))
+    get_rn_generator().set_channel_type(config.setting('rng_channel_type', 'simple'))
+    get_rn_generator().set_vectorized_choice(config.setting('rng_vectorized_choice', False))
 
     if resume_after:
         # open existing pipeline
@@ -541,6 +874,8 @@ def close_pipeline():
 
     _PIPELINE.pipeline_store.close()
 
+    compact.write_memory_report()
+
     _PIPELINE.init_state()
 
     logger.info("close_pipeline")
@@ -669,10 +1004,11 @@ def get_checkpoints():
     store = get_pipeline_store()
 
     if store is not None:
-        df = store[CHECKPOINT_TABLE_NAME]
+        df = store.read(CHECKPOINT_TABLE_NAME)
     else:
         pipeline_file_path = config.pipeline_file_path(orca.get_injectable('pipeline_file_name'))
-        df = pd.read_hdf(pipeline_file_path, CHECKPOINT_TABLE_NAME)
+        with checkpoint_store.open_store(pipeline_file_path, mode='r') as store:
+            df = store.read(CHECKPOINT_TABLE_NAME)
 
     # non-table columns first (column order in df is random because created from a dict)
     table_names = [name for name in df.columns.values if name not in NON_TABLE_COLUMNS]
@@ -711,6 +1047,8 @@ def replace_table(table_name, df):
         raise RuntimeError("replace_table: dataframe '%s' has duplicate columns: %s" %
                            (table_name, df.columns[df.columns.duplicated()]))
 
+    df = compact.compact_df(df, table_name, trace_label='replace_table')
+
     rewrap(table_name, df)
 
     _PIPELINE.replaced_tables[table_name] = True
@@ -739,7 +1077,8 @@ def extend_table(table_name, df, axis=0):
             # don't expect indexes to overlap
             assert len(table_df.index.intersection(df.index)) == 0
             missing_df_str_columns = [c for c in table_df.columns
-                                      if c not in df.columns and table_df[c].dtype == 'O']
+                                      if c not in df.columns and
+                                      (table_df[c].dtype == 'O' or pd.api.types.is_categorical_dtype(table_df[c]))]
         else:
             # expect indexes be same
             assert table_df.index.equals(df.index)
@@ -752,6 +1091,8 @@ def extend_table(table_name, df, axis=0):
         # backfill missing df columns that were str (object) type in table_df
         if axis == 0:
             for c in missing_df_str_columns:
+                if pd.api.types.is_categorical_dtype(df[c]) and '' not in df[c].cat.categories:
+                    df[c] = df[c].cat.add_categories('')
                 df[c] = df[c].fillna('')
 
     replace_table(table_name, df)
@@ -789,6 +1130,8 @@ def drop_table(table_name):
 
         _PIPELINE.last_checkpoint[table_name] = ''
 
+    _PIPELINE.table_fingerprints.pop(table_name, None)
+
 
 def is_table(table_name):
     return orca.is_table(table_name)
@@ -37,6 +37,72 @@ def hash32(s):
     return int(h, base=16) & _SEED_MASK
 
 
+def sample_without_replacement(rands, n):
+    """
+    Sample size (= rands.shape[1]) of range(n) without replacement for each row of rands
+
+    Uses Robert Floyd's algorithm, vectorized over rows: the i-th sampled element of each row is
+    t = floor(rands[i] * (n - size + i + 1)), or n - size + i if t was already sampled. Each row
+    sample is a uniformly distributed subset of range(n), which only depends on the rands of that
+    row (so samples are deterministic per row under the channel seeding scheme). Unlike sampling
+    from a random permutation of range(n), only size rands and O(size) memory are needed per row.
+
+    Parameters
+    ----------
+    rands : 2-D ndarray
+        uniform random numbers in [0, 1), with one row per sample and one column per sampled element
+    n : int
+        number of elements to sample from
+
+    Returns
+    -------
+    samples : 2-D ndarray of int
+        array of the same shape as rands with distinct elements of range(n) in each row
+    """
+
+    num_rows, size = rands.shape
+    assert size <= n
+
+    samples = np.empty((num_rows, size), dtype=np.int64)
+    for i, j in enumerate(range(n - size, n)):
+        t = np.minimum((rands[:, i] * (j + 1)).astype(np.int64), j)
+        already_sampled = (samples[:, :i] == t[:, np.newaxis]).any(axis=1)
+        samples[:, i] = np.where(already_sampled, j, t)
+
+    return samples
+
+
+def choice_from_rands(rands, a, replace):
+    """
+    numpy.random.choice samples for each row of rands, using one rand per sampled element
+
+    Parameters
+    ----------
+    rands : 2-D ndarray
+        uniform random numbers in [0, 1), with one row per sample and one column per sampled element
+    a : 1-D array-like or int
+        If an ndarray, a random sample is generated from its elements.
+        If an int, the random sample is generated as if a was np.arange(n)
+    replace : boolean
+        Whether the sample is with or without replacement
+
+    Returns
+    -------
+    choices : 1-D ndarray of length: rands.size
+        The samples for each row concatenated into a single (flat) array
+    """
+
+    a = np.asanyarray(a)
+    n_a = int(a) if a.ndim == 0 else len(a)
+
+    if replace:
+        positions = np.minimum((rands * n_a).astype(np.int64), n_a - 1)
+    else:
+        positions = sample_without_replacement(rands, n_a)
+
+    return positions.flatten() if a.ndim == 0 else a[positions.flatten()]
+
+
 class SimpleChannel(object):
     """
 
@@ -79,6 +145,9 @@ class SimpleChannel(object):
         self.step_seed = None
         self.row_states = None
 
+        # sample choice_for_df choices from rands (see Random.set_vectorized_choice)
+        self.vectorized_choice = False
+
         # create dataframe to hold state for every df row
         self.extend_domain(domain_df)
         assert self.row_states.shape[0] == domain_df.shape[0]
@@ -320,6 +389,10 @@ class SimpleChannel(object):
         The columns in df are ignored; the index name and values are used to determine
         which random number sequence to to use.
 
+        If vectorized_choice, each row only draws size rands from its random stream (rather than
+        e.g. a permutation of all the elements of a) and the samples of all the rows are computed
+        from them at once (see choice_from_rands), which gives different samples than numpy choice.
+
         Parameters
         ----------
         df : pandas.DataFrame
@@ -350,7 +423,10 @@ class SimpleChannel(object):
         # initialize the generator iterator
         generators = self._generators_for_df(df)
 
-        sample = np.concatenate(tuple(prng.choice(a, size, replace) for prng in generators))
+        if self.vectorized_choice:
+            sample = choice_from_rands(np.asanyarray([prng.rand(size) for prng in generators]), a, replace)
+        else:
+            sample = np.concatenate(tuple(prng.choice(a, size, replace) for prng in generators))
 
         if not self.multi_choice_offset:
             # FIXME - if replace, should we estimate rands_consumed?
@@ -362,6 +438,211 @@ class SimpleChannel(object):
         return sample
 
 
+# Philox4x32 round multipliers and Weyl sequence key increments
+_PHILOX_M0 = np.uint64(0xD2511F53)
+_PHILOX_M1 = np.uint64(0xCD9E8D57)
+_PHILOX_W0 = 0x9E3779B9
+_PHILOX_W1 = 0xBB67AE85
+_PHILOX_ROUNDS = 10
+
+_UINT32_MASK = np.uint64(_SEED_MASK)
+_SHIFT32 = np.uint64(32)
+
+
+def philox4x32(counters, key, rounds=_PHILOX_ROUNDS):
+    """
+    Philox4x32 counter-based random number generator (Salmon et al., "Parallel random numbers:
+    as easy as 1, 2, 3", SC11) vectorized over numpy arrays of counters
+
+    Each distinct (counter, key) maps to four (statistically independent) random 32 bit words,
+    so random numbers for any number of streams and stream positions can be computed at once
+    without any generator state.
+
+    Parameters
+    ----------
+    counters : sequence of 4 numpy.ndarray of uint64
+        the four 32 bit words of each counter (all arrays of the same shape)
+    key : sequence of 2 int
+        the two 32 bit words of the key
+    rounds : int
+
+    Returns
+    -------
+    words : list of 4 numpy.ndarray of uint64
+        the four random 32 bit words for each counter
+    """
+
+    # (copies, since rounds are computed in place)
+    c0, c1, c2, c3 = [np.array(c, dtype=np.uint64, order='C') for c in counters]
+    k0, k1 = [int(k) & _SEED_MASK for k in key]
+
+    p0 = np.empty_like(c0)
+    p1 = np.empty_like(c0)
+    for _ in range(rounds):
+        np.multiply(c0, _PHILOX_M0, out=p0)
+        np.multiply(c2, _PHILOX_M1, out=p1)
+
+        # c0, c1, c2, c3 <- hi(p1) ^ c1 ^ k0, lo(p1), hi(p0) ^ c3 ^ k1, lo(p0)
+        np.right_shift(p1, _SHIFT32, out=c0)
+        c0 ^= c1
+        c0 ^= np.uint64(k0)
+        np.bitwise_and(p1, _UINT32_MASK, out=c1)
+        np.right_shift(p0, _SHIFT32, out=c2)
+        c2 ^= c3
+        c2 ^= np.uint64(k1)
+        np.bitwise_and(p0, _UINT32_MASK, out=c3)
+
+        k0 = (k0 + _PHILOX_W0) & _SEED_MASK
+        k1 = (k1 + _PHILOX_W1) & _SEED_MASK
+
+    return [c0, c1, c2, c3]
+
+
+def uniform_from_words(w0, w1):
+    """
+    doubles in [0, 1) from two random 32 bit words (53 random bits, like numpy random_sample)
+    """
+
+    return ((w0 >> np.uint64(5)) * np.uint64(67108864) + (w1 >> np.uint64(6))) / 9007199254740992.0
+
+
+class CounterChannel(SimpleChannel):
+    """
+    Channel that computes random numbers with a counter-based generator (see philox4x32)
+
+    SimpleChannel reseeds and fast-forwards a numpy RandomState for every row, which dominates the
+    cost of generating random numbers for large channels. Instead, the random numbers of every
+    row are the philox4x32 outputs of the counter (offset, row_id low word, row_id high word,
+    step_seed) with key (base_seed, channel_seed), so the random numbers for all df rows are
+    computed in a few vectorized numpy operations.
+
+    Streams are as repeatable as SimpleChannel streams (they only depend on the base seed, channel
+    name, step name, row id and the number of random numbers already drawn by the row in the step)
+    but distinct (base_seed, channel, row, step) streams never collide. The random numbers are
+    different from those of SimpleChannel.
+    """
+
+    def init_row_states_for_step(self, row_states):
+        """
+        initialize row states (in place) for new step
+
+        (row streams are identified by row_id and step_seed, so only the offsets need resetting)
+        """
+
+        assert self.step_name
+
+        if self.step_name and not row_states.empty:
+            # number of counters used this step
+            row_states['offset'] = 0
+
+        return row_states
+
+    def _words_for_df(self, df, n):
+        """
+        four random 32 bit words for each of the next n counters of each df row
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            dataframe with index values for which random streams are to be generated
+            and well-known index name corresponding to the channel
+        n : int
+            number of counters per row
+
+        Returns
+        -------
+        words : list of 4 numpy.ndarray of uint64 with shape (len(df), n)
+        """
+
+        # assert no dupes
+        assert len(df.index.unique()) == len(df.index)
+
+        offsets = self.row_states.loc[df.index, 'offset'].values.astype(np.uint64)
+        row_ids = df.index.values.astype(np.int64).astype(np.uint64)
+
+        counters = (offsets[:, np.newaxis] + np.arange(n, dtype=np.uint64),
+                    (row_ids & _UINT32_MASK)[:, np.newaxis],
+                    (row_ids >> _SHIFT32)[:, np.newaxis],
+                    np.uint64(self.step_seed))
+        counters = np.broadcast_arrays(*counters)
+
+        return philox4x32(counters, (self.base_seed, self.channel_seed))
+
+    def _advance(self, df, n):
+        # update offset for rows we handled
+        self.row_states.loc[df.index, 'offset'] += n
+
+    def random_for_df(self, df, step_name, n=1):
+        """
+        Return n floating point random numbers in range [0, 1) for each row in df
+        (see SimpleChannel.random_for_df)
+        """
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        w0, w1, _, _ = self._words_for_df(df, n)
+        rands = uniform_from_words(w0, w1)
+
+        self._advance(df, n)
+        return rands
+
+    def normal_for_df(self, df, step_name, mu, sigma, lognormal=False):
+        """
+        Return a floating point random number in normal (or lognormal) distribution
+        for each row in df (see SimpleChannel.normal_for_df)
+
+        Normal random numbers are computed with the Box-Muller transform of the two uniform random
+        numbers of the next counter of each row.
+        """
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        w0, w1, w2, w3 = [w[:, 0] for w in self._words_for_df(df, 1)]
+
+        # (1 - u is in (0, 1] so its log is finite)
+        radius = np.sqrt(-2.0 * np.log(1.0 - uniform_from_words(w0, w1)))
+        rands = radius * np.cos(2.0 * np.pi * uniform_from_words(w2, w3))
+
+        if isinstance(mu, pd.Series):
+            mu = mu.values
+        if isinstance(sigma, pd.Series):
+            sigma = sigma.values
+        rands = rands * sigma + mu
+
+        if lognormal:
+            rands = np.exp(rands)
+
+        self._advance(df, 1)
+        return rands
+
+    def choice_for_df(self, df, step_name, a, size, replace):
+        """
+        Apply numpy.random.choice once for each row in df (see SimpleChannel.choice_for_df)
+
+        Samples use one uniform random number per sampled element (see choice_from_rands).
+        """
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        w0, w1, _, _ = self._words_for_df(df, size)
+        sample = choice_from_rands(uniform_from_words(w0, w1), a, replace)
+
+        if not self.multi_choice_offset:
+            self._advance(df, size)
+
+        return sample
+
+
+# channel classes by rng_channel_type setting
+CHANNEL_TYPES = {
+    'simple': SimpleChannel,
+    'counter': CounterChannel,
+}
+
+
 class Random(object):
 
     def __init__(self):
@@ -374,6 +655,8 @@ class Random(object):
         self.step_name = None
         self.step_seed = None
         self.base_seed = 0
+        self.channel_type = 'simple'
+        self.vectorized_choice = False
         self.global_rng = np.random.RandomState()
 
     def get_channel_for_df(self, df):
@@ -471,11 +754,12 @@ class Random(object):
         else:
             logger.debug("Adding channel '%s' %s ids" % (channel_name, len(domain_df.index)))
 
-            channel = SimpleChannel(channel_name,
-                                    self.base_seed,
-                                    domain_df,
-                                    self.step_name
-                                    )
+            channel = CHANNEL_TYPES[self.channel_type](channel_name,
+                                                       self.base_seed,
+                                                       domain_df,
+                                                       self.step_name
+                                                       )
+            channel.vectorized_choice = self.vectorized_choice
 
             self.channels[channel_name] = channel
             self.index_to_channel[domain_df.index.name] = channel_name
@@ -527,6 +811,56 @@ class Random(object):
             logger.info("Set random seed base to %s" % seed)
             self.base_seed = seed
 
+    def set_channel_type(self, channel_type):
+        """
+        Select the channel implementation used to generate the random streams of channel rows
+
+        'simple' (the default) reseeds a numpy RandomState for every row (see SimpleChannel),
+        'counter' computes the random numbers of all rows at once with a counter-based generator
+        (see CounterChannel), which is much faster but generates different random numbers.
+
+        Must be called before first step (before any channels are added or rands are consumed)
+
+        Parameters
+        ----------
+        channel_type : str
+            'simple' or 'counter'
+        """
+
+        if self.step_name is not None or self.channels:
+            raise RuntimeError("Can only call set_channel_type before the first step.")
+
+        if channel_type not in CHANNEL_TYPES:
+            raise RuntimeError("Unknown random channel type '%s' (expected one of %s)" %
+                               (channel_type, list(CHANNEL_TYPES.keys())))
+
+        logger.info("Set random channel type to %s" % channel_type)
+        self.channel_type = channel_type
+
+    def set_vectorized_choice(self, vectorized_choice):
+        """
+        Sample choice_for_df choices of all rows at once from size rands per row
+
+        By default, simple channels call numpy choice for every row, which (when sampling without
+        replacement) draws a random permutation of all the elements of a for every row. If
+        vectorized_choice, rows only draw size rands from their (still per row, repeatable) random
+        streams and the samples are computed for all the rows at once (see choice_from_rands),
+        which is faster for large choice sets but gives different samples. (Counter channels
+        always sample this way.)
+
+        Must be called before first step (before any channels are added or rands are consumed)
+
+        Parameters
+        ----------
+        vectorized_choice : bool
+        """
+
+        if self.step_name is not None or self.channels:
+            raise RuntimeError("Can only call set_vectorized_choice before the first step.")
+
+        logger.info("Set random vectorized choice to %s" % vectorized_choice)
+        self.vectorized_choice = vectorized_choice
+
     def get_global_rng(self):
         """
         Return a numpy random number generator for use within current step.
@@ -20,6 +20,7 @@ from . import config
 from . import util
 from . import assign
 from . import chunk
+from . import spec_compiler
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +28,12 @@ SPEC_DESCRIPTION_NAME = 'Description'
 SPEC_EXPRESSION_NAME = 'Expression'
 SPEC_LABEL_NAME = 'Label'
 
+# choosers are only deduplicated if there are at most this many distinct profiles per chooser
+MAX_PROFILES_PER_CHOOSER = 0.5
+
+# trace labels of eval_utilities calls whose expression values and utilities are dumped to csv
+DUMP_EXPRESSION_VALUES_TRACE_LABELS = ['trip_mode_choice.simple_simulate.eval_nl']
+
 
 def random_rows(df, n):
 
@@ -125,9 +132,23 @@ def read_model_spec(file_name, spec_dir=None):
         spec = spec.set_index(SPEC_LABEL_NAME, append=True)
         assert isinstance(spec.index, pd.MultiIndex)
 
+    # parse and classify expressions once, rather than every time spec is evaluated
+    spec_compiler.compile_spec(spec_expressions(spec))
+
     return spec
 
 
+def spec_expressions(spec):
+    """
+    spec expressions (spec.index, or its expression level if spec has a Label level)
+    """
+
+    if isinstance(spec.index, pd.MultiIndex):
+        # spec MultiIndex with expression and label
+        return spec.index.get_level_values(SPEC_EXPRESSION_NAME)
+    return spec.index
+
+
 def read_model_coefficients(model_settings=None, file_name=None):
     """
     Read the coefficient file specified by COEFFICIENTS model setting
@@ -295,8 +316,44 @@ def eval_coefficients(spec, coefficients, estimator):
     return spec
 
 
+def eval_utilities_setting(key, default):
+    """
+    config.setting for the eval_utilities performance settings, falling back to default
+    when eval_utilities runs outside a configured pipeline (e.g. with no configs directory)
+    """
+
+    try:
+        return config.setting(key, default)
+    except RuntimeError as e:
+        logger.debug("eval_utilities_setting %s using default %s (%s)" % (key, default, e))
+        return default
+
+
+def utility_dtype():
+    """
+    dtype of expression values, coefficients, utilities and probabilities
+
+    float32 if the float32_utilities setting is True (halving the memory of the dominant
+    arrays of choice models, at the cost of precision), otherwise float64
+    """
+
+    return np.float32 if eval_utilities_setting('float32_utilities', False) else np.float64
+
+
+def dump_expression_values(trace_label):
+    """
+    True if eval_utilities should dump the expression values and utilities it computes for trace_label
+    (eval_utilities calls with trace labels listed in the dump_expression_values_trace_labels setting)
+    """
+
+    trace_labels = eval_utilities_setting('dump_expression_values_trace_labels',
+                                          DUMP_EXPRESSION_VALUES_TRACE_LABELS)
+
+    return trace_label is not None and trace_label in (trace_labels or [])
+
+
 def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
-                   have_trace_targets=False, estimator=None, alt_col_name=None):
+                   have_trace_targets=False, estimator=None, alt_col_name=None, dtype=None):
     """
 
     Parameters
@@ -313,6 +370,8 @@ def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
     have_trace_targets
     estimator :
         called to report intermediate table results (used for estimation)
+    dtype : numpy dtype, optional
+        dtype of expression values, coefficients and utilities (default utility_dtype())
 
     Returns
     -------
@@ -348,22 +407,28 @@ def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
 
     locals_dict['df'] = choosers
 
-    if isinstance(spec.index, pd.MultiIndex):
-        # spec MultiIndex with expression and label
-        exprs = spec.index.get_level_values(SPEC_EXPRESSION_NAME)
-    else:
-        exprs = spec.index
+    dtype = dtype or utility_dtype()
 
-    expression_values = np.empty((spec.shape[0], choosers.shape[0]))
-    for i, expr in enumerate(exprs):
-        try:
-            if expr.startswith('@'):
-                expression_values[i] = eval(expr[1:], globals_dict, locals_dict)
-            else:
-                expression_values[i] = choosers.eval(expr)
-        except Exception as err:
-            logger.exception("Variable evaluation failed for: %s" % str(expr))
-            raise err
+    compiled_spec = spec_compiler.compile_spec(spec_expressions(spec))
+    coefficients = spec.astype(dtype).values
+
+    # fused utilities don't materialize expression_values, which estimation and tracing need
+    # (as does the expression values dump below)
+    dump = dump_expression_values(trace_label)
+    fused = eval_utilities_setting('fused_utilities', False) and spec_compiler.numexpr is not None and \
+        not (estimator or have_trace_targets or dump)
+
+    utilities = None
+    if fused:
+        utilities = compiled_spec.fused_utilities(choosers, coefficients, locals_dict, globals_dict)
+
+    if utilities is not None:
+        utilities = pd.DataFrame(data=utilities.astype(dtype, copy=False), index=choosers.index,
+                                 columns=spec.columns)
+        t0 = tracing.print_elapsed_time(" eval_utilities (fused)", t0)
+        return utilities
+
+    expression_values = compiled_spec.expression_values(choosers, locals_dict, globals_dict, dtype=dtype)
 
     if estimator:
         df = pd.DataFrame(
@@ -374,11 +439,11 @@ def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
         estimator.write_expression_values(df)
 
     # - compute_utilities
-    utilities = np.dot(expression_values.transpose(), spec.astype(np.float64).values)
+    utilities = np.dot(expression_values.transpose(), coefficients)
     utilities = pd.DataFrame(data=utilities, index=choosers.index, columns=spec.columns)
     
     ##### print tables for Anna's team - INEXUS
-    if trace_label == 'trip_mode_choice.simple_simulate.eval_nl':
+    if dump:
 #         print(orca.list_tables())
         
         raw = pd.DataFrame(data = expression_values.transpose(), index = choosers.index)
@@ -565,20 +630,15 @@ def eval_variables(exprs, df, locals_d=None):
 
         return a
 
+    compiled_spec = spec_compiler.compile_spec(exprs)
+    column_arrays = spec_compiler.ColumnArrays(df)
+
     values = OrderedDict()
-    for expr in exprs:
-        try:
-            if expr.startswith('@'):
-                expr_values = to_array(eval(expr[1:], globals_dict, locals_dict))
-            else:
-                expr_values = to_array(df.eval(expr))
-            # read model spec should ensure uniqueness, otherwise we should uniquify
-            assert expr not in values
-            values[expr] = expr_values
-        except Exception as err:
-            logger.exception("Variable evaluation failed for: %s" % str(expr))
-
-            raise err
+    for i, expr in enumerate(exprs):
+        expr_values = to_array(compiled_spec.eval_expression(i, df, locals_dict, globals_dict, column_arrays))
+        # read model spec should ensure uniqueness, otherwise we should uniquify
+        assert expr not in values
+        values[expr] = expr_values
 
     values = util.df_from_dict(values, index=df.index)
 
@@ -680,7 +740,7 @@ def _check_for_variability(expression_values, trace_label):
         logger.warning("%s: %s columns have missing values" % (trace_label, has_missing_vals))
 
 
-def compute_nested_exp_utilities(raw_utilities, nest_spec):
+def compute_nested_exp_utilities(raw_utilities, nest_spec, shift=None):
     """
     compute exponentiated nest utilities based on nesting coefficients
 
@@ -696,37 +756,21 @@ def compute_nested_exp_utilities(raw_utilities, nest_spec):
         (what in non-nested logit would be the utilities of all the alternatives)
     nest_spec : dict
         Nest tree dict from the model spec yaml file
+    shift : numpy.ndarray, optional
+        per row shift of raw utilities (see logit.utility_shift) for single precision utilities,
+        which scales all the exponentiated utilities of each nest level by the same factor
+        (so probabilities are unchanged and the root logsum is shifted by shift)
 
     Returns
     -------
     nested_utilities : pandas.DataFrame
         Will have the index of `raw_utilities` and columns for exponentiated leaf and node utilities
     """
-    nested_utilities = pd.DataFrame(index=raw_utilities.index)
-
-    for nest in logit.each_nest(nest_spec, post_order=True):
-
-        name = nest.name
-
-        if nest.is_leaf:
-            # leaf_utility = raw_utility / nest.product_of_coefficients
-            nested_utilities[name] = \
-                raw_utilities[name].astype(float) / nest.product_of_coefficients
 
-        else:
-            # nest node
-            # the alternative nested_utilities will already have been computed due to post_order
-            # this will RuntimeWarning: divide by zero encountered in log
-            # if all nest alternative utilities are zero
-            # but the resulting inf will become 0 when exp is applied below
-            with np.errstate(divide='ignore'):
-                nested_utilities[name] = \
-                    nest.coefficient * np.log(nested_utilities[nest.alternatives].sum(axis=1))
-
-        # exponentiate the utility
-        nested_utilities[name] = np.exp(nested_utilities[name])
+    tree = logit.nest_tree(nest_spec, raw_utilities.columns)
 
-    return nested_utilities
+    return pd.DataFrame(tree.exp_utilities(raw_utilities.values, shift),
+                        index=raw_utilities.index, columns=tree.names)
 
 
 def compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label):
@@ -749,18 +793,15 @@ def compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label):
         Will have the index of `nested_exp_utilities` and columns for leaf and node probabilities
     """
 
-    nested_probabilities = pd.DataFrame(index=nested_exp_utilities.index)
-
-    for nest in logit.each_nest(nest_spec, type='node', post_order=False):
-
-        probs = logit.utils_to_probs(nested_exp_utilities[nest.alternatives],
-                                     trace_label=trace_label,
-                                     exponentiated=True,
-                                     allow_zero_probs=True)
+    tree = logit.nest_tree(nest_spec, [nest.name for nest in logit.each_nest(nest_spec, type='leaf')])
 
-        nested_probabilities = pd.concat([nested_probabilities, probs], axis=1)
+    nested_probabilities = tree.nested_probabilities(nested_exp_utilities[tree.names].values,
+                                                     index=nested_exp_utilities.index,
+                                                     trace_label=trace_label)
 
-    return nested_probabilities
+    # root has no nested probability column
+    return pd.DataFrame(nested_probabilities[:, 1:], index=nested_exp_utilities.index,
+                        columns=tree.names[1:])
 
 
 def compute_base_probabilities(nested_probabilities, nests, spec):
@@ -784,21 +825,116 @@ def compute_base_probabilities(nested_probabilities, nests, spec):
         Will have the index of `nested_probabilities` and columns for leaf base probabilities
     """
 
-    base_probabilities = pd.DataFrame(index=nested_probabilities.index)
+    # alternative columns in spec order
+    # since these are alternatives chosen by column index, order of columns matters
+    tree = logit.nest_tree(nests, spec.columns)
 
-    for nest in logit.each_nest(nests, type='leaf', post_order=False):
+    probs = np.empty((len(nested_probabilities.index), len(tree.names)), dtype=nested_probabilities.values.dtype)
+    probs[:, 0] = 1.0
+    probs[:, 1:] = nested_probabilities[tree.names[1:]].values
 
-        # skip root: it has a prob of 1 but we didn't compute a nested probability column for it
-        ancestors = nest.ancestors[1:]
+    return pd.DataFrame(tree.base_probabilities(probs), index=nested_probabilities.index, columns=spec.columns)
 
-        base_probabilities[nest.name] = nested_probabilities[ancestors].prod(axis=1)
 
-    # reorder alternative columns to match spec
-    # since these are alternatives chosen by column index, order of columns matters
-    assert(set(base_probabilities.columns) == set(spec.columns))
-    base_probabilities = base_probabilities[spec.columns]
+def chooser_profiles(spec, choosers, locals_d=None, trace_label=None, deduplicate=True):
+    """
+    Group choosers into distinct profiles of the chooser columns that spec expressions reference
+
+    Choosers with the same values in every referenced column have the same utilities (and
+    probabilities), so these only need to be computed once per profile and can then be expanded
+    back to choosers (e.g. before make_choices, which draws each chooser's own random number).
 
-    return base_probabilities
+    Choosers are only deduplicated if deduplicate is True (callers in the pipeline pass the
+    deduplicate_choosers setting), every spec expression is a simple column expression or an
+    '@' python expression that only combines df columns of the same row
+    (see spec_compiler.CompiledExpression.column_dependencies) without skim lookups,
+    and there are at most MAX_PROFILES_PER_CHOOSER profiles per chooser.
+
+    Parameters
+    ----------
+    spec : pandas.DataFrame
+        simple simulate spec
+    choosers : pandas.DataFrame
+    locals_d : Dict or None
+        locals the spec expressions will be evaluated with
+    trace_label : str
+    deduplicate : bool
+        False to never deduplicate choosers
+
+    Returns
+    -------
+    profiles : pandas.DataFrame or None
+        first chooser (row) of each profile, or None if choosers are not deduplicated
+    profile_of_chooser : numpy.ndarray or None
+        position in profiles of the profile of each chooser
+    """
+
+    if not deduplicate or len(choosers.index) < 2:
+        return None, None
+
+    locals_dict = assign.local_utilities()
+    if locals_d is not None:
+        locals_dict.update(locals_d)
+
+    columns = set()
+    for e in spec_compiler.compile_spec(spec_expressions(spec)).exprs:
+        expr_columns, uses_skims = e.column_dependencies(locals_dict)
+        if expr_columns is None or uses_skims:
+            return None, None
+        columns |= expr_columns
+
+    if not columns.issubset(choosers.columns):
+        return None, None
+
+    # combine the factorized codes of each column into a code per distinct profile
+    profile_codes = np.zeros(len(choosers.index), dtype=np.int64)
+    for c in sorted(columns):
+        codes, uniques = pd.factorize(choosers[c])
+        profile_codes, _ = pd.factorize(profile_codes * (len(uniques) + 1) + (codes + 1))
+
+    # (factorize codes are in order of first appearance)
+    profile_of_chooser, uniques = pd.factorize(profile_codes)
+
+    logger.debug("%s: %s distinct profiles of %s choosers" %
+                 (trace_label, len(uniques), len(choosers.index)))
+
+    if len(uniques) > len(choosers.index) * MAX_PROFILES_PER_CHOOSER:
+        return None, None
+
+    first_choosers = np.unique(profile_of_chooser, return_index=True)[1]
+
+    return choosers.iloc[first_choosers], profile_of_chooser
+
+
+def expand_profiles(values, profile_of_chooser, index, columns=None):
+    """
+    Expand per profile values (see chooser_profiles) back to choosers
+
+    Parameters
+    ----------
+    values : pandas.DataFrame, pandas.Series or numpy.ndarray
+        one row per profile
+    profile_of_chooser : numpy.ndarray
+    index : pandas.Index
+        choosers index
+    columns : list, optional
+        columns of values if values is a 2-D numpy.ndarray
+
+    Returns
+    -------
+    expanded : pandas.DataFrame or pandas.Series
+        with one row per chooser
+    """
+
+    if isinstance(values, pd.DataFrame):
+        columns = values.columns
+
+    values = np.asanyarray(values)[profile_of_chooser]
+
+    if values.ndim == 1:
+        return pd.Series(values, index=index)
+
+    return pd.DataFrame(values, index=index, columns=columns)
 
 
 def eval_mnl(choosers, spec, locals_d, custom_chooser, estimator,
@@ -852,7 +988,13 @@ def eval_mnl(choosers, spec, locals_d, custom_chooser, estimator,
     if have_trace_targets:
         tracing.trace_df(choosers, '%s.choosers' % trace_label)
 
-    utilities = eval_utilities(spec, choosers, locals_d,
+    # utilities and probabilities of distinct chooser profiles (traced and estimated per chooser)
+    profiles, profile_of_chooser = (None, None) if (have_trace_targets or estimator) else \
+        chooser_profiles(spec, choosers, locals_d, trace_label,
+                         deduplicate=config.setting('deduplicate_choosers', True))
+    utility_choosers = choosers if profiles is None else profiles
+
+    utilities = eval_utilities(spec, utility_choosers, locals_d,
                                trace_label=trace_label, have_trace_targets=have_trace_targets,
                                estimator=estimator)
     chunk.log_df(trace_label, "utilities", utilities)
@@ -861,7 +1003,10 @@ def eval_mnl(choosers, spec, locals_d, custom_chooser, estimator,
         tracing.trace_df(utilities, '%s.utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
 
-    probs = logit.utils_to_probs(utilities, trace_label=trace_label, trace_choosers=choosers)
+    probs = logit.utils_to_probs(utilities, trace_label=trace_label, trace_choosers=utility_choosers)
+
+    if profiles is not None:
+        probs = expand_profiles(probs, profile_of_chooser, choosers.index)
     chunk.log_df(trace_label, "probs", probs)
 
     del utilities
@@ -936,7 +1081,13 @@ def eval_nl(choosers, spec, nest_spec, locals_d, custom_chooser, estimator,
     if have_trace_targets:
         tracing.trace_df(choosers, '%s.choosers' % trace_label)
 
-    raw_utilities = eval_utilities(spec, choosers, locals_d,
+    # utilities and probabilities of distinct chooser profiles (traced and estimated per chooser)
+    profiles, profile_of_chooser = (None, None) if (have_trace_targets or estimator) else \
+        chooser_profiles(spec, choosers, locals_d, trace_label,
+                         deduplicate=config.setting('deduplicate_choosers', True))
+    utility_choosers = choosers if profiles is None else profiles
+
+    raw_utilities = eval_utilities(spec, utility_choosers, locals_d,
                                    trace_label=trace_label, have_trace_targets=have_trace_targets,
                                    estimator=estimator)
     chunk.log_df(trace_label, "raw_utilities", raw_utilities)
@@ -945,36 +1096,52 @@ def eval_nl(choosers, spec, nest_spec, locals_d, custom_chooser, estimator,
         tracing.trace_df(raw_utilities, '%s.raw_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
 
+    # nest tree compiled into index arrays (alternatives in spec column order)
+    tree = logit.nest_tree(nest_spec, spec.columns)
+
     # exponentiated utilities of leaves and nests
-    nested_exp_utilities = compute_nested_exp_utilities(raw_utilities, nest_spec)
+    shift = logit.utility_shift(raw_utilities.values)
+    nested_exp_utilities = tree.exp_utilities(raw_utilities.values, shift)
     chunk.log_df(trace_label, "nested_exp_utilities", nested_exp_utilities)
 
     del raw_utilities
     chunk.log_df(trace_label, 'raw_utilities', None)
 
     if have_trace_targets:
-        tracing.trace_df(nested_exp_utilities, '%s.nested_exp_utilities' % trace_label,
+        tracing.trace_df(pd.DataFrame(nested_exp_utilities, index=choosers.index, columns=tree.names),
+                         '%s.nested_exp_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
 
     # probabilities of alternatives relative to siblings sharing the same nest
     nested_probabilities = \
-        compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label=trace_label)
+        tree.nested_probabilities(nested_exp_utilities, index=utility_choosers.index, trace_label=trace_label)
     chunk.log_df(trace_label, "nested_probabilities", nested_probabilities)
 
     if want_logsums:
         # logsum of nest root
-        logsums = pd.Series(np.log(nested_exp_utilities.root), index=choosers.index)
+        logsums = tree.logsums(nested_exp_utilities, shift)
+        if profiles is None:
+            logsums = pd.Series(logsums, index=choosers.index)
+        else:
+            logsums = expand_profiles(logsums, profile_of_chooser, choosers.index)
         chunk.log_df(trace_label, "logsums", logsums)
 
     del nested_exp_utilities
     chunk.log_df(trace_label, 'nested_exp_utilities', None)
 
     if have_trace_targets:
-        tracing.trace_df(nested_probabilities, '%s.nested_probabilities' % trace_label,
+        tracing.trace_df(pd.DataFrame(nested_probabilities[:, 1:], index=choosers.index,
+                                      columns=tree.names[1:]),
+                         '%s.nested_probabilities' % trace_label,
                          column_labels=['alternative', 'probability'])
 
     # global (flattened) leaf probabilities based on relative nest coefficients (in spec order)
-    base_probabilities = compute_base_probabilities(nested_probabilities, nest_spec, spec)
+    base_probabilities = tree.base_probabilities(nested_probabilities)
+    if profiles is None:
+        base_probabilities = pd.DataFrame(base_probabilities, index=choosers.index, columns=spec.columns)
+    else:
+        base_probabilities = expand_profiles(base_probabilities, profile_of_chooser, choosers.index,
+                                             columns=spec.columns)
     chunk.log_df(trace_label, "base_probabilities", base_probabilities)
 
     del nested_probabilities
@@ -1074,6 +1241,10 @@ def _simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None,
     if skims is not None:
         set_skim_wrapper_targets(choosers, skims)
 
+    if config.setting('validate_float32_utilities', False) and not estimator:
+        comparison = compare_utility_precision(choosers, spec, nest_spec, locals_d, trace_label=trace_label)
+        logger.info("%s float32 utilities validation\n%s" % (trace_label, comparison.to_string()))
+
     if nest_spec is None:
         choices = eval_mnl(choosers, spec, locals_d, custom_chooser,
                            want_logsums=want_logsums,
@@ -1115,6 +1286,10 @@ def simple_simulate_rpc(chunk_size, choosers, spec, nest_spec, trace_label):
 
         # logger.debug("%s #chunk_calc nest_count %s" % (trace_label, nest_count))
 
+    if utility_dtype() == np.float32:
+        # single precision extra columns take half the memory of (float64) chooser columns
+        extra_columns = (extra_columns + 1) // 2
+
     row_size = chooser_row_size + extra_columns
 
     # logger.debug("%s #chunk_calc choosers %s" % (trace_label, choosers.shape))
@@ -1144,7 +1319,7 @@ def simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None,
 
     result_list = []
     # segment by person type and pick the right spec for each person type
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label=trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
@@ -1175,6 +1350,78 @@ def simple_simulate(choosers, spec, nest_spec, skims=None, locals_d=None,
     return choices
 
 
+def _probs_and_logsums(choosers, spec, nest_spec, locals_d, dtype, trace_label):
+    """
+    probabilities and logsums of simple simulate choosers with utilities of dtype
+    """
+
+    utilities = eval_utilities(spec, choosers, locals_d, trace_label=trace_label, dtype=dtype)
+
+    if nest_spec is None:
+        probs = logit.utils_to_probs(utilities, trace_label=trace_label, allow_zero_probs=True).values
+        logsums = logit.utils_to_logsums(utilities).values
+    else:
+        tree = logit.nest_tree(nest_spec, spec.columns)
+        shift = logit.utility_shift(utilities.values)
+        nested_exp_utilities = tree.exp_utilities(utilities.values, shift)
+        logsums = tree.logsums(nested_exp_utilities, shift)
+        probs = tree.base_probabilities(
+            tree.nested_probabilities(nested_exp_utilities, index=choosers.index, trace_label=trace_label))
+
+    return probs, logsums
+
+
+def compare_utility_precision(choosers, spec, nest_spec, locals_d=None, seed=0, trace_label=None):
+    """
+    Validation harness for the float32_utilities setting
+
+    Compute the probabilities and logsums of simple simulate choosers with both double and single
+    precision utilities, and compare them and the choices made with the same random numbers.
+
+    The random numbers are drawn from a RandomState seeded with seed (rather than from the pipeline
+    random number channels) so that validation doesn't alter the random numbers of the run itself.
+
+    Parameters
+    ----------
+    choosers : pandas.DataFrame
+    spec : pandas.DataFrame
+    nest_spec : dict or None
+        nest spec for nested logit, None for multinomial logit
+    locals_d : Dict or None
+    seed : int
+    trace_label : str
+
+    Returns
+    -------
+    comparison : pandas.Series
+        number of choosers, number and share of choosers whose choices differ,
+        and max absolute differences of probabilities and logsums
+    """
+
+    trace_label = tracing.extend_trace_label(trace_label, 'compare_utility_precision')
+
+    rands = np.random.RandomState(seed).rand(len(choosers.index), 1)
+
+    results = []
+    for dtype in (np.float64, np.float32):
+        probs, logsums = _probs_and_logsums(choosers, spec, nest_spec, locals_d, dtype, trace_label)
+        choices = np.argmax((probs.cumsum(axis=1) - rands) > 0.0, axis=1)
+        results.append((probs, logsums, choices))
+
+    (probs64, logsums64, choices64), (probs32, logsums32, choices32) = results
+
+    finite = np.isfinite(logsums64) & np.isfinite(logsums32)
+    differing_choices = np.count_nonzero(choices64 != choices32)
+
+    return pd.Series(OrderedDict([
+        ('choosers', len(choosers.index)),
+        ('differing_choices', differing_choices),
+        ('differing_choice_share', differing_choices / max(len(choosers.index), 1)),
+        ('max_prob_difference', np.abs(probs64 - probs32).max(initial=0.0)),
+        ('max_logsum_difference', np.abs(logsums64 - logsums32)[finite].max(initial=0.0)),
+    ]))
+
+
 def eval_mnl_logsums(choosers, spec, locals_d, trace_label=None):
     """
     like eval_nl except return logsums instead of making choices
@@ -1246,19 +1493,22 @@ def eval_nl_logsums(choosers, spec, nest_spec, locals_d, trace_label=None, alt_c
                          column_labels=['alternative', 'utility'])
 
     # - exponentiated utilities of leaves and nests
-    nested_exp_utilities = compute_nested_exp_utilities(raw_utilities, nest_spec)
+    tree = logit.nest_tree(nest_spec, raw_utilities.columns)
+    shift = logit.utility_shift(raw_utilities.values)
+    nested_exp_utilities = tree.exp_utilities(raw_utilities.values, shift)
     chunk.log_df(trace_label, "nested_exp_utilities", nested_exp_utilities)
 
     del raw_utilities  # done with raw_utilities
     chunk.log_df(trace_label, 'raw_utilities', None)
 
     # - logsums
-    logsums = np.log(nested_exp_utilities.root)
+    logsums = tree.logsums(nested_exp_utilities, shift)
     logsums = pd.Series(logsums, index=choosers.index)
     chunk.log_df(trace_label, "logsums", logsums)
 
     if have_trace_targets:
         # add logsum to nested_exp_utilities for tracing
+        nested_exp_utilities = pd.DataFrame(nested_exp_utilities, index=choosers.index, columns=tree.names)
         nested_exp_utilities['logsum'] = logsums
         tracing.trace_df(nested_exp_utilities, '%s.nested_exp_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
@@ -1349,7 +1599,7 @@ def simple_simulate_logsums(choosers, spec, nest_spec,
 
     result_list = []
     # segment by person type and pick the right spec for each person type
-    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk):
+    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label=trace_label):
 
         logger.info("Running chunk %s of %s size %d" % (i, num_chunks, len(chooser_chunk)))
 
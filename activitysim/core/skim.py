@@ -17,18 +17,66 @@ from activitysim.core.util import quick_loc_series
 logger = logging.getLogger(__name__)
 
 
+def dequantize(values, quantization, dtype=np.float32):
+    """
+    convert quantized (low precision) skim values back to skim dtype
+
+    Parameters
+    ----------
+    values : numpy array
+        values gathered from a quantized skim (storage dtype float16, int16 or uint8)
+    quantization : dict
+        {'dtype': <storage dtype>, 'scale': <float>, 'offset': <float>}
+        as built by abm.tables.skims.get_skim_info
+    dtype : numpy dtype
+        nominal dtype of skim values
+
+    Returns
+    -------
+    values : numpy array of dtype
+        values * scale + offset
+    """
+
+    values = np.asanyarray(values).astype(dtype)
+
+    scale = quantization.get('scale', 1)
+    offset = quantization.get('offset', 0)
+
+    if scale != 1:
+        values *= scale
+    if offset != 0:
+        values += offset
+
+    return values
+
+
 class OffsetMapper(object):
     """
     Utility to map skim zone ids to ordinal offsets (e.g. numpy array indices)
 
     Can map either by a fixed offset (e.g. -1 to map 1-based to 0-based)
     or by an explicit mapping of zone id to offset (slower but more flexible)
+
+    Explicit mappings of integer zone ids are looked up with numpy, either in a dense array
+    of offsets indexed by zone id (if the zone ids are not too sparse) or by searchsorted
+    over the sorted zone ids (e.g. for H3 or block-level ids)
     """
 
+    # use dense offsets array if zone id range is no more than this many times the number of zones
+    MAX_DENSE_OFFSETS_RATIO = 8
+
     def __init__(self, offset_int=None):
         self.offset_series = None
         self.offset_int = offset_int
 
+        # dense int32 array of offsets indexed by zone_id - dense_offsets_base (-1 for ids not in skim)
+        self.dense_offsets = None
+        self.dense_offsets_base = None
+
+        # sorted zone ids and corresponding offsets (for searchsorted)
+        self.sorted_zone_ids = None
+        self.sorted_offsets = None
+
     def set_offset_list(self, offset_list):
         """
         Specify the zone ids corresponding to the offsets (ordinal positions)
@@ -54,10 +102,34 @@ class OffsetMapper(object):
 
         if self.offset_series is None:
             self.offset_series = pd.Series(data=list(range(len(offset_list))), index=offset_list)
+            self._init_offset_arrays(np.asanyarray(offset_list))
         else:
             # make sure it offsets are the same
             assert (offset_list == self.offset_series.index).all()
 
+    def _init_offset_arrays(self, zone_ids):
+        """
+        build numpy lookup arrays for mapping integer zone_ids to offsets
+        """
+
+        if not np.issubdtype(zone_ids.dtype, np.integer):
+            # non-integer zone ids will be mapped using offset_series
+            return
+
+        offsets = np.arange(len(zone_ids), dtype=np.int32)
+
+        min_id = zone_ids.min()
+        id_range = int(zone_ids.max()) - int(min_id) + 1
+
+        if id_range <= self.MAX_DENSE_OFFSETS_RATIO * len(zone_ids):
+            self.dense_offsets_base = min_id
+            self.dense_offsets = np.full(id_range, -1, dtype=np.int32)
+            self.dense_offsets[zone_ids - min_id] = offsets
+        else:
+            sort_order = np.argsort(zone_ids, kind='stable')
+            self.sorted_zone_ids = zone_ids[sort_order]
+            self.sorted_offsets = offsets[sort_order]
+
     def set_offset_int(self, offset_int):
         """
         specify fixed offset (e.g. -1 to map 1-based to 0-based)
@@ -95,7 +167,25 @@ class OffsetMapper(object):
         if self.offset_series is not None:
             assert(self.offset_int is None)
             assert isinstance(self.offset_series, pd.Series)
-            offsets = np.asanyarray(quick_loc_series(zone_ids, self.offset_series).fillna(NOT_IN_SKIM).astype(int))
+
+            ids = np.asanyarray(zone_ids)
+
+            if self.dense_offsets is not None and np.issubdtype(ids.dtype, np.integer):
+                ids = ids - self.dense_offsets_base
+                in_range = (ids >= 0) & (ids < len(self.dense_offsets))
+                if in_range.all():
+                    offsets = self.dense_offsets.take(ids)
+                else:
+                    offsets = np.where(in_range, self.dense_offsets.take(np.where(in_range, ids, 0)), NOT_IN_SKIM)
+
+            elif self.sorted_zone_ids is not None and np.issubdtype(ids.dtype, np.integer):
+                positions = np.searchsorted(self.sorted_zone_ids, ids)
+                positions = np.minimum(positions, len(self.sorted_zone_ids) - 1)
+                found = self.sorted_zone_ids.take(positions) == ids
+                offsets = np.where(found, self.sorted_offsets.take(positions), NOT_IN_SKIM)
+
+            else:
+                offsets = np.asanyarray(quick_loc_series(zone_ids, self.offset_series).fillna(NOT_IN_SKIM).astype(int))
 
         elif self.offset_int:
             assert (self.offset_series is None)
@@ -118,12 +208,15 @@ class SkimWrapper(object):
         values to turn them into array indices.
         For example, if zone IDs are 1-based, an offset of -1
         would turn them into 0-based array indices.
+    quantization : dict, optional
+        if data is stored in low precision, quantization info used to dequantize the gathered values
 
     """
-    def __init__(self, data, offset_mapper=None):
+    def __init__(self, data, offset_mapper=None, quantization=None):
 
         self.data = data
         self.offset_mapper = offset_mapper if offset_mapper is not None else OffsetMapper()
+        self.quantization = quantization
 
     def get(self, orig, dest):
         """
@@ -151,6 +244,9 @@ class SkimWrapper(object):
         mapped_dest = self.offset_mapper.map(dest)
         result = self.data[mapped_orig, mapped_dest]
 
+        if self.quantization:
+            result = dequantize(result, self.quantization)
+
         # FIXME - should return nan if not in skim (negative indices wrap around)
         # NOT_IN_SKIM = np.nan
         # in_skim = \
@@ -178,10 +274,157 @@ class SkimDict(object):
         self.offset_mapper = OffsetMapper()
         self.usage = set()
 
+        # skim_data blocks reshaped to (num_od_pairs, block_size) for lookups by flattened od index
+        self._block_rows = {}
+
     def touch(self, key):
 
         self.usage.add(key)
 
+    def od_index(self, orig, dest):
+        """
+        map origin and destination zone ids to flattened od index into skim matrices
+
+        Wrappers compute this once per df and reuse it for every skim key they look up.
+
+        Parameters
+        ----------
+        orig : 1D array-like of origin zone ids
+        dest : 1D array-like of destination zone ids
+
+        Returns
+        -------
+        od_index : numpy array of int
+            mapped_orig * num_dest_zones + mapped_dest
+        """
+
+        # fixme - remove?
+        assert not (np.isnan(orig) | np.isnan(dest)).any()
+
+        mapped_orig = np.asanyarray(self.offset_mapper.map(np.asanyarray(orig).astype(int)), dtype=np.int64)
+        mapped_dest = np.asanyarray(self.offset_mapper.map(np.asanyarray(dest).astype(int)), dtype=np.int64)
+
+        # zone ids not in skim are mapped to NOT_IN_SKIM (-1), which in the flattened index would read
+        # the last cell of the previous origin row, so wrap them to the last zone as data[orig, dest] does
+        num_dest_zones = self.num_dest_zones
+        not_in_skim = mapped_dest < 0
+        if not_in_skim.any():
+            mapped_dest = np.where(not_in_skim, mapped_dest + num_dest_zones, mapped_dest)
+        not_in_skim = mapped_orig < 0
+        if not_in_skim.any():
+            mapped_orig = np.where(not_in_skim, mapped_orig + self.skim_data[0].shape[0], mapped_orig)
+
+        return mapped_orig * num_dest_zones + mapped_dest
+
+    @property
+    def num_dest_zones(self):
+        return self.skim_data[0].shape[1]
+
+    def block_rows(self, block):
+        """
+        skim_data block as 2D (num_od_pairs, block_size) view, for lookups by flattened od index
+        """
+
+        block_rows = self._block_rows.get(block)
+        if block_rows is None:
+            block_data = self.skim_data[block]
+            block_rows = block_data.reshape(-1, block_data.shape[2])
+            self._block_rows[block] = block_rows
+
+        return block_rows
+
+    def gather(self, block, od_index, offsets):
+        """
+        gather skim values from block at flattened od index and block offsets (broadcast against each other)
+
+        Parameters
+        ----------
+        block : int
+        od_index : numpy array of int
+        offsets : int or numpy array of int
+
+        Returns
+        -------
+        values : numpy array (in block storage dtype)
+        """
+        return self.block_rows(block)[od_index, offsets]
+
+    def lookup_od(self, key, od_index):
+        """
+        lookup skim values for key by flattened od index (see od_index)
+
+        Parameters
+        ----------
+        key : hashable
+        od_index : numpy array of int
+
+        Returns
+        -------
+        values : numpy array
+        """
+
+        assert key in self.skim_info['block_offsets'], "SkimDict key %s missing" % (key, )
+
+        block, offset = self.skim_info['block_offsets'][key]
+
+        self.touch(key)
+
+        result = self.gather(block, od_index, offset)
+
+        quantization = self.quantization(key)
+        if quantization:
+            result = dequantize(result, quantization)
+
+        return result
+
+    def lookup_od_many(self, keys, od_index):
+        """
+        lookup skim values for several keys by flattened od index, with one gather per skim block
+
+        Parameters
+        ----------
+        keys : list of hashable
+        od_index : numpy array of int
+
+        Returns
+        -------
+        values : OrderedDict {<key>: numpy array}
+        """
+
+        block_offsets = self.skim_info['block_offsets']
+
+        keys_by_block = OrderedDict()
+        for key in keys:
+            assert key in block_offsets, "SkimDict key %s missing" % (key, )
+            keys_by_block.setdefault(block_offsets[key][0], []).append(key)
+
+        values = {}
+        for block, block_keys in keys_by_block.items():
+
+            offsets = np.array([block_offsets[key][1] for key in block_keys])
+            block_values = self.gather(block, od_index[:, np.newaxis], offsets[np.newaxis, :])
+
+            for i, key in enumerate(block_keys):
+                self.touch(key)
+                quantization = self.quantization(key)
+                values[key] = \
+                    dequantize(block_values[:, i], quantization) if quantization else block_values[:, i]
+
+        return OrderedDict([(key, values[key]) for key in keys])
+
+    def quantization(self, key):
+        """
+        quantization info for key (or None if key is stored at full precision)
+
+        Parameters
+        ----------
+        key : str or tuple of two strings
+            quantization is specified by key1, so all time period subkeys of key1 share it
+        """
+
+        key1 = key[0] if isinstance(key, tuple) else key
+        return self.skim_info.get('quantization', {}).get(key1)
+
     def get(self, key):
         """
         Get an available wrapped skim object (not the lookup)
@@ -197,6 +440,8 @@ class SkimDict(object):
              The skim object
         """
 
+        assert key in self.skim_info['block_offsets'], "SkimDict key %s missing" % (key, )
+
         block, offset = self.skim_info['block_offsets'].get(key)
         block_data = self.skim_data[block]
 
@@ -204,7 +449,7 @@ class SkimDict(object):
 
         data = block_data[:, :, offset]
 
-        return SkimWrapper(data, self.offset_mapper)
+        return SkimWrapper(data, self.offset_mapper, self.quantization(key))
 
     def wrap(self, left_key, right_key):
         """
@@ -242,6 +487,10 @@ class SkimDictWrapper(object):
         self.right_key = right_key
         self.df = None
 
+        # flattened o-d and d-o indexes into skims, computed once per df (on first lookup)
+        self.od_index = None
+        self.do_index = None
+
     def set_df(self, df):
         """
         Set the dataframe
@@ -256,6 +505,24 @@ class SkimDictWrapper(object):
         Nothing
         """
         self.df = df
+        self.od_index = None
+        self.do_index = None
+
+    def get_od_index(self, reverse=False):
+        """
+        flattened od (or do if reverse) index for df, memoized across skim keys
+        """
+
+        assert self.df is not None, "Call set_df first"
+
+        if reverse:
+            if self.do_index is None:
+                self.do_index = self.skim_dict.od_index(self.df[self.right_key], self.df[self.left_key])
+            return self.do_index
+        else:
+            if self.od_index is None:
+                self.od_index = self.skim_dict.od_index(self.df[self.left_key], self.df[self.right_key])
+            return self.od_index
 
     def lookup(self, key, reverse=False):
         """
@@ -277,25 +544,30 @@ class SkimDictWrapper(object):
             with the same index as df
         """
 
-        # The skim object to perform the lookup
         # using df[left_key] as the origin and df[right_key] as the destination
-        skim = self.skim_dict.get(key)
+        s = self.skim_dict.lookup_od(key, self.get_od_index(reverse))
 
-        # assert self.df is not None, "Call set_df first"
-        # origins = self.df[self.left_key].astype('int')
-        # destinations = self.df[self.right_key].astype('int')
-        # if self.offset:
-        #     origins = origins + self.offset
-        #     destinations = destinations + self.offset
+        return pd.Series(s, index=self.df.index)
 
-        assert self.df is not None, "Call set_df first"
+    def lookup_many(self, keys, reverse=False):
+        """
+        lookup several skims at once (one gather per skim block)
 
-        if reverse:
-            s = skim.get(self.df[self.right_key], self.df[self.left_key])
-        else:
-            s = skim.get(self.df[self.left_key], self.df[self.right_key])
+        Parameters
+        ----------
+        keys : list of hashable
+        reverse : bool
+            lookup destination-origin skim values
 
-        return pd.Series(s, index=self.df.index)
+        Returns
+        -------
+        impedances: pd.DataFrame
+            with one column per key and the same index as df
+        """
+
+        values = self.skim_dict.lookup_od_many(keys, self.get_od_index(reverse))
+
+        return pd.DataFrame(values, index=self.df.index)
 
     def reverse(self, key):
         """
@@ -308,13 +580,9 @@ class SkimDictWrapper(object):
         return max skim value in either o-d or d-o direction
         """
 
-        skim = self.skim_dict.get(key)
-
-        assert self.df is not None, "Call set_df first"
-
         s = np.maximum(
-            skim.get(self.df[self.right_key], self.df[self.left_key]),
-            skim.get(self.df[self.left_key], self.df[self.right_key])
+            self.skim_dict.lookup_od(key, self.get_od_index(reverse=True)),
+            self.skim_dict.lookup_od(key, self.get_od_index(reverse=False))
         )
 
         return pd.Series(s, index=self.df.index)
@@ -337,6 +605,199 @@ class SkimDictWrapper(object):
         return self.lookup(key)
 
 
+class SparseSkimWrapper(object):
+    """
+    SkimWrapper analog for a single skim in a SparseSkimDict
+
+    Parameters
+    ----------
+    skim_dict : SparseSkimDict
+    key : hashable
+        skim key
+    """
+
+    def __init__(self, skim_dict, key):
+
+        self.skim_dict = skim_dict
+        self.key = key
+
+    def get(self, orig, dest):
+        """
+        Get impedence values for a set of origin, destination pairs.
+
+        Parameters
+        ----------
+        orig : 1D array
+        dest : 1D array
+
+        Returns
+        -------
+        values : 1D array
+        """
+
+        return self.skim_dict.lookup_od(self.key, self.skim_dict.od_index(orig, dest))
+
+    @property
+    def data(self):
+        """
+        dense (zones x zones) skim array, with default value for od pairs not stored in the sparse skim
+
+        Only for callers (e.g. accessibility) that really need the whole matrix - this is as big as a dense skim.
+        """
+
+        skim_dict = self.skim_dict
+        block, offset = skim_dict.skim_info['block_offsets'][self.key]
+
+        data = np.full(skim_dict.skim_info['omx_shape'], skim_dict.block_defaults[block][offset],
+                       dtype=skim_dict.skim_data[block].dtype)
+        data[skim_dict.orig_offsets, skim_dict.indices] = skim_dict.skim_data[block][:, offset]
+
+        quantization = skim_dict.quantization(self.key)
+        if quantization:
+            data = dequantize(data, quantization)
+
+        return data
+
+
+class SparseSkimDict(SkimDict):
+    """
+    SkimDict for skims stored sparsely, e.g. for fine-grained zone systems where only od pairs within
+    a distance cutoff are of interest and dense zones x zones skims would be too big.
+
+    All skims share the same sparsity pattern, stored in compressed sparse row (CSR) format: the
+    destination offsets of the od pairs stored for origin offset i are indices[indptr[i]:indptr[i+1]]
+    (sorted ascending), and the corresponding values of the skims in a block are the rows
+    skim_data[block][indptr[i]:indptr[i+1], :]
+
+    Lookups of od pairs not stored in the sparse skim return a default (fallback) value for the skim.
+    The lookup api (od_index, lookup_od, get, wrap, ...) is the same as for SkimDict, and works with
+    SkimStack, but od_index values are located with a (vectorized) binary search of the stored od pairs.
+
+    Parameters
+    ----------
+    skim_data : list of 2D numpy arrays (one per block)
+        (nnz, block_size) skim values for each stored od pair
+    skim_info : dict
+        as returned by abm.tables.skims.get_skim_info
+    indptr : 1D numpy array of int
+        (num_orig_zones + 1) CSR row pointers
+    indices : 1D numpy array of int
+        (nnz) CSR destination offsets, sorted within each row
+    default_value : scalar
+        value of skims for od pairs not stored
+    default_values : dict {<key1>: scalar}, optional
+        default value for specific skim key1s (overriding default_value)
+    """
+
+    def __init__(self, skim_data, skim_info, indptr, indices, default_value=np.nan, default_values=None):
+
+        super(SparseSkimDict, self).__init__(skim_data, skim_info)
+
+        num_orig_zones, num_dest_zones = skim_info['omx_shape']
+
+        indptr = np.asanyarray(indptr, dtype=np.int64)
+        indices = np.asanyarray(indices, dtype=np.int64)
+
+        assert len(indptr) == num_orig_zones + 1
+        assert len(indices) == indptr[-1]
+        for block_data in skim_data:
+            assert block_data.shape[0] == len(indices)
+
+        self.indptr = indptr
+        self.indices = indices
+
+        # origin offset of each stored od pair
+        self.orig_offsets = np.repeat(np.arange(num_orig_zones, dtype=np.int64), np.diff(indptr))
+
+        # flattened od index of each stored od pair (sorted, since indices are sorted within rows)
+        self.stored_od_index = self.orig_offsets * num_dest_zones + indices
+        assert (np.diff(self.stored_od_index) > 0).all(), "SparseSkimDict indices not sorted within rows"
+
+        # - block_defaults list of arrays of default values indexed by block offset
+        default_values = default_values or {}
+        self.block_defaults = [np.full(block_data.shape[1], default_value, dtype=block_data.dtype)
+                               for block_data in skim_data]
+        for key, (block, offset) in skim_info['block_offsets'].items():
+            key1 = key[0] if isinstance(key, tuple) else key
+            self.block_defaults[block][offset] = default_values.get(key1, default_value)
+
+    @property
+    def num_dest_zones(self):
+        return self.skim_info['omx_shape'][1]
+
+    @property
+    def nnz(self):
+        """
+        number of stored od pairs
+        """
+        return len(self.indices)
+
+    def block_rows(self, block):
+        """
+        sparse skim_data blocks are already 2D (nnz, block_size)
+        """
+        return self.skim_data[block]
+
+    def stored_positions(self, od_index):
+        """
+        locate od_index values among the stored od pairs
+
+        Parameters
+        ----------
+        od_index : numpy array of int
+
+        Returns
+        -------
+        positions : numpy array of int
+            row in skim_data blocks (0 if not stored)
+        stored : numpy array of bool
+            whether od pair is stored
+        """
+
+        od_index = np.asanyarray(od_index)
+
+        if self.nnz == 0:
+            return np.zeros(od_index.shape, dtype=np.int64), np.zeros(od_index.shape, dtype=bool)
+
+        positions = np.searchsorted(self.stored_od_index, od_index)
+        positions = np.minimum(positions, self.nnz - 1)
+
+        # mapped zone ids not in skim (-1) give negative od_index values that are never stored
+        stored = self.stored_od_index.take(positions) == od_index
+
+        return np.where(stored, positions, 0), stored
+
+    def gather(self, block, od_index, offsets):
+
+        positions, stored = self.stored_positions(od_index)
+
+        values = self.skim_data[block][positions, offsets]
+        defaults = self.block_defaults[block][offsets]
+
+        return np.where(stored, values, defaults)
+
+    def get(self, key):
+        """
+        Get an available wrapped skim object (not the lookup)
+
+        Parameters
+        ----------
+        key : hashable
+             The key (identifier) for this skim object
+
+        Returns
+        -------
+        skim: SparseSkimWrapper
+             The skim object
+        """
+
+        assert key in self.skim_info['block_offsets'], "SkimDict key %s missing" % (key, )
+
+        self.touch(key)
+
+        return SparseSkimWrapper(self, key)
+
+
 class SkimStack(object):
 
     def __init__(self, skim_dict):
@@ -368,34 +829,159 @@ class SkimStack(object):
 
         self.skim_dim3 = skim_dim3
 
+        # - dim3_codes dict maps key2 (e.g. time period label) to integer dim3 code
+        # {'EA': 0, 'AM': 1, 'MD': 2, 'PM': 3, 'EV': 4}
+        dim3_codes = OrderedDict()
+        for key2_offsets in skim_dim3.values():
+            for key2 in key2_offsets:
+                dim3_codes.setdefault(key2, len(dim3_codes))
+        self.dim3_codes = dim3_codes
+
+        # - dim3_offsets dict maps key1 to array of block offsets indexed by dim3 code (-1 if no such key2)
+        # with an extra trailing -1 so that code -1 (unknown key2 label) also maps to -1
+        # DRV_COM_WLK_BOARDS: [-1, 3, 4, 5, -1, -1], ...
+        self.dim3_offsets = OrderedDict()
+        for key1, key2_offsets in skim_dim3.items():
+            offsets = np.full(len(dim3_codes) + 1, -1, dtype=int)
+            for key2, offset in key2_offsets.items():
+                offsets[dim3_codes[key2]] = offset
+            self.dim3_offsets[key1] = offsets
+
         logger.info("SkimStack.__init__ loaded %s keys with %s total skims"
                     % (len(self.skim_dim3),
                        sum([len(d) for d in self.skim_dim3.values()])))
 
         self.usage = set()
 
+    def dim3_codes_for(self, dim3):
+        """
+        convert dim3 key2 labels (e.g. time period) to integer dim3 codes
+
+        Chooser tables can call this once and store the codes (e.g. as a categorical or int column)
+        so that subsequent lookups skip the label conversion.
+
+        Parameters
+        ----------
+        dim3 : array-like of key2 labels, pandas Categorical of key2 labels, or integer dim3 codes
+            integer values are assumed to already be dim3 codes (as returned by this method)
+
+        Returns
+        -------
+        codes : numpy array of int
+        """
+
+        if isinstance(dim3, pd.Series):
+            dim3 = dim3.values
+
+        if isinstance(dim3, pd.Categorical):
+            # map the (few) categories and then take with the categorical codes
+            category_codes = np.array([self.dim3_codes.get(c, -1) for c in dim3.categories] + [-1], dtype=int)
+            return category_codes[dim3.codes]
+
+        dim3 = np.asanyarray(dim3)
+
+        if np.issubdtype(dim3.dtype, np.integer):
+            return dim3
+
+        return pd.Categorical(dim3, categories=list(self.dim3_codes.keys())).codes.astype(int)
+
     def touch(self, key):
         self.usage.add(key)
 
     def lookup(self, orig, dest, dim3, key):
+        """
+        Parameters
+        ----------
+        orig : array-like of origin zone ids
+        dest : array-like of destination zone ids
+        dim3 : array-like of key2 labels, categorical key2 labels or integer dim3 codes (see dim3_codes_for)
+        key : str
+            key1 of the stacked skims
+
+        Returns
+        -------
+        values : numpy array
+        """
+
+        return self.lookup_od(self.skim_dict.od_index(orig, dest), dim3, key)
 
-        orig = self.offset_mapper.map(orig)
-        dest = self.offset_mapper.map(dest)
+    def lookup_od(self, od_index, dim3, key):
+        """
+        lookup by flattened od index (see SkimDict.od_index)
+
+        Parameters
+        ----------
+        od_index : numpy array of int
+        dim3 : array-like of key2 labels, categorical key2 labels or integer dim3 codes (see dim3_codes_for)
+        key : str
+            key1 of the stacked skims
+
+        Returns
+        -------
+        values : numpy array
+        """
 
         assert key in self.key1_blocks, "SkimStack key %s missing" % key
         assert key in self.skim_dim3, "SkimStack key %s missing" % key
 
         block = self.key1_blocks[key]
-        stacked_skim_data = self.skim_dict.skim_data[block]
-        skim_keys_to_indexes = self.skim_dim3[key]
 
         self.touch(key)
 
-        # skim_indexes = dim3.map(skim_keys_to_indexes).astype('int')
-        # this should be faster than map
-        skim_indexes = np.vectorize(skim_keys_to_indexes.get)(dim3)
+        # map dim3 codes to block offsets with a single take from the precomputed offsets array
+        dim3_offsets = self.dim3_offsets[key]
+        skim_indexes = dim3_offsets[self.dim3_codes_for(dim3)]
 
-        return stacked_skim_data[orig, dest, skim_indexes]
+        assert (skim_indexes >= 0).all(), "SkimStack key %s missing dim3 skims" % key
+
+        result = self.skim_dict.gather(block, od_index, skim_indexes)
+
+        quantization = self.skim_dict.quantization(key)
+        if quantization:
+            result = dequantize(result, quantization)
+
+        return result
+
+    def lookup_od_many(self, od_index, dim3, keys):
+        """
+        lookup several stacked skims by flattened od index, with one gather per skim block
+
+        Parameters
+        ----------
+        od_index : numpy array of int
+        dim3 : array-like of key2 labels, categorical key2 labels or integer dim3 codes (see dim3_codes_for)
+        keys : list of str
+            key1s of the stacked skims
+
+        Returns
+        -------
+        values : OrderedDict {<key>: numpy array}
+        """
+
+        dim3_codes = self.dim3_codes_for(dim3)
+
+        keys_by_block = OrderedDict()
+        for key in keys:
+            assert key in self.key1_blocks, "SkimStack key %s missing" % key
+            keys_by_block.setdefault(self.key1_blocks[key], []).append(key)
+
+        values = {}
+        for block, block_keys in keys_by_block.items():
+
+            # (num_rows, num_keys) block offsets for each row and key
+            skim_indexes = np.column_stack([self.dim3_offsets[key][dim3_codes] for key in block_keys])
+
+            assert (skim_indexes >= 0).all(), "SkimStack keys %s missing dim3 skims" % (block_keys, )
+
+            block_values = self.skim_dict.gather(block, od_index[:, np.newaxis], skim_indexes)
+
+            for i, key in enumerate(block_keys):
+                self.touch(key)
+                quantization = self.skim_dict.quantization(key)
+                values[key] = \
+                    dequantize(block_values[:, i], quantization) if quantization else block_values[:, i]
+
+        return OrderedDict([(key, values[key]) for key in keys])
 
     def wrap(self, left_key, right_key, skim_key):
         """
@@ -422,8 +1008,8 @@ class SkimStackWrapper(object):
 
     To be more explicit, the input is a dictionary of Skims objects, each of
     which contains a 2D matrix.  These are stacked into a 3D matrix with a
-    mapping of keys to indexes which is applied using pandas .map to a third
-    column in the object dataframe.  The three columns - left_key and
+    mapping of keys to indexes which is applied (via integer dim3 codes, computed
+    once per dataframe) to a third column in the object dataframe.  The three columns - left_key and
     right_key from the Skims object and skim_key from this one, are then used to
     dereference the 3D matrix.  The tricky part comes in defining the key which
     matches the 3rd dimension of the matrix, and the key which is passed into
@@ -455,6 +1041,8 @@ class SkimStackWrapper(object):
         self.right_key = right_key
         self.skim_key = skim_key
         self.df = None
+        self.dim3 = None
+        self.od_index = None
 
     def set_df(self, df):
         """
@@ -470,6 +1058,8 @@ class SkimStackWrapper(object):
         Nothing
         """
         self.df = df
+        self.dim3 = None
+        self.od_index = None
 
     def __getitem__(self, key):
         """
@@ -487,14 +1077,44 @@ class SkimStackWrapper(object):
         """
 
         assert self.df is not None, "Call set_df first"
-        orig = self.df[self.left_key].astype('int')
-        dest = self.df[self.right_key].astype('int')
-        dim3 = self.df[self.skim_key]
 
-        skim_values = self.stack.lookup(orig, dest, dim3, key)
+        # compute od index and convert skim_key column to dim3 codes once per df,
+        # rather than for every skim key lookup
+        if self.od_index is None:
+            self.od_index = self.stack.skim_dict.od_index(self.df[self.left_key], self.df[self.right_key])
+        if self.dim3 is None:
+            self.dim3 = self.stack.dim3_codes_for(self.df[self.skim_key])
+
+        skim_values = self.stack.lookup_od(self.od_index, self.dim3, key)
 
         return pd.Series(skim_values, self.df.index)
 
+    def lookup_many(self, keys):
+        """
+        lookup several stacked skims at once
+
+        Parameters
+        ----------
+        keys : list of str
+            key1s of the stacked skims
+
+        Returns
+        -------
+        impedances: pd.DataFrame
+            with one column per key and the same index as df
+        """
+
+        assert self.df is not None, "Call set_df first"
+
+        if self.od_index is None:
+            self.od_index = self.stack.skim_dict.od_index(self.df[self.left_key], self.df[self.right_key])
+        if self.dim3 is None:
+            self.dim3 = self.stack.dim3_codes_for(self.df[self.skim_key])
+
+        skim_values = self.stack.lookup_od_many(self.od_index, self.dim3, keys)
+
+        return pd.DataFrame(skim_values, index=self.df.index)
+
 
 class DataFrameMatrix(object):
     """
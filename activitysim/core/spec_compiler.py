@@ -0,0 +1,550 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import ast
+import re
+import sys
+import logging
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .skim import SkimDictWrapper, SkimStackWrapper
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+logger = logging.getLogger(__name__)
+
+"""
+Spec expression compiler
+
+Spec expressions are parsed and classified once (when the spec is read) rather than every time
+the spec is evaluated:
+
+    column      simple column name (e.g. 'is_worker') - values are taken straight from the df
+    arithmetic  arithmetic/comparison expression over df columns (e.g. '(age > 16) & female') - evaluated
+                with numexpr against the df column arrays, bypassing the per-call parsing of DataFrame.eval
+    pandas      any other (non '@') expression - evaluated with DataFrame.eval
+    skim        skim wrapper lookup (e.g. "@od_skims['DIST']") - batched per skim wrapper (lookup_many)
+    python      any other '@' python expression - evaluated from a precompiled code object
+
+Expressions that can't be evaluated by the fast path (e.g. columns with extension dtypes, or float32
+columns, which DataFrame.eval combines with float constants at float32 precision) silently fall back
+to DataFrame.eval, so the compiled evaluation gives exactly the same values as before.
+
+With fused utilities, column and arithmetic expressions are not materialized as expression_values at all.
+Instead they are fused into a few numexpr kernels per alternative that sum the coefficient weighted
+terms directly into the utilities (only the non-arithmetic expressions are dotted with coefficients).
+This changes the floating point summation order, so utilities are only equal to within rounding.
+"""
+
+EXPR_COLUMN = 'column'
+EXPR_ARITHMETIC = 'arithmetic'
+EXPR_PANDAS = 'pandas'
+EXPR_SKIM = 'skim'
+EXPR_PYTHON = 'python'
+
+# ast nodes of expressions that numexpr can evaluate (the same way DataFrame.eval does)
+NUMEXPR_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.BitAnd, ast.BitOr,
+    ast.Invert, ast.USub, ast.UAdd,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+if sys.version_info < (3, 8):
+    NUMEXPR_NODES += (ast.Num, ast.Str, ast.NameConstant)
+
+# suffix appended to duplicate spec expressions by simulate.uniquify_spec_index
+UNIQUIFY_SUFFIX_PATTERN = re.compile(r'\s#\s\(\d+\)$')
+
+# numpy functions and pandas/numpy methods that compute each row's value from the same row's values,
+# so '@' python expressions using them can be evaluated on any subset of the rows of a df
+ELEMENTWISE_NUMPY_FUNCTIONS = {
+    'abs', 'ceil', 'clip', 'exp', 'floor', 'isnan', 'log', 'log1p', 'logical_and', 'logical_not',
+    'logical_or', 'maximum', 'minimum', 'power', 'sqrt', 'where',
+}
+ELEMENTWISE_METHODS = {
+    'abs', 'apply', 'astype', 'between', 'clip', 'isin', 'map', 'mask', 'round', 'values', 'where',
+}
+# other ast nodes allowed in such expressions (besides names, attributes and subscripts)
+ELEMENTWISE_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Constant, ast.Tuple, ast.List,
+    ast.keyword, ast.operator, ast.unaryop, ast.cmpop, ast.expr_context,
+)
+if sys.version_info < (3, 9):
+    ELEMENTWISE_NODES += (ast.Index, ast.Num, ast.Str, ast.NameConstant)
+
+# numexpr limits the number of distinct input arrays of a kernel
+MAX_KERNEL_NAMES = 24
+MAX_KERNEL_TERMS = 64
+
+
+class CompiledExpression(object):
+    """
+    A spec expression, parsed and classified once
+
+    Parameters
+    ----------
+    expr : str
+        spec expression
+    """
+
+    def __init__(self, expr):
+
+        self.expr = expr
+        self.source = UNIQUIFY_SUFFIX_PATTERN.sub('', expr)
+        self.code = None
+        self.names = None
+        self.skim_wrapper = None
+        self.skim_key = None
+
+        # names of columns that numexpr should evaluate as float64 (see _classify_arithmetic)
+        self.float_names = set()
+
+        # set False if numexpr evaluation fails, so we don't keep trying
+        self.numexpr_ok = numexpr is not None
+
+        if expr.startswith('@'):
+            self.kind = EXPR_PYTHON
+            try:
+                self.code = compile(expr[1:], '<spec expression>', 'eval')
+            except SyntaxError:
+                # leave it to eval to raise (and log) the error if the expression is ever evaluated
+                return
+            self._classify_skim_lookup(expr[1:])
+        elif self.source.isidentifier():
+            self.kind = EXPR_COLUMN
+            self.names = [self.source]
+        else:
+            self.kind = EXPR_PANDAS if self._classify_arithmetic(self.source) is None else EXPR_ARITHMETIC
+
+    def _classify_skim_lookup(self, python_expr):
+        """
+        recognize skim wrapper lookups of the form wrapper['KEY'] or wrapper[('KEY1', 'KEY2')]
+        """
+
+        try:
+            node = ast.parse(python_expr.strip(), mode='eval').body
+            if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+                # subscript is wrapped in an ast.Index before python 3.9
+                key = ast.literal_eval(node.slice.value if sys.version_info < (3, 9) else node.slice)
+                if isinstance(key, str) or \
+                        (isinstance(key, tuple) and all(isinstance(k, str) for k in key)):
+                    self.kind = EXPR_SKIM
+                    self.skim_wrapper = node.value.id
+                    self.skim_key = key
+        except (SyntaxError, ValueError):
+            pass
+
+    def _classify_arithmetic(self, expr):
+        """
+        parse expr and set names if numexpr can evaluate it, otherwise return None
+        """
+
+        try:
+            tree = ast.parse(expr.strip(), mode='eval')
+        except SyntaxError:
+            # pandas eval supports some syntax that python doesn't - let pandas deal with it
+            return None
+
+        names = []
+        divisions = []
+        for node in ast.walk(tree):
+            if not isinstance(node, NUMEXPR_NODES):
+                return None
+            if isinstance(node, ast.Compare) and len(node.ops) > 1:
+                # chained comparisons
+                return None
+            if isinstance(node, ast.Name) and node.id not in names:
+                names.append(node.id)
+            if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div):
+                divisions.append(node)
+
+        if not names:
+            # constant expressions evaluate to scalars, not arrays
+            return None
+
+        if divisions:
+            # DataFrame.eval casts the (non-float) terms of divisions to float64 before handing the
+            # expression to numexpr (which evaluates float division by a constant as multiplication
+            # by its reciprocal) so we must too, to get exactly the same values
+            if not hasattr(ast, 'unparse'):
+                return None
+            for node in [n for division in divisions for n in ast.walk(division)]:
+                if isinstance(node, ast.Compare):
+                    # (comparisons of strings are evaluated by pandas and then cast)
+                    return None
+                if isinstance(node, ast.Name):
+                    self.float_names.add(node.id)
+                if isinstance(node, ast.Constant) and type(node.value) in (int, bool):
+                    node.value = float(node.value)
+            self.source = ast.unparse(tree)
+
+        self.names = names
+        return names
+
+    @property
+    def fusible(self):
+        return self.kind in (EXPR_COLUMN, EXPR_ARITHMETIC) and self.numexpr_ok
+
+    def eval_pandas(self, df, locals_dict, globals_dict):
+
+        if self.expr.startswith('@'):
+            return eval(self.code or self.expr[1:], globals_dict, locals_dict)
+        return df.eval(self.expr)
+
+    def column_dependencies(self, locals_dict, temps=None):
+        """
+        df columns that the value of each row of the expression depends on (row by row)
+
+        Parameters
+        ----------
+        locals_dict : dict
+            locals the expression will be evaluated with (to recognize constants and skim wrappers)
+        temps : dict, optional
+            column_dependencies of previously assigned temps (e.g. _DIST@od_skims['DIST']) by name
+
+        Returns
+        -------
+        columns : set of str or None
+            None if row values may depend on anything other than the same row of df columns
+            (e.g. aggregates over rows, the df index, or other tables)
+        uses_skims : bool
+            True if the expression (or a temp it references) looks up skim values
+        """
+
+        if self.kind in (EXPR_COLUMN, EXPR_ARITHMETIC):
+            return set(self.names), False
+
+        if self.code is None:
+            # pandas eval or syntax error
+            return None, False
+
+        temps = temps or {}
+        columns = set()
+        uses_skims = False
+
+        df_nodes = set()
+        for node in ast.walk(ast.parse(self.expr[1:].strip(), mode='eval')):
+
+            if isinstance(node, (ast.Subscript, ast.Attribute)) and \
+                    isinstance(node.value, ast.Name) and node.value.id == 'df':
+                if isinstance(node, ast.Attribute):
+                    # (df.index, df.loc, etc. are not columns)
+                    column = None if hasattr(pd.DataFrame, node.attr) else node.attr
+                else:
+                    # subscript is wrapped in an ast.Index before python 3.9
+                    key = node.slice.value if sys.version_info < (3, 9) else node.slice
+                    column = key.value if isinstance(key, ast.Constant) else getattr(key, 's', None)
+                if not isinstance(column, str):
+                    return None, uses_skims
+                columns.add(column)
+                df_nodes.add(id(node.value))
+
+            elif isinstance(node, ast.Name):
+                value = locals_dict.get(node.id)
+                if node.id in temps:
+                    temp_columns, temp_uses_skims = temps[node.id]
+                    if temp_columns is None:
+                        return None, uses_skims
+                    columns |= temp_columns
+                    uses_skims |= temp_uses_skims
+                elif isinstance(value, (SkimDictWrapper, SkimStackWrapper)):
+                    columns |= {value.left_key, value.right_key}
+                    if isinstance(value, SkimStackWrapper):
+                        columns.add(value.skim_key)
+                    uses_skims = True
+                elif not ((node.id == 'df' and id(node) in df_nodes) or node.id == 'np' or
+                          (node.id in locals_dict and np.isscalar(value))):
+                    return None, uses_skims
+
+            elif isinstance(node, ast.Attribute):
+                base = node.value.id if isinstance(node.value, ast.Name) else None
+                if base == 'np':
+                    if node.attr not in ELEMENTWISE_NUMPY_FUNCTIONS:
+                        return None, uses_skims
+                elif not (node.attr in ELEMENTWISE_METHODS or
+                          isinstance(locals_dict.get(base), (SkimDictWrapper, SkimStackWrapper))):
+                    return None, uses_skims
+
+            elif isinstance(node, ast.Subscript):
+                if not (isinstance(node.value, ast.Name) and
+                        isinstance(locals_dict.get(node.value.id), (SkimDictWrapper, SkimStackWrapper))):
+                    return None, uses_skims
+
+            elif not isinstance(node, ELEMENTWISE_NODES):
+                return None, uses_skims
+
+        return columns, uses_skims
+
+
+class ColumnArrays(object):
+    """
+    numpy arrays of df columns for numexpr evaluation, converted (once per df) as needed
+
+    object and categorical columns are converted to bytes (numexpr only compares bytes strings)
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.arrays = {}
+
+    def local_dict(self, names, float_names=()):
+        """
+        dict of arrays for names, or None if any name is not a column numexpr can handle
+
+        arrays of float_names are cast to float64 (unless they are already float)
+        """
+
+        local_dict = {}
+        for name in names:
+            key = (name, name in float_names)
+            if key not in self.arrays:
+                self.arrays[key] = self._column_array(*key)
+            if self.arrays[key] is None:
+                return None
+            local_dict[name] = self.arrays[key]
+
+        return local_dict
+
+    def _column_array(self, name, as_float=False):
+
+        if as_float:
+            a = self._column_array(name)
+            if a is None or a.dtype.kind == 'S':
+                return None
+            return a if a.dtype in (np.float32, np.float64) else a.astype(np.float64)
+
+        if name not in self.df.columns:
+            return None
+
+        column = self.df[name]
+        if isinstance(column, pd.DataFrame):
+            # duplicate column names
+            return None
+
+        dtype = column.dtype
+        if isinstance(dtype, pd.CategoricalDtype) or dtype == object:
+            try:
+                return np.asarray(column).astype('S')
+            except (UnicodeEncodeError, TypeError, ValueError):
+                return None
+
+        if isinstance(dtype, np.dtype) and (np.issubdtype(dtype, np.number) or dtype == bool):
+            return column.values
+
+        return None
+
+
+class CompiledSpec(object):
+    """
+    compiled expressions of a spec
+
+    Parameters
+    ----------
+    exprs : sequence of str
+        spec expressions
+    """
+
+    def __init__(self, exprs):
+
+        self.exprs = [CompiledExpression(expr) for expr in exprs]
+
+    def kind_counts(self):
+        counts = OrderedDict()
+        for e in self.exprs:
+            counts[e.kind] = counts.get(e.kind, 0) + 1
+        return counts
+
+    def skim_lookups(self, locals_dict, indexes):
+        """
+        batch skim lookups of skim expressions in indexes, one lookup_many per skim wrapper
+
+        Returns
+        -------
+        values : dict {<expression index>: numpy array}
+        """
+
+        keys_by_wrapper = OrderedDict()
+        for i in indexes:
+            e = self.exprs[i]
+            if e.kind != EXPR_SKIM:
+                continue
+            wrapper = locals_dict.get(e.skim_wrapper)
+            if not isinstance(wrapper, (SkimDictWrapper, SkimStackWrapper)) or wrapper.df is None:
+                continue
+            keys_by_wrapper.setdefault(e.skim_wrapper, OrderedDict()).setdefault(e.skim_key, []).append(i)
+
+        values = {}
+        for wrapper_name, expr_indexes in keys_by_wrapper.items():
+            keys = list(expr_indexes.keys())
+            skim_values = locals_dict[wrapper_name].lookup_many(keys)
+            for j, key in enumerate(keys):
+                for i in expr_indexes[key]:
+                    values[i] = skim_values.iloc[:, j].values
+
+        return values
+
+    def eval_expression(self, i, df, locals_dict, globals_dict, column_arrays, skim_values=None):
+        """
+        evaluate expression i in the context of df and locals_dict
+
+        Returns
+        -------
+        values : array-like, pandas Series or scalar (just like DataFrame.eval or python eval would)
+        """
+
+        e = self.exprs[i]
+
+        try:
+            if skim_values is not None and i in skim_values:
+                return skim_values[i]
+
+            if e.kind == EXPR_COLUMN and e.source in df.columns and not isinstance(df[e.source], pd.DataFrame):
+                return df[e.source]
+
+            if e.kind == EXPR_ARITHMETIC and e.numexpr_ok:
+                local_dict = column_arrays.local_dict(e.names, e.float_names)
+                if local_dict is not None and not any(a.dtype == np.float32 for a in local_dict.values()):
+                    try:
+                        return numexpr.evaluate(e.source, local_dict=local_dict)
+                    except Exception as err:
+                        logger.debug("numexpr evaluation failed for %s (%s), using pandas eval" % (e.source, err))
+                        e.numexpr_ok = False
+
+            return e.eval_pandas(df, locals_dict, globals_dict)
+
+        except Exception as err:
+            logger.exception("Variable evaluation failed for: %s" % str(e.expr))
+            raise err
+
+    def expression_values(self, df, locals_dict, globals_dict, indexes=None, dtype=np.float64):
+        """
+        evaluate expressions (all or only those in indexes) into rows of an array
+
+        Returns
+        -------
+        expression_values : numpy array
+            (len(indexes), len(df)) expression values (float64 unless dtype is specified)
+        """
+
+        indexes = list(range(len(self.exprs))) if indexes is None else indexes
+
+        column_arrays = ColumnArrays(df)
+        skim_values = self.skim_lookups(locals_dict, indexes)
+
+        expression_values = np.empty((len(indexes), df.shape[0]), dtype=dtype)
+        for row, i in enumerate(indexes):
+            expression_values[row] = \
+                self.eval_expression(i, df, locals_dict, globals_dict, column_arrays, skim_values)
+
+        return expression_values
+
+    def fused_utilities(self, df, coefficients, locals_dict, globals_dict):
+        """
+        compute utilities without materializing the values of fusible (arithmetic) expressions
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+        coefficients : numpy array
+            (num_expressions, num_alternatives) spec coefficients
+
+        Returns
+        -------
+        utilities : numpy array
+            (len(df), num_alternatives) utilities, or None if fused kernels could not be evaluated
+        """
+
+        column_arrays = ColumnArrays(df)
+
+        def fusible(e):
+            if not e.fusible:
+                return False
+            local_dict = column_arrays.local_dict(e.names, e.float_names)
+            if local_dict is None:
+                return False
+            # string columns only make sense in comparisons
+            return e.kind != EXPR_COLUMN or local_dict[e.source].dtype.kind != 'S'
+
+        fused = [i for i, e in enumerate(self.exprs) if fusible(e)]
+        fused_set = set(fused)
+        others = [i for i in range(len(self.exprs)) if i not in fused_set]
+
+        # - dot non-fused expression values with their coefficients
+        if others:
+            values = self.expression_values(df, locals_dict, globals_dict, others)
+            utilities = np.dot(values.transpose(), coefficients[others])
+        else:
+            utilities = np.zeros((df.shape[0], coefficients.shape[1]))
+
+        # - sum coefficient weighted fused expression terms with a few kernels per alternative
+        for alt in range(coefficients.shape[1]):
+
+            terms = []
+            names = set()
+            float_names = set()
+            for i in fused:
+                coefficient = coefficients[i, alt]
+                if coefficient == 0:
+                    continue
+                e = self.exprs[i]
+                if terms and (len(names.union(e.names)) > MAX_KERNEL_NAMES or len(terms) == MAX_KERNEL_TERMS):
+                    if not self._add_kernel(utilities, alt, terms, names, float_names, column_arrays):
+                        return None
+                    terms, names, float_names = [], set(), set()
+                terms.append("%r * (%s)" % (float(coefficient), e.source))
+                names.update(e.names)
+                float_names.update(e.float_names)
+
+            if terms and not self._add_kernel(utilities, alt, terms, names, float_names, column_arrays):
+                return None
+
+        return utilities
+
+    def _add_kernel(self, utilities, alt, terms, names, float_names, column_arrays):
+
+        kernel = ' + '.join(terms)
+        try:
+            # cast the terms' float_names to float64, as when evaluating their expression values
+            local_dict = column_arrays.local_dict(names, float_names)
+            if local_dict is None:
+                return False
+            utilities[:, alt] += numexpr.evaluate(kernel, local_dict=local_dict)
+        except Exception as err:
+            logger.warning("fused utilities kernel failed (%s), using expression values" % (err, ))
+            return False
+        return True
+
+
+# compiled specs memoized by expressions (coefficients may vary for the same expressions)
+_COMPILED_SPECS = {}
+
+
+def compile_spec(exprs):
+    """
+    compiled spec for exprs (parsed and classified only once per distinct list of expressions)
+
+    Parameters
+    ----------
+    exprs : sequence of str
+        spec expressions (e.g. spec.index)
+
+    Returns
+    -------
+    compiled_spec : CompiledSpec
+    """
+
+    key = tuple(exprs)
+    compiled_spec = _COMPILED_SPECS.get(key)
+    if compiled_spec is None:
+        compiled_spec = _COMPILED_SPECS[key] = CompiledSpec(key)
+        logger.debug("compile_spec compiled %s expressions %s" %
+                     (len(key), dict(compiled_spec.kind_counts())))
+
+    return compiled_spec
@@ -9,6 +9,7 @@ from collections import OrderedDict
 from activitysim.core import pipeline
 from activitysim.core import inject
 from activitysim.core import config
+from activitysim.core import compact
 
 from activitysim.core.config import setting
 
@@ -19,7 +20,7 @@ def track_skim_usage(output_dir):
     """
     write statistics on skim usage (diagnostic to detect loading of un-needed skims)
 
-    FIXME - have not yet implemented a facility to avoid loading of unused skims
+    (see prune_skims setting to avoid loading skims not referenced by model specs)
 
     Parameters
     ----------
@@ -250,7 +251,7 @@ def write_tables(output_dir):
 
         if h5_store:
             file_path = config.output_file_path('%soutput_tables.h5' % prefix)
-            df.to_hdf(file_path, key=table_name, mode='a', format='fixed')
+            compact.decategorize(df).to_hdf(file_path, key=table_name, mode='a', format='fixed')
         else:
             file_name = "%s%s.csv" % (prefix, table_name)
             file_path = config.output_file_path(file_name)
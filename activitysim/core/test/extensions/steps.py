@@ -43,6 +43,20 @@ def step_add_col():
     pipeline.replace_table(table_name, table)
 
 
+@inject.step()
+def step_add_rows():
+
+    table_name = inject.get_step_arg('table_name')
+    assert table_name is not None
+
+    table = pipeline.get_table(table_name)
+
+    new_rows = table.copy()
+    new_rows.index += len(table)
+
+    pipeline.extend_table(table_name, new_rows)
+
+
 @inject.step()
 def step_forget_tab():
 
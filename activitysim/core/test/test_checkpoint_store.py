@@ -0,0 +1,115 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import os
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+from .. import checkpoint_store
+from .. import inject
+
+
+@pytest.fixture(params=[checkpoint_store.HDF5, checkpoint_store.PARQUET])
+def store_type(request):
+
+    if request.param == checkpoint_store.PARQUET:
+        pytest.importorskip('pyarrow')
+
+    return request.param
+
+
+def test_checkpoint_store(tmpdir, store_type):
+
+    file_path = os.path.join(str(tmpdir), 'pipeline.h5')
+
+    df = pd.DataFrame({'a': np.arange(10), 'b': np.linspace(0, 1, 10), 'c': list('abcdefghij')},
+                      index=pd.Index(np.arange(100, 110), name='household_id'))
+    checkpoints = pd.DataFrame({'checkpoint_name': ['init', 'step1'], 'households': ['init', 'step1']})
+
+    with checkpoint_store.open_store(file_path, mode='a', type_name=store_type) as store:
+        store.write('households/init', df)
+        store['households/step1'] = df.head(5)
+        store['checkpoints'] = checkpoints
+        store.flush()
+
+    assert os.path.exists(checkpoint_store.store_path(file_path, store_type))
+
+    with checkpoint_store.open_store(file_path, mode='r', type_name=store_type) as store:
+
+        assert 'households/init' in store
+        assert 'persons/init' not in store
+
+        pdt.assert_frame_equal(store['households/init'], df)
+        pdt.assert_frame_equal(store['households/step1'], df.head(5))
+        pdt.assert_frame_equal(store.read('households/init', columns=['b']), df[['b']])
+        pdt.assert_frame_equal(store.read('households/init', columns=[]), df[[]])
+        pdt.assert_frame_equal(store['checkpoints'], checkpoints)
+
+        with pytest.raises(KeyError):
+            store.read('persons/init')
+
+    checkpoint_store.remove_store(file_path, store_type)
+    assert not os.path.exists(checkpoint_store.store_path(file_path, store_type))
+
+
+def test_store_type_setting():
+
+    inject.add_injectable('settings', {'pipeline_store_type': 'bogus'})
+
+    with pytest.raises(RuntimeError):
+        checkpoint_store.store_type()
+
+    inject.add_injectable('settings', {'pipeline_store_type': checkpoint_store.PARQUET})
+    assert checkpoint_store.store_path('output/pipeline.h5') == os.path.join('output', 'pipeline')
+
+    inject.reinject_decorated_tables()
+
+
+class FailingStore(object):
+
+    path = 'failing'
+
+    def write(self, key, df):
+        raise IOError("disk full")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_background_writer_store(tmpdir):
+
+    file_path = os.path.join(str(tmpdir), 'pipeline.h5')
+
+    df = pd.DataFrame({'a': np.arange(10)})
+
+    hdf_store = checkpoint_store.open_store(file_path, mode='a', type_name=checkpoint_store.HDF5)
+    with checkpoint_store.BackgroundWriterStore(hdf_store, queue_size=2) as store:
+
+        for i in range(10):
+            store.write('table/step%s' % i, df)
+            # snapshot is written, not later modifications
+            df['a'] += 1
+        store.flush()
+
+        assert 'table/step9' in store
+
+        # read waits for queued writes
+        assert store['table/step3'].a.tolist() == list(range(3, 13))
+
+    with checkpoint_store.open_store(file_path, mode='r', type_name=checkpoint_store.HDF5) as store:
+        assert store['table/step9'].a.tolist() == list(range(9, 19))
+
+    # background write errors are raised by the next call
+    store = checkpoint_store.BackgroundWriterStore(FailingStore(), queue_size=1)
+    store.write('table/step1', df)
+    with pytest.raises(RuntimeError) as excinfo:
+        store.wait()
+    assert "disk full" in str(excinfo.value)
+    with pytest.raises(RuntimeError):
+        store.close()
@@ -0,0 +1,96 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from .. import chunk
+from .. import inject
+
+
+@pytest.fixture
+def adaptive_chunking(tmpdir):
+
+    inject.add_injectable('settings', {'adaptive_chunking': True})
+    inject.add_injectable('output_dir', str(tmpdir))
+    chunk.ROW_SIZES.clear()
+    chunk.CALIBRATION.clear()
+
+    yield str(tmpdir)
+
+    chunk.ROW_SIZES.clear()
+    chunk.CALIBRATION.clear()
+    inject.reinject_decorated_tables()
+
+
+def test_adaptive_chunking(adaptive_chunking):
+
+    trace_label = 'test.adaptive'
+    chunk_size = 1000
+    choosers = pd.DataFrame({'x': np.arange(5000)})
+
+    # estimated row_size is 10 times too small
+    rows_per_chunk, effective_chunk_size = chunk.rows_per_chunk(chunk_size, 1, len(choosers), trace_label)
+    assert rows_per_chunk == 1000
+
+    chunk_lengths = []
+    for i, num_chunks, chooser_chunk in chunk.chunked_choosers(choosers, rows_per_chunk, trace_label):
+
+        chunk.log_open(trace_label, chunk_size, effective_chunk_size)
+        chunk.log_df(trace_label, 'utilities', np.zeros((len(chooser_chunk), 10)))
+        chunk.log_close(trace_label)
+
+        chunk_lengths.append(len(chooser_chunk))
+
+    assert sum(chunk_lengths) == len(choosers)
+    assert chunk_lengths[0] == 1000
+    assert 0 < max(chunk_lengths[1:]) <= 100
+
+    # measured row_size is saved and used for later runs
+    calibration = pd.read_csv(os.path.join(adaptive_chunking, chunk.CALIBRATION_FILE_NAME), index_col=0)
+    assert calibration.row_size[trace_label] >= 10
+
+    chunk.ROW_SIZES.clear()
+    chunk.CALIBRATION.clear()
+    rows_per_chunk, _ = chunk.rows_per_chunk(chunk_size, 1, len(choosers), trace_label)
+    assert rows_per_chunk <= 100
+
+    # not adaptive without trace_label
+    chunk_lengths = [len(c) for _, _, c in chunk.chunked_choosers(choosers, 1000)]
+    assert chunk_lengths == [1000] * 5
+
+
+def test_next_rows_per_chunk(adaptive_chunking):
+
+    trace_label = 'test.next_rows_per_chunk'
+    row_sizes = []
+
+    def next_rpc(elements, rss_growth, chunk_rows=100):
+        chunk.LAST_CHUNK.clear()
+        chunk.LAST_CHUNK.update({'chunk_size': 1000, 'elements': elements, 'bytes': 0,
+                                 'rss_growth': rss_growth * chunk.BYTES_PER_ELEMENT})
+        return chunk.next_rows_per_chunk(100, chunk_rows, row_sizes, trace_label)
+
+    # one-off rss growth of the first chunk is ignored
+    assert next_rpc(1000, rss_growth=100000) == 100
+    assert chunk.ROW_SIZES[trace_label] == 10
+
+    # median, not max, of the row_sizes measured so far
+    next_rpc(1000, rss_growth=5000)
+    next_rpc(1000, rss_growth=0)
+    assert row_sizes == [10, 50, 10]
+    assert chunk.ROW_SIZES[trace_label] == 10
+
+    chunk.write_calibration()
+    chunk.LAST_CHUNK.clear()
+
+    # later runs replace the calibrated row_size with their own measurements
+    chunk.ROW_SIZES.clear()
+    chunk.CALIBRATION.clear()
+    assert chunk.calibrated_row_size(1, trace_label) == 10
+    row_sizes = []
+    next_rpc(500, rss_growth=0)
+    assert chunk.ROW_SIZES[trace_label] == 5
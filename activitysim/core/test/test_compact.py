@@ -0,0 +1,98 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import os
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+from .. import checkpoint_store
+from .. import compact
+from .. import inject
+
+
+@pytest.fixture
+def compact_settings(tmpdir):
+
+    inject.add_injectable('settings', {
+        'compact_tables': True,
+        'compact_min_int_dtype': 'int8',
+        'compact_floats': True,
+        'compact_categories': {'tours': {'tour_type': ['work', 'school']}},
+    })
+    inject.add_injectable('output_dir', str(tmpdir))
+    compact.MEMORY_REPORT.clear()
+
+    yield str(tmpdir)
+
+    compact.MEMORY_REPORT.clear()
+    inject.reinject_decorated_tables()
+
+
+def test_compact_columns():
+
+    s = pd.Series([0, 100, -100])
+    assert compact.compact_int(s, 'int8').dtype == np.int8
+    assert compact.compact_int(s, 'int32').dtype == np.int32
+    assert compact.compact_int(pd.Series([0, 1000]), 'int8').dtype == np.int16
+    assert compact.compact_int(pd.Series([0, 2 ** 40]), 'int8').dtype == np.int64
+    # never upcast
+    assert compact.compact_int(s.astype(np.int8), 'int32').dtype == np.int8
+
+    assert compact.compact_float(pd.Series([0.5, np.nan, 2.0])).dtype == np.float32
+    assert compact.compact_float(pd.Series([0.1, 2.0])).dtype == np.float64
+
+    # listed categories first, then unlisted values sorted
+    s = pd.Series(['b', 'a', 'b', 'a', None, 'b'])
+    c = compact.compact_strings(s, categories=['b', 'c'])
+    assert list(c.cat.categories) == ['b', 'c', 'a']
+    assert c.isnull().sum() == 1
+    assert (c.astype(object).fillna('') == s.fillna('')).all()
+
+    # not listed
+    assert compact.compact_strings(s) is s
+    # not strings
+    assert compact.compact_strings(pd.Series([1, 'a', 1, 1]), categories=['a']).dtype == object
+
+    # categories added so they can be assigned
+    c = compact.add_categories(c, ['a', 'd'])
+    assert list(c.cat.categories) == ['b', 'c', 'a', 'd']
+    assert list(c.where(c != 'a', 'd').dropna()) == ['b', 'd', 'b', 'd', 'b']
+    assert compact.add_categories(s, ['d']) is s
+
+
+def test_compact_df(compact_settings):
+
+    tours = pd.DataFrame({
+        'person_id': np.arange(10, dtype=np.int64),
+        'tour_type': ['escort', 'work', 'school', 'work', 'work'] * 2,
+        'tour_category': ['mandatory'] * 10,
+        'logsum': np.linspace(-1, 1, 10),
+        'duration': np.full(10, 1.5),
+    })
+    original = tours.copy()
+
+    df = compact.compact_df(tours, 'tours', trace_label='test')
+
+    assert df.person_id.dtype == np.int8
+    assert list(df.tour_type.cat.categories) == ['work', 'school', 'escort']
+    # unlisted string columns are not encoded
+    assert df.tour_category.dtype == object
+    assert df.logsum.dtype == np.float64
+    assert df.duration.dtype == np.float32
+
+    report = compact.MEMORY_REPORT['tours']
+    assert report['compacted_columns'] == 3
+    assert report['bytes_after'] < report['bytes_before']
+
+    compact.write_memory_report()
+    report = pd.read_csv(os.path.join(compact_settings, compact.MEMORY_REPORT_FILE_NAME), index_col='table_name')
+    assert report.loc['tours', 'rows'] == 10
+
+    # hdf5 fixed format store writes categoricals as their values
+    file_path = os.path.join(compact_settings, 'pipeline.h5')
+    with checkpoint_store.open_store(file_path, type_name=checkpoint_store.HDF5) as store:
+        store['tours/test'] = df
+        pdt.assert_frame_equal(store['tours/test'], original, check_dtype=False)
@@ -0,0 +1,29 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import numpy.testing as npt
+
+from .. import interaction_sample
+
+
+def test_sample_positions():
+
+    rng = np.random.RandomState(0)
+
+    for alternative_count in [1, 2, 7, 64, 100]:
+        probs = rng.rand(50, alternative_count) * (rng.rand(50, alternative_count) > 0.3)
+        probs = probs / np.maximum(probs.sum(axis=1), 1e-9)[:, np.newaxis]
+        cum_probs_arr = probs.cumsum(axis=1)
+
+        rands = rng.rand(50, 10)
+        # rands equal to cumulative probabilities (ties) and not less than the last cum prob
+        rands[:, 0] = cum_probs_arr[:, rng.randint(0, alternative_count)]
+        rands[:, 1] = cum_probs_arr[:, -1]
+        rands[:, 2] = 0.0
+
+        expected = np.empty(rands.shape, dtype=int)
+        for j in range(rands.shape[1]):
+            expected[:, j] = np.argmax(cum_probs_arr > rands[:, [j]], axis=1)
+
+        npt.assert_array_equal(interaction_sample.sample_positions(cum_probs_arr, rands), expected)
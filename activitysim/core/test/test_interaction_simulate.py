@@ -0,0 +1,139 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+
+from .. import inject
+from .. import interaction_simulate
+from .. import logit
+from .. import skim
+from ..simulate import set_skim_wrapper_targets
+
+
+@pytest.fixture(scope='module')
+def choosers():
+    rng = np.random.RandomState(0)
+    n = 20
+    return pd.DataFrame({
+        'home_taz': rng.randint(1, 6, n),
+        'income': rng.rand(n) * 100000,
+        'female': rng.rand(n) > 0.5,
+        'size_term': rng.rand(n),
+        'unused': rng.rand(n),
+    }, index=pd.Index(np.arange(n) + 100, name='person_id'))
+
+
+@pytest.fixture(scope='module')
+def alternatives():
+    rng = np.random.RandomState(1)
+    n = 5
+    alternatives = pd.DataFrame({
+        'size_term': rng.rand(n) * 100,
+        'area_type': rng.randint(0, 4, n),
+        'unused_too': rng.rand(n),
+    }, index=pd.Index(np.arange(n) + 1, name='TAZ'))
+    alternatives['TAZ'] = alternatives.index
+    return alternatives
+
+
+@pytest.fixture(scope='module')
+def spec():
+    exprs = [
+        '_DIST@skims["DIST"]',
+        'female',
+        '@df.income.clip(upper=50000) / 1000',
+        '@np.log1p(df.size_term)',
+        '@(df.area_type == 2) * df.size_term_chooser',
+        '@df.size_term.apply(np.log1p)',
+        '@(df.area_type < 2) * _DIST',
+        '@_DIST * df.income',
+        'area_type * income',
+        '@df.size_term == 0',
+    ]
+    return pd.DataFrame({'coefficient': np.linspace(-1.0, 1.0, len(exprs))},
+                        index=pd.Index(exprs, name='Expression'))
+
+
+@pytest.fixture(scope='module')
+def skims():
+    skim_data = np.arange(75, dtype=np.float64).reshape((5, 5, 3))
+    skim_dict = skim.SkimDict([skim_data], {'block_offsets': {'DIST': (0, 0), 'TIME': (0, 1)}})
+    skim_dict.offset_mapper.set_offset_int(-1)
+    return skim_dict.wrap('home_taz', 'TAZ')
+
+
+def test_factor_interaction_spec(choosers, alternatives, spec, skims):
+
+    inject.add_injectable('settings', {})
+
+    locals_d = {'skims': skims}
+
+    interaction_df = logit.interaction_dataset(choosers, alternatives)
+    set_skim_wrapper_targets(interaction_df, skims)
+    utilities, _ = interaction_simulate.eval_interaction_utilities(spec, interaction_df, locals_d,
+                                                                   'test', None)
+
+    separable_terms, interaction_choosers, interaction_alternatives = \
+        interaction_simulate.factor_interaction_spec(spec, choosers, alternatives, len(alternatives),
+                                                     skims, locals_d, 'test')
+
+    # female and clipped income are chooser terms, alternative size_term terms are alternative terms
+    assert sorted(separable_terms) == [1, 2, 3, 5, 9]
+
+    assert list(interaction_choosers.columns) == ['home_taz', 'income', 'size_term']
+    assert list(interaction_alternatives.columns) == ['size_term', 'area_type', 'TAZ']
+
+    interaction_df = logit.interaction_dataset(interaction_choosers, interaction_alternatives)
+    set_skim_wrapper_targets(interaction_df, skims)
+    factored_utilities, _ = interaction_simulate.eval_interaction_utilities(
+        spec, interaction_df, locals_d, 'test', None, separable_terms=separable_terms)
+
+    npt.assert_array_equal(factored_utilities.utility.values, utilities.utility.values)
+    npt.assert_array_equal(factored_utilities.index.values, utilities.index.values)
+
+    # lazy interaction dataset only materializes referenced columns
+    interaction_df = logit.interaction_dataset(choosers, alternatives, lazy=True)
+    set_skim_wrapper_targets(interaction_df, skims)
+    lazy_utilities, _ = interaction_simulate.eval_interaction_utilities(spec, interaction_df, locals_d,
+                                                                        'test', None)
+    npt.assert_array_equal(lazy_utilities.utility.values, utilities.utility.values)
+    assert 'unused' not in interaction_df.series and 'unused_too' not in interaction_df.series
+
+    # with sampled alternatives, only chooser terms are separable
+    separable_terms, _, _ = \
+        interaction_simulate.factor_interaction_spec(spec, choosers, alternatives, 3,
+                                                     skims, locals_d, 'test')
+    assert sorted(separable_terms) == [1, 2]
+
+    inject.reinject_decorated_tables()
+
+
+def test_log_materialized_interaction_df(choosers, alternatives, spec, skims, monkeypatch):
+
+    inject.add_injectable('settings', {'lazy_interaction_dataset': True})
+
+    logged_bytes = []
+
+    class UtilitiesLogged(Exception):
+        pass
+
+    def log_df(trace_label, table_name, df):
+        if table_name == 'interaction_df':
+            logged_bytes.append(df.memory_usage(index=True).sum())
+        if table_name == 'interaction_utilities':
+            raise UtilitiesLogged()
+
+    monkeypatch.setattr(interaction_simulate.chunk, 'log_df', log_df)
+
+    with pytest.raises(UtilitiesLogged):
+        interaction_simulate._interaction_simulate(choosers, alternatives.copy(), spec, skims=skims,
+                                                   locals_d={'skims': skims}, trace_label='test')
+
+    # interaction_df is logged again once its referenced columns are materialized
+    assert len(logged_bytes) == 2
+    assert logged_bytes[1] > logged_bytes[0]
+
+    inject.reinject_decorated_tables()
@@ -149,3 +149,88 @@ def test_interaction_dataset_sampled(
 
     interacted, expected = interacted.align(expected, axis=1)
     pdt.assert_frame_equal(interacted, expected)
+
+
+def test_lazy_interaction_dataset(interaction_choosers, interaction_alts):
+
+    choosers = interaction_choosers.copy()
+    choosers['prop'] = [1.5, 2.5, 3.5, 4.5]
+    choosers['cat'] = pd.Categorical(['u', 'v', 'u', 'v'])
+    alts = interaction_alts.copy()
+    alts['alt_cat'] = pd.Categorical(['p', 'q', 'p', 'r'])
+
+    expected = logit.interaction_dataset(choosers, alts, alt_index_id='alt_id')
+    lazy = logit.interaction_dataset(choosers, alts, alt_index_id='alt_id', lazy=True)
+
+    assert list(lazy.columns) == list(expected.columns)
+    assert lazy.shape == expected.shape
+    assert not lazy.series
+
+    pdt.assert_series_equal(lazy['prop_chooser'], expected['prop_chooser'])
+    pdt.assert_series_equal(lazy.alt_cat, expected.alt_cat)
+    assert list(lazy.series) == ['prop_chooser', 'alt_cat']
+
+    pdt.assert_series_equal(lazy.eval('prop * prop_chooser'), expected.eval('prop * prop_chooser'))
+    pdt.assert_frame_equal(lazy[['attr', 'alt_id']], expected[['attr', 'alt_id']])
+
+    trace_rows = np.arange(len(expected)) % 3 == 0
+    pdt.assert_frame_equal(lazy[trace_rows], expected[trace_rows])
+
+    # other DataFrame attributes are those of the fully materialized DataFrame
+    pdt.assert_frame_equal(lazy.loc[:, ['cat']], expected.loc[:, ['cat']])
+
+
+@pytest.fixture(scope='module')
+def nest_spec():
+    return {
+        'name': 'root', 'coefficient': 1.0,
+        'alternatives': [
+            {'name': 'auto', 'coefficient': 0.72,
+             'alternatives': ['drive', {'name': 'shared', 'coefficient': 0.35,
+                                        'alternatives': ['sr2', 'sr3']}]},
+            {'name': 'nonmotorized', 'coefficient': 0.5, 'alternatives': ['walk', 'bike']},
+            'transit',
+        ]
+    }
+
+
+def test_nest_tree(nest_spec):
+
+    alternatives = ['walk', 'sr3', 'drive', 'transit', 'bike', 'sr2']
+    rng = np.random.RandomState(0)
+    utilities = pd.DataFrame(rng.randn(50, len(alternatives)) * 3, columns=alternatives)
+    # a nest whose alternatives are all unavailable
+    utilities.loc[0, ['walk', 'bike']] = -999
+
+    tree = logit.nest_tree(nest_spec, alternatives)
+    assert logit.nest_tree(nest_spec, alternatives) is tree
+    assert tree.names[:4] == ['root', 'auto', 'nonmotorized', 'transit']
+
+    nested_exp_utilities = tree.exp_utilities(utilities.values)
+    nested_probabilities = tree.nested_probabilities(nested_exp_utilities)
+    base_probabilities = tree.base_probabilities(nested_probabilities)
+    logsums = tree.logsums(nested_exp_utilities)
+
+    # nest by nest computation
+    exp_utilities = {}
+    for nest in logit.each_nest(nest_spec, post_order=True):
+        if nest.is_leaf:
+            exp_utilities[nest.name] = np.exp(utilities[nest.name].values / nest.product_of_coefficients)
+        else:
+            with np.errstate(divide='ignore'):
+                exp_utilities[nest.name] = \
+                    np.exp(nest.coefficient * np.log(sum(exp_utilities[a] for a in nest.alternatives)))
+    probabilities = {'root': 1.0}
+    for nest in logit.each_nest(nest_spec, type='node'):
+        probs = logit.utils_to_probs(pd.DataFrame({a: exp_utilities[a] for a in nest.alternatives}),
+                                     exponentiated=True, allow_zero_probs=True)
+        for a in nest.alternatives:
+            probabilities[a] = probs[a].values * probabilities[nest.name]
+
+    np.testing.assert_allclose(logsums, np.log(exp_utilities['root']))
+    np.testing.assert_allclose(nested_exp_utilities[:, tree.leaves], np.column_stack(
+        [exp_utilities[a] for a in alternatives]))
+    np.testing.assert_allclose(base_probabilities, np.column_stack(
+        [probabilities[a] for a in alternatives]))
+    np.testing.assert_allclose(base_probabilities.sum(axis=1), 1.0)
+    assert base_probabilities[0, [0, 4]].sum() == 0
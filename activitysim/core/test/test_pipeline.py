@@ -4,6 +4,8 @@ import os
 import logging
 import pytest
 
+import pandas.testing as pdt
+
 import tables
 
 from activitysim.core import tracing
@@ -137,6 +139,129 @@ def test_pipeline_checkpoint_drop():
     pipeline.close_pipeline()
     close_handlers()
 
+
+@pytest.mark.parametrize('background_checkpoint_writer', [False, True])
+def test_pipeline_checkpoint_deltas(background_checkpoint_writer):
+
+    inject.add_injectable('settings', {'checkpoint_deltas': True, 'checkpoint_snapshot_interval': 2,
+                                       'background_checkpoint_writer': background_checkpoint_writer})
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step_add_col', steps.step_add_col)
+    inject.add_step('step_add_rows', steps.step_add_rows)
+
+    _MODELS = [
+        'step1',
+        'step_add_col.table_name=table1;column_name=c2',
+        'step_add_rows.table_name=table1',
+        'step_add_col.table_name=table1;column_name=c3',
+    ]
+    pipeline.run(models=_MODELS, resume_after=None)
+
+    expected = {checkpoint_name: pipeline.get_table('table1', checkpoint_name=checkpoint_name)
+                for checkpoint_name in _MODELS}
+
+    assert list(expected[_MODELS[1]].columns) == ['c', 'c2']
+    assert len(expected[_MODELS[2]]) == 6
+    assert list(expected[_MODELS[3]].columns) == ['c', 'c2', 'c3']
+
+    # only the new column was written at step_add_col and only the new rows at step_add_rows
+    store = pipeline.get_pipeline_store()
+    assert list(store[pipeline.pipeline_table_key('table1', _MODELS[1])].columns) == ['c2']
+    assert list(store[pipeline.pipeline_table_key('table1', _MODELS[2])].columns) == []
+    assert len(store[pipeline.pipeline_table_key('table1_added_rows', _MODELS[2])]) == 3
+
+    # full snapshot after checkpoint_snapshot_interval deltas
+    assert list(store[pipeline.pipeline_table_key('table1', _MODELS[3])].columns) == ['c', 'c2', 'c3']
+
+    # column names are written as str without renaming the columns of the live table
+    table2 = pipeline.get_table('table1').rename(columns={'c3': 3})
+    pipeline.write_checkpoint_df(table2, 'table2', _MODELS[3])
+    assert list(table2.columns) == ['c', 'c2', 3]
+    assert list(store[pipeline.pipeline_table_key('table2', _MODELS[3])].columns) == ['c', 'c2', '3']
+
+    pipeline.close_pipeline()
+
+    # reconstruct tables from deltas when resuming
+    pipeline.open_pipeline(resume_after=_MODELS[2])
+    for checkpoint_name in _MODELS[:3]:
+        df = pipeline.get_table('table1', checkpoint_name=checkpoint_name)
+        pdt.assert_frame_equal(df, expected[checkpoint_name])
+    pdt.assert_frame_equal(pipeline.get_table('table1'), expected[_MODELS[2]])
+
+    pipeline.close_pipeline()
+    close_handlers()
+
+
+def test_pipeline_lazy_checkpoint_tables():
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step3', steps.step3)
+    inject.add_step('step_add_col', steps.step_add_col)
+
+    _MODELS = [
+        'step1',
+        'step3',
+        'step_add_col.table_name=table1;column_name=c2',
+    ]
+    pipeline.run(models=_MODELS, resume_after=None)
+    table1 = pipeline.get_table('table1')
+    table3 = pipeline.get_table('table3')
+    pipeline.close_pipeline()
+
+    inject.add_injectable('settings', {'lazy_checkpoint_tables': True})
+
+    pipeline.open_pipeline(resume_after=_MODELS[-1])
+
+    # tables are only read from the store when first accessed
+    assert pipeline.orca_dataframe_tables() == []
+    pdt.assert_frame_equal(pipeline.get_table('table1'), table1)
+    assert pipeline.orca_dataframe_tables() == ['table1']
+
+    # unchanged (and unread) tables are not checkpointed again
+    inject.add_step('step_add_col', steps.step_add_col)
+    pipeline.run_model('step_add_col.table_name=table1;column_name=c3')
+    checkpoints = pipeline.get_checkpoints()
+    assert checkpoints.table1.iloc[-1] == 'step_add_col.table_name=table1;column_name=c3'
+    assert checkpoints.table3.iloc[-1] == 'step3'
+
+    pdt.assert_frame_equal(pipeline.get_table('table3'), table3)
+    assert list(pipeline.get_table('table1').columns) == ['c', 'c2', 'c3']
+
+    pipeline.close_pipeline()
+    close_handlers()
+
+
+def test_pipeline_compact_tables():
+
+    inject.add_injectable('settings', {'compact_tables': True})
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step_add_col', steps.step_add_col)
+    inject.add_step('step_add_rows', steps.step_add_rows)
+
+    _MODELS = [
+        'step1',
+        'step_add_col.table_name=table1;column_name=c2',
+        'step_add_rows.table_name=table1',
+    ]
+    pipeline.run(models=_MODELS, resume_after=None)
+
+    # compacted by replace_table and extend_table
+    table1 = pipeline.get_table('table1')
+    assert len(table1) == 6
+    assert table1.c2.dtype == 'int32'
+
+    pipeline.close_pipeline()
+
+    # and when loaded from checkpoint
+    pipeline.open_pipeline(resume_after=_MODELS[-1])
+    pdt.assert_frame_equal(pipeline.get_table('table1'), table1)
+    pipeline.close_pipeline()
+
+    close_handlers()
+
+
 # if __name__ == "__main__":
 #
 #     print "\n\ntest_pipeline_run"
@@ -109,3 +109,125 @@ def test_channel():
     npt.assert_almost_equal(np.asanyarray(rands).flatten(), test1_expected_rands2)
 
     rng.end_step('test_step')
+
+
+def test_philox4x32():
+
+    # Random123 known answer test vectors
+    words = random.philox4x32([np.uint64(0)] * 4, (0, 0))
+    assert [int(w) for w in words] == [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8]
+
+    counters = [np.uint64(c) for c in (0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344)]
+    words = random.philox4x32(counters, (0xa4093822, 0x299f31d0))
+    assert [int(w) for w in words] == [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1]
+
+
+def test_counter_channel():
+
+    rng = random.Random()
+    rng.set_channel_type('counter')
+
+    persons = pd.DataFrame(index=pd.Index(np.arange(10000) + 1, name='person_id'))
+
+    rng.begin_step('test_step')
+    rng.add_channel('persons', persons)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        rng.set_channel_type('simple')
+    assert "call set_channel_type before the first step" in str(excinfo.value)
+
+    rands = rng.random_for_df(persons, n=2)
+    assert rands.shape == (10000, 2)
+    assert (rands >= 0).all() and (rands < 1).all()
+    npt.assert_almost_equal(rands.mean(), 0.5, decimal=2)
+
+    # rands of a row don't depend on the other rows of df, and subsequent calls return the next rands
+    subset = persons.iloc[[5, 3]]
+    rands2 = rng.random_for_df(subset)
+    assert not np.isin(rands2, rands).any()
+
+    normals = rng.normal_for_df(persons, mu=1, sigma=2)
+    npt.assert_almost_equal(normals.mean(), 1, decimal=1)
+    npt.assert_almost_equal(normals.std(), 2, decimal=1)
+
+    choices = rng.choice_for_df(persons, [1, 2, 3, 4], 3, replace=True)
+    assert choices.shape == (30000, )
+    assert set(choices) == {1, 2, 3, 4}
+
+    choices = rng.choice_for_df(persons, 10, 4, replace=False).reshape(10000, 4)
+    assert ((choices >= 0) & (choices < 10)).all()
+    assert (np.sort(choices, axis=1)[:, 1:] != np.sort(choices, axis=1)[:, :-1]).all()
+
+    rng.end_step('test_step')
+
+    # same step name, same rands (and the same rands for rows of a subset of df)
+    rng.begin_step('test_step')
+    npt.assert_array_equal(rng.random_for_df(persons, n=2), rands)
+    npt.assert_array_equal(rng.random_for_df(subset), rands2)
+    rng.end_step('test_step')
+
+    # different rands for a different step
+    rng.begin_step('test_step2')
+    assert not np.isin(rng.random_for_df(persons, n=2), rands).any()
+    rng.end_step('test_step2')
+
+
+def test_sample_without_replacement():
+
+    rands = np.random.RandomState(0).rand(60000, 2)
+    samples = random.sample_without_replacement(rands, 4)
+
+    assert samples.shape == (60000, 2)
+    assert (samples[:, 0] != samples[:, 1]).all()
+
+    # every subset is equally likely
+    subsets = pd.Series(np.sort(samples, axis=1).tolist()).map(tuple).value_counts(normalize=True)
+    assert len(subsets) == 6
+    npt.assert_allclose(subsets.values, 1 / 6, atol=0.01)
+
+    # CounterChannel samples are distinct and repeatable
+    rng = random.Random()
+    rng.set_channel_type('counter')
+    households = pd.DataFrame(index=pd.Index(np.arange(100) + 1, name='household_id'))
+    rng.begin_step('test_step')
+    rng.add_channel('households', households)
+    choices = rng.choice_for_df(households, np.arange(10) * 10, 5, replace=False).reshape(100, 5)
+    rng.end_step('test_step')
+
+    assert (np.diff(np.sort(choices, axis=1), axis=1) > 0).all()
+
+    rng.begin_step('test_step')
+    npt.assert_array_equal(rng.choice_for_df(households, np.arange(10) * 10, 5, replace=False),
+                           choices.flatten())
+    rng.end_step('test_step')
+
+    # SimpleChannel samples are the per row numpy choice samples
+    rng = random.Random()
+    rng.begin_step('test_step')
+    rng.add_channel('households', households)
+    choices = rng.choice_for_df(households, np.arange(10) * 10, 5, replace=False)
+    channel = rng.get_channel_for_df(households)
+    channel.row_states['offset'] = 0
+    expected = np.concatenate([prng.choice(np.arange(10) * 10, 5, False)
+                               for prng in channel._generators_for_df(households)])
+    rng.end_step('test_step')
+
+    npt.assert_array_equal(choices, expected)
+
+    # vectorized SimpleChannel samples only depend on the first 5 rands of each row stream
+    rng = random.Random()
+    rng.set_vectorized_choice(True)
+    rng.begin_step('test_step')
+    rng.add_channel('households', households)
+    choices = rng.choice_for_df(households, np.arange(10) * 10, 5, replace=False)
+    channel = rng.get_channel_for_df(households)
+    channel.row_states['offset'] = 0
+    rands = rng.random_for_df(households, n=5)
+    rng.end_step('test_step')
+
+    assert (np.diff(np.sort(choices.reshape(100, 5), axis=1), axis=1) > 0).all()
+    npt.assert_array_equal(choices, random.choice_from_rands(rands, np.arange(10) * 10, replace=False))
+
+    with pytest.raises(RuntimeError) as excinfo:
+        rng.set_vectorized_choice(False)
+    assert "call set_vectorized_choice before the first step" in str(excinfo.value)
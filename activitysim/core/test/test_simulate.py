@@ -87,3 +87,99 @@ def test_simple_simulate_chunked(data, spec):
     choices = simulate.simple_simulate(choosers=data, spec=spec, nest_spec=None, chunk_size=2)
     expected = pd.Series([1, 1, 1], index=data.index)
     pdt.assert_series_equal(choices, expected)
+
+
+def test_float32_utilities(data, spec):
+
+    inject.add_injectable("settings", {'check_for_variability': False, 'float32_utilities': True})
+
+    utilities = simulate.eval_utilities(spec, data)
+    assert (utilities.dtypes == np.float32).all()
+
+    choices = simulate.simple_simulate(choosers=data, spec=spec, nest_spec=None)
+    expected = pd.Series([1, 1, 1], index=data.index)
+    pdt.assert_series_equal(choices, expected)
+
+    inject.reinject_decorated_tables()
+
+
+def test_compare_utility_precision():
+
+    inject.add_injectable("settings", {})
+
+    rng = np.random.RandomState(0)
+    choosers = pd.DataFrame({
+        'x': rng.rand(1000) * 10,
+        'y': rng.randint(0, 5, 1000),
+    })
+    # utilities large enough to overflow float32 exp (unless shifted)
+    spec = pd.DataFrame({
+        'walk': [30.0, -1.5],
+        'bike': [29.5, 0.0],
+        'drive': [31.0, -2.0],
+        'transit': [-999.0, 1.0],
+    }, index=pd.Index(['x', 'y'], name='Expression'))
+    nest_spec = {
+        'name': 'root', 'coefficient': 1.0,
+        'alternatives': [
+            {'name': 'nonmotorized', 'coefficient': 0.5, 'alternatives': ['walk', 'bike']},
+            {'name': 'motorized', 'coefficient': 0.7, 'alternatives': ['drive', 'transit']},
+        ]}
+
+    for nests in [None, nest_spec]:
+        comparison = simulate.compare_utility_precision(choosers, spec, nests)
+
+        assert comparison.choosers == 1000
+        assert comparison.differing_choice_share < 0.01
+        assert comparison.max_prob_difference < 1e-4
+        # (logsums are about 300, and float32 has 24 significant bits)
+        assert comparison.max_logsum_difference < 1e-3
+
+    inject.reinject_decorated_tables()
+
+
+def test_deduplicate_choosers():
+
+    rng = np.random.RandomState(0)
+    choosers = pd.DataFrame({
+        'income_segment': rng.randint(0, 4, 1000),
+        'female': rng.rand(1000) > 0.5,
+        'unused': rng.rand(1000),
+    }, index=pd.Index(np.arange(1000) + 1, name='person_id'))
+    spec = pd.DataFrame({
+        'walk': [1.0, -1.5, 0.0],
+        'bike': [0.5, 0.0, 0.2],
+        'drive': [0.0, 2.0, 0.5],
+    }, index=pd.Index(['female', '@np.log1p(df.income_segment)', '@1'], name='Expression'))
+    nest_spec = {
+        'name': 'root', 'coefficient': 1.0,
+        'alternatives': [
+            {'name': 'nonmotorized', 'coefficient': 0.5, 'alternatives': ['walk', 'bike']},
+            'drive',
+        ]}
+
+    inject.add_injectable("settings", {})
+
+    profiles, profile_of_chooser = simulate.chooser_profiles(spec, choosers)
+    assert len(profiles) == 8
+    columns = ['income_segment', 'female']
+    npt.assert_array_equal(profiles[columns].values[profile_of_chooser], choosers[columns].values)
+
+    # profiles of all the columns are not worth deduplicating
+    assert simulate.chooser_profiles(spec.rename(index={'female': 'unused > 0.5'}), choosers)[0] is None
+
+    for nests in [None, nest_spec]:
+        choices = simulate.simple_simulate(choosers, spec, nests, want_logsums=nests is not None,
+                                           trace_label='test')
+
+        inject.add_injectable("settings", {'deduplicate_choosers': False})
+        expected = simulate.simple_simulate(choosers, spec, nests, want_logsums=nests is not None,
+                                            trace_label='test')
+        inject.add_injectable("settings", {})
+
+        if nests is None:
+            pdt.assert_series_equal(choices, expected)
+        else:
+            pdt.assert_frame_equal(choices, expected)
+
+    inject.reinject_decorated_tables()
@@ -58,6 +58,27 @@ def test_offset_list(data):
         [52, 99, 16])
 
 
+def test_offset_list_sparse():
+
+    # dense offsets array
+    offset_mapper = skim.OffsetMapper()
+    offset_mapper.set_offset_list([2, 4, 6, 8, 10, 12, 14, 16, 18, 20])
+    assert offset_mapper.dense_offsets is not None
+
+    npt.assert_array_equal(offset_mapper.map(np.array([12, 20, 4])), [5, 9, 1])
+    npt.assert_array_equal(offset_mapper.map(pd.Series([12, 3, 40, 0])), [5, -1, -1, -1])
+
+    # searchsorted over (unsorted) sparse ids
+    zone_ids = [617700169958293503, 617700169957507071, 617700169958031359, 617700169957769215]
+    offset_mapper = skim.OffsetMapper()
+    offset_mapper.set_offset_list(zone_ids)
+    assert offset_mapper.dense_offsets is None
+    assert offset_mapper.sorted_zone_ids is not None
+
+    npt.assert_array_equal(offset_mapper.map(np.array(zone_ids[::-1])), [3, 2, 1, 0])
+    npt.assert_array_equal(offset_mapper.map(np.array([zone_ids[2], 1, 617800169958293503])), [2, -1, -1])
+
+
 # fixme - nan support disabled in skim.py (not sure we need it?)
 # def test_skim_nans(data):
 #     sk = skim.SkimWrapper(data)
@@ -144,3 +165,168 @@ def test_3dskims(data):
         ),
         check_dtype=False
     )
+
+
+def test_quantized_skims(data):
+
+    skims_shape = data.shape + (2,)
+
+    # stored as uint8 with scale 0.5 and offset 10
+    skim_data = np.zeros(skims_shape, dtype=np.uint8)
+    skim_data[:, :, 0] = data
+    skim_data[:, :, 1] = data * 2
+
+    quantization = {'dtype': np.dtype(np.uint8), 'scale': 0.5, 'offset': 10}
+
+    skim_info = {
+        'block_offsets': {('SOV', 'AM'): (0, 0), ('SOV', 'PM'): (0, 1)},
+        'key1_block_offsets': {'SOV': (0, 0)},
+        'quantization': {'SOV': quantization}
+    }
+    skim_dict = skim.SkimDict([skim_data], skim_info)
+
+    sk = skim_dict.get(('SOV', 'PM'))
+    result = sk.get([1, 9, 4], [2, 3, 7])
+    assert result.dtype == np.float32
+    npt.assert_array_equal(result, [22, 103, 57])
+
+    stack = skim.SkimStack(skim_dict)
+    skims3d = stack.wrap(left_key="taz_l", right_key="taz_r", skim_key="period")
+
+    df = pd.DataFrame({
+        "taz_l": [1, 9, 4],
+        "taz_r": [2, 3, 7],
+        "period": ["AM", "PM", "AM"]
+    })
+
+    skims3d.set_df(df)
+
+    npt.assert_array_equal(skims3d["SOV"], [16, 103, 33.5])
+
+
+def test_3dskims_dim3_codes(data):
+
+    skims_shape = data.shape + (3,)
+
+    skim_data = np.zeros(skims_shape, dtype=int)
+    skim_data[:, :, 0] = data
+    skim_data[:, :, 1] = data*10
+    skim_data[:, :, 2] = data*100
+
+    skim_info = {
+        'block_offsets': {'DIST': (0, 0), ('SOV', 'AM'): (0, 1), ('SOV', 'PM'): (0, 2)},
+        'key1_block_offsets': {'DIST': (0, 0), 'SOV': (0, 1)}
+    }
+    skim_dict = skim.SkimDict([skim_data], skim_info)
+
+    stack = skim.SkimStack(skim_dict)
+
+    assert stack.dim3_codes == {'AM': 0, 'PM': 1}
+
+    periods = ["AM", "PM", "AM"]
+    codes = stack.dim3_codes_for(periods)
+    npt.assert_array_equal(codes, [0, 1, 0])
+    npt.assert_array_equal(stack.dim3_codes_for(pd.Categorical(periods)), codes)
+    npt.assert_array_equal(stack.dim3_codes_for(codes), codes)
+
+    orig = [1, 9, 4]
+    dest = [2, 3, 7]
+
+    for dim3 in [periods, codes, pd.Series(periods, dtype='category')]:
+        npt.assert_array_equal(stack.lookup(orig, dest, dim3, 'SOV'), [120, 9300, 470])
+
+    with pytest.raises(AssertionError) as excinfo:
+        stack.lookup(orig, dest, ["AM", "EV", "AM"], 'SOV')
+    assert "missing dim3" in str(excinfo.value)
+
+
+def test_skims_lookup_many(data):
+
+    skims_shape = data.shape + (3,)
+
+    skim_data = np.zeros(skims_shape, dtype=int)
+    skim_data[:, :, 0] = data
+    skim_data[:, :, 1] = data*10
+    skim_data[:, :, 2] = data*100
+
+    skim_info = {
+        'block_offsets': {'DIST': (0, 0), ('SOV', 'AM'): (0, 1), ('SOV', 'PM'): (0, 2)},
+        'key1_block_offsets': {'DIST': (0, 0), 'SOV': (0, 1)}
+    }
+    skim_dict = skim.SkimDict([skim_data], skim_info)
+
+    df = pd.DataFrame({
+        "taz_l": [1, 9, 4],
+        "taz_r": [2, 3, 7],
+        "period": ["AM", "PM", "AM"]
+    })
+
+    skims = skim_dict.wrap("taz_l", "taz_r")
+    skims.set_df(df)
+
+    values = skims.lookup_many(['DIST', ('SOV', 'PM')])
+    pdt.assert_series_equal(values['DIST'], skims['DIST'], check_names=False)
+    pdt.assert_series_equal(values[('SOV', 'PM')], skims[('SOV', 'PM')], check_names=False)
+    npt.assert_array_equal(values['DIST'], [12, 93, 47])
+
+    # od index is computed once and reused across keys
+    od_index = skims.od_index
+    npt.assert_array_equal(skims.reverse('DIST'), [21, 39, 74])
+    npt.assert_array_equal(skims.max('DIST'), [21, 93, 74])
+    assert skims.od_index is od_index
+
+    skims.set_df(df.iloc[:2])
+    assert skims.od_index is None
+    npt.assert_array_equal(skims['DIST'], [12, 93])
+
+    # zones not in skim (mapped to -1) read the same cells as 2D lookups, not the previous origin row
+    skim_dict.offset_mapper.set_offset_list(list(range(10, 110, 10)))
+    orig, dest = np.array([20, 999, 50]), np.array([999, 40, 999])
+    assert (skim_dict.offset_mapper.map(dest) == -1).sum() == 2
+    npt.assert_array_equal(skim_dict.lookup_od('DIST', skim_dict.od_index(orig, dest)),
+                           skim_dict.get('DIST').get(orig, dest))
+    npt.assert_array_equal(skim_dict.lookup_od('DIST', skim_dict.od_index(orig, dest)), [19, 93, 49])
+    skim_dict.offset_mapper = skim.OffsetMapper()
+
+    skims3d = skim.SkimStack(skim_dict).wrap(left_key="taz_l", right_key="taz_r", skim_key="period")
+    skims3d.set_df(df)
+
+    values = skims3d.lookup_many(['SOV'])
+    npt.assert_array_equal(values['SOV'], [120, 9300, 470])
+    pdt.assert_series_equal(values['SOV'], skims3d['SOV'], check_names=False)
+
+
+def test_sparse_skims(data):
+
+    # keep od pairs with data value < 50 (upper half of the 10 x 10 skim)
+    rows, cols = np.nonzero(data < 50)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=10))))
+
+    skim_data = np.column_stack([data[rows, cols], data[rows, cols] * 10])
+
+    skim_info = {
+        'omx_shape': data.shape,
+        'block_offsets': {'DIST': (0, 0), 'TIME': (0, 1)},
+    }
+    skim_dict = skim.SparseSkimDict([skim_data], skim_info, indptr, cols,
+                                    default_value=-1, default_values={'TIME': 999})
+    assert skim_dict.nnz == 50
+
+    npt.assert_array_equal(skim_dict.get('DIST').get([1, 9, 4], [2, 3, 7]), [12, -1, 47])
+    npt.assert_array_equal(skim_dict.get('TIME').data[4], [400, 410, 420, 430, 440, 450, 460, 470, 480, 490])
+    npt.assert_array_equal(skim_dict.get('TIME').data[5], [999] * 10)
+
+    df = pd.DataFrame({
+        "taz_l": [1, 9, 4],
+        "taz_r": [2, 3, 7],
+    })
+
+    skims = skim_dict.wrap("taz_l", "taz_r")
+    skims.set_df(df)
+
+    npt.assert_array_equal(skims['TIME'], [120, 999, 470])
+    npt.assert_array_equal(skims.reverse('DIST'), [21, 39, -1])
+
+    values = skims.lookup_many(['DIST', 'TIME'])
+    npt.assert_array_equal(values['DIST'], [12, -1, 47])
+    npt.assert_array_equal(values['TIME'], [120, 999, 470])
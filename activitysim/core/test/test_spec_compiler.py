@@ -0,0 +1,137 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pytest
+
+from .. import inject
+from .. import simulate
+from .. import skim
+from .. import spec_compiler
+
+
+@pytest.fixture(scope='module')
+def df():
+    rng = np.random.RandomState(0)
+    n = 100
+    return pd.DataFrame({
+        'orig': rng.randint(1, 11, n),
+        'dest': rng.randint(1, 11, n),
+        'start': rng.randint(5, 23, n),
+        'duration': rng.randint(0, 18, n),
+        'tour_type': rng.choice(['work', 'shopping', 'escort'], n),
+        'female': rng.rand(n) > 0.5,
+        'income': rng.rand(n) * 100000,
+        'dist': rng.rand(n).astype(np.float32),
+    })
+
+
+@pytest.fixture(scope='module')
+def exprs():
+    return [
+        'female',
+        'start # (2)',
+        "(tour_type == 'work') & (start > 8)",
+        "(tour_type != 'escort') * duration",
+        'income / 1000',
+        'dist * 2.5',
+        '5 < start < 10',
+        "@df.income.clip(upper=50000)",
+        "@od_skims['DIST']",
+        "@od_skims.reverse('DIST')",
+    ]
+
+
+@pytest.fixture(scope='module')
+def od_skims(df):
+    skim_data = np.arange(200, dtype=np.float32).reshape((10, 10, 2))
+    skim_dict = skim.SkimDict([skim_data], {'block_offsets': {'DIST': (0, 0), 'TIME': (0, 1)}})
+    skim_dict.offset_mapper.set_offset_int(-1)
+    od_skims = skim_dict.wrap('orig', 'dest')
+    od_skims.set_df(df)
+    return od_skims
+
+
+def test_compile_spec(exprs):
+
+    compiled_spec = spec_compiler.compile_spec(exprs)
+
+    assert spec_compiler.compile_spec(list(exprs)) is compiled_spec
+
+    kinds = [e.kind for e in compiled_spec.exprs]
+    assert kinds == ['column', 'column', 'arithmetic', 'arithmetic', 'arithmetic', 'arithmetic',
+                     'pandas', 'python', 'skim', 'python']
+
+    assert compiled_spec.exprs[1].source == 'start'
+    assert compiled_spec.exprs[2].names == ['tour_type', 'start']
+    assert compiled_spec.exprs[8].skim_wrapper == 'od_skims'
+    assert compiled_spec.exprs[8].skim_key == 'DIST'
+
+
+def test_compiled_expression_values(df, exprs, od_skims):
+
+    locals_dict = {'df': df, 'od_skims': od_skims}
+
+    # same values as evaluating each expression with DataFrame.eval or python eval
+    expected = np.empty((len(exprs), len(df)))
+    for i, expr in enumerate(exprs):
+        expected[i] = eval(expr[1:], {}, locals_dict) if expr.startswith('@') else df.eval(expr)
+
+    compiled_spec = spec_compiler.compile_spec(exprs)
+    npt.assert_array_equal(compiled_spec.expression_values(df, locals_dict, {}), expected)
+
+
+def test_fused_utilities(df, exprs, od_skims):
+
+    rng = np.random.RandomState(1)
+    spec = pd.DataFrame(rng.rand(len(exprs), 3) * (rng.rand(len(exprs), 3) > 0.3),
+                        index=pd.Index(exprs, name='Expression'), columns=['a', 'b', 'c'])
+    locals_d = {'od_skims': od_skims}
+
+    inject.add_injectable('settings', {})
+    utilities = simulate.eval_utilities(spec, df, locals_d)
+
+    inject.add_injectable('settings', {'fused_utilities': True})
+    fused_utilities = simulate.eval_utilities(spec, df, locals_d)
+
+    npt.assert_allclose(fused_utilities.values, utilities.values, rtol=1e-6)
+
+    # kernels cast the integer columns of divisions to float, as expression_values does
+    division_exprs = ['duration / 3', '(start + duration) / 7', 'female']
+    spec = pd.DataFrame(np.ones((len(division_exprs), 1)),
+                        index=pd.Index(division_exprs, name='Expression'), columns=['a'])
+    fused_utilities = simulate.eval_utilities(spec, df, locals_d)
+    inject.add_injectable('settings', {})
+    npt.assert_array_equal(fused_utilities.values, simulate.eval_utilities(spec, df, locals_d).values)
+
+    # utilities dumped to csv are not fused
+    assert simulate.dump_expression_values('trip_mode_choice.simple_simulate.eval_nl')
+    inject.add_injectable('settings', {'dump_expression_values_trace_labels': []})
+    assert not simulate.dump_expression_values('trip_mode_choice.simple_simulate.eval_nl')
+    inject.add_injectable('settings', {'dump_expression_values_trace_labels': ['test.eval_utilities']})
+    assert simulate.dump_expression_values('test.eval_utilities')
+    assert not simulate.dump_expression_values(None)
+
+    inject.reinject_decorated_tables()
+
+
+def test_column_dependencies(od_skims):
+
+    locals_dict = {'od_skims': od_skims, 'max_income': 50000}
+
+    def dependencies(expr, temps=None):
+        return spec_compiler.CompiledExpression(expr).column_dependencies(locals_dict, temps)
+
+    assert dependencies("(tour_type == 'work') & (start > 8)") == ({'tour_type', 'start'}, False)
+    assert dependencies("@df.income.clip(upper=max_income)") == ({'income'}, False)
+    assert dependencies("@np.log1p(df['income']) * df.female") == ({'income', 'female'}, False)
+    assert dependencies("@od_skims['DIST'] * df.female") == ({'orig', 'dest', 'female'}, True)
+    assert dependencies("@_DIST * df.female", {'_DIST': ({'orig', 'dest'}, True)}) == \
+        ({'orig', 'dest', 'female'}, True)
+
+    # values that depend on other rows (or on anything but df columns) are not row by row
+    assert dependencies("@df.income / df.income.sum()")[0] is None
+    assert dependencies("@df.index.values")[0] is None
+    assert dependencies("@reindex(df.income, df.orig)")[0] is None
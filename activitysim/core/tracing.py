@@ -637,11 +637,11 @@ def interaction_trace_rows(interaction_df, choosers, sample_size=None):
         # or index of interaction_df being same as choosers
         if slicer_column_name in interaction_df.columns:
             trace_rows = np.in1d(interaction_df[slicer_column_name], targets)
-            trace_ids = interaction_df.loc[trace_rows, slicer_column_name].values
+            trace_ids = np.asanyarray(interaction_df[slicer_column_name])[trace_rows]
         else:
             assert interaction_df.index.name == choosers.index.name
             trace_rows = np.in1d(interaction_df.index, targets)
-            trace_ids = interaction_df[trace_rows].index.values
+            trace_ids = interaction_df.index[trace_rows].values
 
     else:
 